@@ -2,11 +2,13 @@ SET threads = 4;
 SET preserve_insertion_order = false;
 SET temp_directory = 'data/DVF/';
 
-DROP TABLE IF EXISTS Classes;
-DROP TABLE IF EXISTS Mutations;
+-- Department of a parcel, the overseas departments have 3 digits
+CREATE OR REPLACE MACRO departement(idpar) AS
+	CASE WHEN idpar LIKE '97%' THEN left(idpar, 3) ELSE left(idpar, 2) END;
 
-CREATE TABLE Mutations (
-	idg INTEGER PRIMARY KEY,
+-- Kept between the runs by the warehouse, databases/reset.sql drops them first otherwise
+CREATE TABLE IF NOT EXISTS Mutations (
+	idg BIGINT PRIMARY KEY,
 	idpar VARCHAR NOT NULL,
 	idmutation INTEGER NOT NULL,
 	vefa BOOLEAN NOT NULL,
@@ -24,9 +26,22 @@ CREATE TABLE Mutations (
 	vendu BOOLEAN
 );
 
-CREATE TABLE Classes (
-	idg INTEGER NOT NULL,
+CREATE TABLE IF NOT EXISTS Classes (
+	idg BIGINT NOT NULL,
 	libelle VARCHAR NOT NULL,
 	surface DECIMAL(12,2) NOT NULL,
 	FOREIGN KEY (idg) REFERENCES Mutations(idg)
 );
+
+-- Extracted files already merged into the warehouse, a rewritten file has a new modified time
+CREATE TABLE IF NOT EXISTS LoadedFiles (
+	filename VARCHAR PRIMARY KEY,
+	modified DOUBLE NOT NULL,
+	loaded_at TIMESTAMP NOT NULL
+);
+
+-- Partitions changed by the merges not exported yet, kept when a run stops between its merges and its export
+CREATE TABLE IF NOT EXISTS AffectedPartitions (
+	annee BIGINT NOT NULL,
+	departement VARCHAR NOT NULL
+);
@@ -0,0 +1,4 @@
+DROP TABLE IF EXISTS Classes;
+DROP TABLE IF EXISTS Mutations;
+DROP TABLE IF EXISTS LoadedFiles;
+DROP TABLE IF EXISTS AffectedPartitions;
@@ -0,0 +1,16 @@
+{#
+    The incremental models replace the rows dated from dvf_since(): the mutations are merged on idg,
+    then these hooks delete the rows the extraction no longer has, deleted from the API for instance,
+    and the classes of the mutations about to be inserted again.
+#}
+{% macro dvf_delete_removed_mutations() %}
+    DELETE FROM {{ this }}
+    WHERE datemut >= {{ dvf_since() }}
+      AND idg NOT IN (SELECT idg FROM {{ ref('dvf_mutations') }})
+{% endmacro %}
+
+{% macro dvf_delete_replaced_classes() %}
+    -- Only the classes of the older mutations are kept, the ones of the deleted mutations are dropped too
+    DELETE FROM {{ this }}
+    WHERE idg NOT IN (SELECT idg FROM {{ ref('mutations') }} WHERE datemut < {{ dvf_since() }})
+{% endmacro %}
@@ -0,0 +1,13 @@
+{#
+    Lower bound of the datemut rewritten by an incremental run: the first year rewritten by the last
+    partitioned export when load.py sets DVF_SINCE_DVFPLUS, else the start of the year of the
+    latest datemut of the extracted rows minus dvf_lookback_years. Older changes need a --full-refresh.
+#}
+{% macro dvf_since() %}
+    {%- set since = env_var('DVF_SINCE_DVFPLUS', '') -%}
+    {%- if since -%}
+        CAST('{{ since }}' AS DATE)
+    {%- else -%}
+        (SELECT CAST(TIMESTAMPADD(YEAR, -{{ var('dvf_lookback_years') }}, DATE_TRUNC('YEAR', MAX(datemut))) AS DATE) FROM {{ ref('dvf_mutations') }} AS latest)
+    {%- endif -%}
+{% endmacro %}
@@ -1 +1,15 @@
-SELECT * FROM DVF."classes.parquet"
\ No newline at end of file
+-- depends_on: {{ ref('mutations') }}
+-- depends_on: {{ ref('dvf_mutations') }}
+{{ config(
+    materialized='incremental',
+    incremental_strategy='append',
+    pre_hook="{% if is_incremental() %}{{ dvf_delete_replaced_classes() }}{% endif %}"
+) }}
+
+SELECT c.*
+FROM {{ ref('dvf_classes') }} AS c
+{% if is_incremental() %}
+JOIN (
+    SELECT idg FROM {{ ref('mutations') }} WHERE datemut >= {{ dvf_since() }}
+) m ON c.idg = m.idg
+{% endif %}
@@ -0,0 +1,4 @@
+{{ config(materialized='view') }}
+
+SELECT *
+FROM DVF."classes.parquet" AS dvf
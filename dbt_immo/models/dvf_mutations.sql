@@ -0,0 +1,4 @@
+{{ config(materialized='view') }}
+
+SELECT *
+FROM DVF."mutations.parquet" AS dvf
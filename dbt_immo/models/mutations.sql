@@ -1 +1,12 @@
-SELECT * FROM DVF."mutations.parquet"
\ No newline at end of file
+{{ config(
+    materialized='incremental',
+    incremental_strategy='merge',
+    unique_key='idg',
+    post_hook="{{ dvf_delete_removed_mutations() }}"
+) }}
+
+SELECT s.*
+FROM {{ ref('dvf_mutations') }} AS s
+{% if is_incremental() %}
+WHERE s.datemut >= {{ dvf_since() }}
+{% endif %}
@@ -0,0 +1,256 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, replace
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import duckdb
+import pyarrow.parquet as pq
+from synthetic import SyntheticConfig, generate_features, generate_response
+
+# The scripts of the databases folder are read relatively to the root of the repository
+ROOT = Path(__file__).resolve().parent.parent
+
+# Peak resident memory of each timed call above the memory in use when it started, so the
+# generation of the input isn't counted
+PEAKS_MB: List[float] = []
+
+def memory_status() -> Optional[Dict[str, int]]:
+    # Linux resets the peak resident memory (VmHWM) of the process on writing 5 to clear_refs
+    try:
+        with open("/proc/self/clear_refs", 'w') as fs:
+            fs.write("5")
+        with open("/proc/self/status", 'r') as fs:
+            return {name: int(value.split()[0]) for name, value in (line.split(":", 1) for line in fs) if name in ("VmRSS", "VmHWM")}
+    except (OSError, ValueError):
+        return None
+
+def peak_above(status: Dict[str, int]) -> Optional[float]:
+    try:
+        with open("/proc/self/status", 'r') as fs:
+            for line in fs:
+                if line.startswith("VmHWM:"):
+                    return (int(line.split()[1]) - status["VmRSS"]) / 1024
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def timed(function: Callable[[], int]) -> Tuple[float, int]:
+    status = memory_status()
+    start = time.perf_counter()
+    units = function()
+    seconds = time.perf_counter() - start
+    peak = peak_above(status) if status is not None else None
+    if peak is not None:
+        PEAKS_MB.append(peak)
+    return seconds, units
+
+def bench_transform(config: SyntheticConfig, repeat: int) -> Tuple[List[Tuple[float, int]], str]:
+    from transform_api_dvf import transform_api_data
+    body = generate_response(config)
+    return [timed(lambda: len(transform_api_data(body)[0])) for _ in range(repeat)], "rows"
+
+def bench_split_geometry(config: SyntheticConfig, repeat: int) -> Tuple[List[Tuple[float, int]], str]:
+    from geometry import split_geometry
+    geometries = [feature["geometry"] for feature in generate_features(config)]
+
+    def run() -> int:
+        for geometry in geometries:
+            split_geometry(geometry)
+        return len(geometries)
+    return [timed(run) for _ in range(repeat)], "geometries"
+
+def bench_write_parquet(config: SyntheticConfig, repeat: int) -> Tuple[List[Tuple[float, int]], str]:
+    from transform_api_dvf import transform_api_data
+    from tables import MUTATIONS_LAYOUT, CLASSES_LAYOUT, write_batch_to_parquet
+    mutations, classes = transform_api_data(generate_response(config))
+
+    with tempfile.TemporaryDirectory() as folder:
+        def run() -> int:
+            write_batch_to_parquet(mutations.to_batch(), os.path.join(folder, "mutations.parquet"), MUTATIONS_LAYOUT)
+            write_batch_to_parquet(classes.to_batch(), os.path.join(folder, "classes.parquet"), CLASSES_LAYOUT)
+            return len(mutations)
+        return [timed(run) for _ in range(repeat)], "rows"
+
+def write_extracted(config: SyntheticConfig, folder: Path, files: int) -> None:
+    from transform_api_dvf import transform_api_data
+    from tables import MUTATIONS_LAYOUT, CLASSES_LAYOUT, write_batch_to_parquet
+    folder.mkdir(parents=True, exist_ok=True)
+    for index in range(files):
+        body = generate_response(replace(config, seed=config.seed + index, start=index * config.features * config.dispositions))
+        mutations, classes = transform_api_data(body)
+        write_batch_to_parquet(mutations.to_batch(), str(folder / f"mutations_{index}.parquet"), MUTATIONS_LAYOUT)
+        write_batch_to_parquet(classes.to_batch(), str(folder / f"classes_{index}.parquet"), CLASSES_LAYOUT)
+
+def bench_from_folder(config: SyntheticConfig, repeat: int, files: int) -> Tuple[List[Tuple[float, int]], str]:
+    import extract_duckdb
+    with tempfile.TemporaryDirectory() as folder:
+        extracted = Path(folder) / "extracted"
+        write_extracted(config, extracted, files)
+
+        def run() -> int:
+            conn = duckdb.connect()
+            extract_duckdb.from_folder(conn, extracted, lambda conn: None)
+            row = conn.execute("SELECT count(*) FROM mutations").fetchone()
+            conn.close()
+            return row[0] if row else 0
+        return [timed(run) for _ in range(repeat)], "rows"
+
+def bench_extraction(config: SyntheticConfig, repeat: int, files: int) -> Tuple[List[Tuple[float, int]], str]:
+    # Extraction of files departments from the local simulator, each one has 4 geometries larger than it accepts
+    import simulator
+    server, _ = simulator.start(simulator.SimulatorConfig(max_area=25e6, seed=config.seed, synthetic=replace(config, dispositions=1)))
+    os.environ.update({
+        "API_URL_DVFPLUS": f"http://127.0.0.1:{server.server_address[1]}",
+        "CACHE_DVFPLUS": "0",
+        "RATE_DVFPLUS": "1000",
+        "MAX_RATE_DVFPLUS": "1000",
+    })
+
+    results = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                departments = Path(folder) / "departments"
+                departments.mkdir()
+                for index in range(files):
+                    x = 2.0 + index * 0.2
+                    squares = [[[x, y], [x + 0.08, y], [x + 0.08, y + 0.08], [x, y + 0.08], [x, y]] for y in (45.0, 45.1, 45.2, 45.3)]
+                    with open(departments / f"{index:02d}.json", 'w') as fs:
+                        json.dump({"features": [{"geometry": {"type": "Polygon", "coordinates": [square]}} for square in squares]}, fs)
+
+                # The learned surface limit and tilings are module state, each run starts from scratch
+                for name in ("tiling", "rate_limiter", "cache", "manifest", "extract_api_dvf"):
+                    if name in sys.modules:
+                        importlib.reload(sys.modules[name])
+                import extract_api_dvf
+
+                def run() -> int:
+                    extract_api_dvf.main(str(departments))
+                    extracted = Path(folder) / extract_api_dvf.TARGET_FOLDER
+                    return sum(pq.ParquetFile(path).metadata.num_rows for path in extracted.glob("mutations_*.parquet"))
+                results.append(timed(run))
+            finally:
+                os.chdir(ROOT)
+
+    server.shutdown()
+    return results, "rows"
+
+CASES: Dict[str, Callable[..., Tuple[List[Tuple[float, int]], str]]] = {
+    "transform_api_data": bench_transform,
+    "split_geometry": bench_split_geometry,
+    "write_parquet": bench_write_parquet,
+    "from_folder": bench_from_folder,
+    "extraction": bench_extraction,
+}
+
+def run_case(name: str, config: SyntheticConfig, repeat: int, files: int, results: Any) -> None:
+    # Runs in its own process so the memory of a case doesn't carry over to the next ones
+    os.chdir(ROOT)
+    function = CASES[name]
+    if name in ("from_folder", "extraction"):
+        timings, unit = function(config, repeat, files)
+    else:
+        timings, unit = function(config, repeat)
+
+    seconds, units = min(timings)
+    results.put({
+        "seconds": seconds,
+        "units": units,
+        "unit": unit,
+        "throughput": units / seconds if seconds > 0 else None,
+        "all_seconds": [timing for timing, _ in timings],
+        # None where the peak resident memory can't be reset
+        "peak_rss_mb": max(PEAKS_MB) if PEAKS_MB else None,
+    })
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def run(cases: List[str], config: SyntheticConfig, repeat: int, files: int) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    report: Dict[str, Any] = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {**asdict(config), "repeat": repeat, "files": files},
+        "results": {}
+    }
+    for name in cases:
+        results = context.Queue()
+        process = context.Process(target=run_case, args=(name, config, repeat, files, results))
+        process.start()
+        result = results.get()
+        process.join()
+        report["results"][name] = result
+        peak = f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] is not None else "n/a"
+        print(f"{name:<20} {result['throughput']:>14.0f} {result['unit']}/s  {result['seconds']:.3f}s  peak {peak}", file=sys.stderr)
+    return report
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> bool:
+    # Returns False when a case is slower than the baseline by more than the threshold
+    ok = True
+    print(f"Compared with {baseline.get('commit')}", file=sys.stderr)
+    for name, result in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None or not previous.get("throughput") or not result.get("throughput"):
+            continue
+        ratio = result["throughput"] / previous["throughput"]
+        regression = ratio < 1 - threshold
+        ok = ok and not regression
+        print(f"{name:<20} x{ratio:.2f} {'REGRESSION' if regression else ''}", file=sys.stderr)
+    return ok
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks of the extraction on synthetic DVF+ responses")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--features", type=int, default=2000)
+    parser.add_argument("--dispositions", type=int, default=1)
+    parser.add_argument("--parcels", type=int, default=3)
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--vertices", type=int, default=64)
+    parser.add_argument("--files", type=int, default=8, help="extracted files loaded by from_folder, departments of extraction")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="writes the JSON report to this file instead of the standard output")
+    parser.add_argument("--compare", help="JSON report of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown tolerated by --compare")
+    args = parser.parse_args()
+
+    config = SyntheticConfig(
+        features=args.features, dispositions=args.dispositions, parcels=args.parcels,
+        classes=args.classes, vertices=args.vertices, seed=args.seed
+    )
+    report = run(args.cases, config, args.repeat, args.files)
+
+    if args.output:
+        with open(args.output, 'w') as fs:
+            json.dump(report, fs, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, 'r') as fs:
+            baseline = json.load(fs)
+        if not compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from typing import Optional, Tuple
+from utils import *
+
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER_DVFPLUS", "data/DVF/cache")
+# Total size of the compressed responses kept on disk
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES_DVFPLUS", str(5 * 1024 ** 3)))
+CACHE_ENABLED = os.environ.get("CACHE_DVFPLUS", "1") == "1"
+# Serve every request from the cache and never call the API
+REPLAY_DVFPLUS = os.environ.get("REPLAY_DVFPLUS", "0") == "1"
+
+CACHE_MISS = "Cache miss in replay mode"
+# The eviction removes entries until the cache is back under this fraction of its maximum size
+EVICTION_TARGET = 0.9
+
+def cache_key(endpoint: str, data: dict, filters: dict) -> str:
+    payload = json.dumps([endpoint, data, filters], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResponseCache:
+    def __init__(self, folder: str = CACHE_FOLDER, max_bytes: int = CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size: Optional[int] = None
+        self.lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.gz")
+
+    def entries(self) -> list[os.DirEntry]:
+        entries: list[os.DirEntry] = []
+        if os.path.exists(self.folder):
+            for directory in os.scandir(self.folder):
+                if directory.is_dir():
+                    entries.extend(entry for entry in os.scandir(directory.path) if entry.name.endswith(".gz"))
+        return entries
+
+    def get(self, key: str) -> Optional[Tuple[int, bytes]]:
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as fs:
+                content = gzip.decompress(fs.read())
+            # The modification time is the last access time used by the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as error:
+            logger.error(f"Failed to read the cache entry {path} : {error}")
+            return None
+
+        status, _, body = content.partition(b"\n")
+        return int(status), body
+
+    def put(self, key: str, status: int, body: bytes) -> None:
+        path = self.path(key)
+        compressed = gzip.compress(f"{status}\n".encode() + body)
+        try:
+            # An overwritten entry no longer counts in the size of the cache
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as fs:
+                fs.write(compressed)
+            os.replace(temp_path, path)
+        except Exception as error:
+            logger.error(f"Failed to write the cache entry {path} : {error}")
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry.stat().st_size for entry in self.entries())
+            else:
+                self.size += len(compressed) - previous
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+        target = self.max_bytes * EVICTION_TARGET
+
+        for entry in entries:
+            if size <= target:
+                break
+            try:
+                entry_size = entry.stat().st_size
+                os.remove(entry.path)
+                size -= entry_size
+            except FileNotFoundError:
+                pass
+        self.size = size
+        logger.info(f"Evicted cache entries, the cache now uses {size} bytes")
+
+CACHE: Optional[ResponseCache] = ResponseCache() if CACHE_ENABLED or REPLAY_DVFPLUS else None
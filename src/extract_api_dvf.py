@@ -1,20 +1,34 @@
 from utils import *
-from typing import Any
+from typing import Any, Callable, Optional
+import pyarrow as pa
 import requests
 from requests import Response
 import json
 import os
-from datetime import date
+from datetime import date, datetime
 import time
 import re
-from geometry import split_geometry
-from transform_api_dvf import transform_api_data
-from tables import Mutation, Classes, write_mutations_to_parquet, write_classes_to_parquet
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import transport
+from rate_limiter import SCHEDULER
+from cache import CACHE, CACHE_MISS, REPLAY_DVFPLUS, cache_key
+from manifest import MANIFEST, DEFERRED_FEATURES, INCREMENTAL
+from tiling import TILING_CACHE, SURFACE_LIMIT
+from geometry import split_geometry, split_into_tiles, geometry_area
+from writers import DepartmentWriter, RAW_PARQUET
+from pipeline import Pipeline
+from metrics import METRICS
 from dotenv import load_dotenv
 
 load_dotenv()
 
 API_KEY_DVFPLUS = os.environ.get("API_KEY_DVFPLUS")
+API_URL_DVFPLUS = os.environ.get("API_URL_DVFPLUS", "https://api.sogefi-sig.com")
+
+# Maximum number of 'mutation/search' calls in flight across all features and departments
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT_DVFPLUS", "8"))
+# Maximum number of features processed at the same time
+MAX_FEATURES = int(os.environ.get("MAX_FEATURES_DVFPLUS", "8"))
 
 HEADERS = {
     'Content-Type': 'application/json',
@@ -24,36 +38,89 @@ HEADERS = {
 # Default filters
 FILTERS = {
     "valeurfonc[lte]": "100000000000000000",
-    "datemut[lt]": date.today().strftime("%Y-%m-%d"),
+    "datemut[lt]": os.environ.get("DATEMUT_DVFPLUS", date.today().strftime("%Y-%m-%d")),
     "buffer": "0"
 }
 
 TARGET_FOLDER = "data/DVF/extracted"
+# Identifies the files written by this run
+RUN_ID = datetime.now().strftime("%Y%m%d%H%M%S")
+# Requests still failing at the end of a run, they are retried first by the next run
+DEFERRED_PATH = "data/DVF/deferred_requests.json"
+
+# Status codes worth retrying: quota exceeded and temporary server errors
+RETRY_STATUS = (402, 429, 500, 501, 502, 503, 504)
+MAX_RETRIES = 5
+RETRY_ROUNDS = 3
 
 REGEX_ERROR = re.compile(r"""403\s*:\s*\{"message":"Surface\s+(.*?)\s+du\s+GeoJSON\s+trop\s+grande"\}""")
+REGEX_STATUS = re.compile(r"status code : (\d{3})")
     
-def api_post(endpoint: str, headers: dict = HEADERS, data: dict = {}, filters: dict = FILTERS) -> Result[Response, str]:
-    url = f"https://api.sogefi-sig.com/{API_KEY_DVFPLUS}/dvfplus/v1.0/sogefi/{endpoint}"
+def api_post(endpoint: str, headers: dict = HEADERS, data: dict = {}, filters: dict = FILTERS) -> Result[bytes, str]:
+    url = f"{API_URL_DVFPLUS}/{API_KEY_DVFPLUS}/dvfplus/v1.0/sogefi/{endpoint}"
+    key = cache_key(endpoint, data, filters)
 
-    response: Response = requests.post(
-        url=url,
-        headers=headers,
-        params=filters,
-        json=data
-    )
+    if CACHE is not None:
+        cached = CACHE.get(key)
+        if cached is not None:
+            status, body = cached
+            METRICS.cache_hits.inc()
+            if status == 200:
+                return Ok(body)
+            return Err(f"Failed to POST '{url}' (cached), status code : {status} : {body.decode(errors='replace')}")
+    if REPLAY_DVFPLUS:
+        return Err(f"{CACHE_MISS} : '{endpoint}' {key}")
+
+    sent = SCHEDULER.acquire()
+    start = time.perf_counter()
+    try:
+        response: Response = transport.post(
+            url=url,
+            headers=headers,
+            params=filters,
+            json=data
+        )
+    except requests.RequestException as error:
+        METRICS.requests.observe(time.perf_counter() - start, status="error")
+        logger.error(error)
+        return Err(f"Failed to POST '{url}' : {error}")
 
     if response.status_code == 200:
+        SCHEDULER.on_success()
         try:
-            return Ok(response)
+            content = transport.read_body(response)
         except Exception as error:
+            METRICS.requests.observe(time.perf_counter() - start, status="error")
             logger.error(error)
-            return Err(f"Failed to convert to json format the following content :\n{response.reason}\nError occured : {error}")
+            return Err(f"Failed to read the content of the response :\n{response.reason}\nError occured : {error}")
+        seconds = time.perf_counter() - start
+        METRICS.requests.observe(seconds, status=200)
+        METRICS.response_bytes.inc(len(content))
+        METRICS.stage_seconds.observe(seconds, stage="fetch")
+        if CACHE is not None:
+            CACHE.put(key, response.status_code, content)
+        return Ok(content)
     elif response.status_code == 402:
+        response.close()
+        METRICS.requests.observe(time.perf_counter() - start, status=402)
+        SCHEDULER.on_quota(sent)
         logger.error("Error 402")
         return Err(f"Failed to POST '{url}' status code : 402 - Ecxceed request quota")
     else:
         logger.error(f"Error {response.status_code}")
-        return Err(f"Failed to POST '{url}', status code : {response.status_code} - {response.reason}")
+        try:
+            content = transport.read_body(response)
+        except Exception as error:
+            METRICS.requests.observe(time.perf_counter() - start, status="error")
+            logger.error(error)
+            return Err(f"Failed to POST '{url}' ({response.reason}), status code : {response.status_code} : failed to read the content : {error}")
+        METRICS.requests.observe(time.perf_counter() - start, status=response.status_code)
+        METRICS.response_bytes.inc(len(content))
+        message = f"Failed to POST '{url}' ({response.reason}), status code : {response.status_code} : {content.decode(errors='replace')}"
+        # The geometries rejected as too large are cached so a replay splits them the same way
+        if CACHE is not None and REGEX_ERROR.search(message):
+            CACHE.put(key, response.status_code, content)
+        return Err(message)
     
 def get_department(path: str) -> Result[dict, str]:
     try:
@@ -68,95 +135,305 @@ def get_department(path: str) -> Result[dict, str]:
         logger.error(error)
         return Err(f"Error occurs when try to get the data from {path} :\n{error}")
     
-def process_feature(feature_id: str, idg: int, data: dict) -> Result[int, str]:
-    failed_retry = False
-    buffer: list[dict] = [data]
+def status_code(message: str) -> Optional[int]:
+    found = REGEX_STATUS.search(message)
+    return int(found.group(1)) if found else None
+
+def is_retriable(message: str) -> bool:
+    status = status_code(message)
+    if status is None:
+        return not message.startswith(CACHE_MISS)
+    return status in RETRY_STATUS
+
+def fetch(data: dict, filters: dict, retries: int = 0) -> Result[bytes, str]:
+    if retries > 0:
+        time.sleep(SCHEDULER.backoff(retries))
+    return api_post(endpoint="mutation/search", data=data, filters=filters)
+
+def pre_split(item: dict) -> list[dict]:
+    # Split up front the geometries larger than the surface the API is known to accept
+    target = SURFACE_LIMIT.target()
+    geometry = item.get("geojson")
+    if target is None or not geometry:
+        return [item]
+
+    try:
+        area = geometry_area(geometry)
+    except ValueError:
+        return [item]
+    if area <= target:
+        return [item]
+
+    match split_into_tiles(geometry, target):
+        case Ok(tiles) if len(tiles) > 1:
+            logger.info(f"Pre-split a geometry of {area:.0f} m2 into {len(tiles)} tiles")
+            return [{'geojson': tile} for tile in tiles]
+        case Ok(_):
+            return [item]
+        case Err(message):
+            logger.error(message)
+            return [item]
+
+def request_area(item: dict) -> Optional[float]:
+    try:
+        return geometry_area(item["geojson"])
+    except (KeyError, TypeError, ValueError):
+        return None
 
-    mutations: list[Mutation] = []
-    classes: list[Classes] = []
+def process_feature(
+    feature_id: str,
+    data: dict,
+    pipeline: Pipeline,
+    writer: DepartmentWriter,
+    filters: dict = FILTERS
+) -> Result[tuple[int, Optional[str]], str]:
+    # Each item of the buffer is a geometry to request with the number of retries already done
+    # and the number of splits that led to it
+    buffer: list[tuple[dict, int, int]] = [(data, 0, 0)]
+    # Set when a part of the feature couldn't be extracted
+    failed = False
+    # Requests left to the retry rounds
+    deferred = 0
+    # Geometries accepted by the API, saved as the tiling of the feature when it had to be split
+    accepted: list[dict] = []
+    split = False
+
+    feature_geometry = data.get("geojson")
+    if feature_geometry:
+        tiles = TILING_CACHE.get(feature_geometry)
+        if tiles is not None:
+            buffer = [({'geojson': tile}, 0, 1) for tile in tiles]
+            split = True
+
+    # Responses being transformed by the worker processes
+    transforms: list[Future] = []
+    rows = 0
+    last_datemut: Optional[str] = None
+
+    def collect(block: bool) -> None:
+        # Hands the transformed responses to the writers, waits for all of them when block is set
+        nonlocal transforms, rows, last_datemut, failed
+        done = [future for future in transforms if block or future.done()]
+        transforms = [future for future in transforms if future not in done]
+        for future in done:
+            try:
+                transformed = future.result()
+            except Exception as error:
+                logger.error(f"Failed to transform a response of the feature {feature_id} : {error}")
+                failed = True
+                continue
+            rows += transformed.mutations.num_rows
+            METRICS.stage_seconds.observe(transformed.seconds, stage="transform")
+            METRICS.stage_rows.inc(transformed.mutations.num_rows, stage="transform")
+            last_datemut = max(last_datemut or "", transformed.last_datemut or "") or None
+            pipeline.write(writer, transformed)
 
     while len(buffer) > 0:
-        api_response: Result[Response, str] = api_post(
-            endpoint="mutation/search",
-            data=buffer[0]
-        )
+        # Only the new geometries are pre-split, the retries are sent as they are
+        if SURFACE_LIMIT.target() is not None:
+            items: list[tuple[dict, int, int]] = []
+            for item, retries, depth in buffer:
+                tiles = pre_split(item) if retries == 0 else [item]
+                split = split or len(tiles) > 1
+                depth = depth + 1 if len(tiles) > 1 else depth
+                items.extend((tile, retries, depth) for tile in tiles)
+            buffer = items
 
-        match (api_response, failed_retry):
-            case (Ok(response), default):
-                content: str = response.text
-                try:
-                    new_idg, mut_data, cls_data = transform_api_data(content, idg)
-                except Exception as error:
-                    logger.error(error)
-                    raise error
-                
-                idg = new_idg
-                mutations.extend(mut_data)
-                classes.extend(cls_data)
-
-                buffer.pop(0)
-                idg += 1
-                break
-            case (Err(message), True):
-                logger.error(message)
-                buffer.pop(0)
-                failed_retry = False
-                break
-            case (Err(message), False):
-                logger.error(message)
-                if "402" in message or "501" in message:
-                    time.sleep(60)
-                    failed_retry = True
-                elif REGEX_ERROR.match(message):
-                    geometry = buffer[0].get("geojson")
-                    if geometry:
-                        match split_geometry(geometry):
+        futures = [
+            (item, retries, depth, pipeline.fetch(fetch, item, filters, retries))
+            for item, retries, depth in buffer
+        ]
+        buffer = []
+
+        for item, retries, depth, future in futures:
+            match future.result():
+                case Ok(content):
+                    METRICS.split_depth.observe(depth)
+                    transforms.append(pipeline.transform(content))
+                    tile = item.get("geojson")
+                    if tile is not None:
+                        accepted.append(tile)
+                    area = request_area(item)
+                    if area is not None:
+                        SURFACE_LIMIT.accepted(area)
+                case Err(message) if (surface := REGEX_ERROR.search(message)) is not None:
+                    logger.warning(message)
+                    split = True
+                    tile = item.get("geojson")
+                    area = request_area(item)
+                    if area is not None:
+                        SURFACE_LIMIT.rejected(area, surface.group(1))
+                    tiles = pre_split(item)
+                    if len(tiles) > 1:
+                        buffer.extend((piece, 0, depth + 1) for piece in tiles)
+                    elif tile:
+                        # Bisection when the surface limit doesn't give a tiling
+                        match split_geometry(tile):
                             case Ok((geometry1, geometry2)):
-                                buffer.pop(0)
-                                buffer.append({'geojson': geometry1})
-                                buffer.append({'geojson': geometry2})
-                                break
+                                buffer.append(({'geojson': geometry1}, 0, depth + 1))
+                                buffer.append(({'geojson': geometry2}, 0, depth + 1))
                             case Err(message):
                                 logger.error(message)
-                                break
+                                failed = True
                     else:
                         logger.error("Failed to get the key 'geojson'")
-                    break
-                else:
-                    buffer.pop(0)
-                    break
+                        failed = True
+                case Err(message) if is_retriable(message):
+                    logger.warning(message)
+                    if retries < MAX_RETRIES:
+                        METRICS.retries.inc(status=status_code(message) or "error")
+                        buffer.append((item, retries + 1, depth))
+                    else:
+                        logger.error(f"Deferred a request of the feature {feature_id} after {retries} retries")
+                        METRICS.deferred.inc()
+                        SCHEDULER.defer((feature_id, item, filters))
+                        deferred += 1
+                case Err(message):
+                    logger.error(message)
+                    failed = True
 
-    mutations_path = os.path.join(TARGET_FOLDER, f"mutations_{feature_id}.parquet")
-    classes_path = os.path.join(TARGET_FOLDER, f"classes_{feature_id}.parquet")
+        collect(block=False)
 
-    if len(mutations) > 0:
-        try:
-            write_mutations_to_parquet(mutations, mutations_path)
-            write_classes_to_parquet(classes, classes_path)
-            return Ok(idg)
-        except Exception as error:
-            message = f"{error}"
-            logger.error(message)
-            return Err(message)
-    else:
+    collect(block=True)
+    DEFERRED_FEATURES.extracted(feature_id, filters["datemut[lt]"], deferred, failed, last_datemut, rows)
+
+    if failed or deferred > 0:
         return Err(f"Incomplete values {feature_id}")
+    # Only the tiling of a feature fully extracted, transforms included
+    if split and feature_geometry:
+        TILING_CACHE.put(feature_geometry, accepted)
+    return Ok((rows, last_datemut))
+
+def commit(writer: DepartmentWriter, on_commit: Optional[Callable[[str, str], None]] = None) -> None:
+    # The manifest records the features of a department once its files are committed
+    match writer.close():
+        case Ok(path):
+            if path is not None:
+                logger.info(f"Committed {path}")
+                for table, sink in (("mutations", writer.mutations), ("classes", writer.classes)):
+                    if os.path.exists(sink.path):
+                        METRICS.file_bytes.observe(os.path.getsize(sink.path), table=table)
+                if on_commit is not None:
+                    on_commit(writer.mutations.path, writer.classes.path)
+            for args in writer.completed:
+                MANIFEST.complete(*args)
+        case Err(message):
+            logger.error(message)
+
+def finish_feature(pipeline: Pipeline, writer: DepartmentWriter, completion: Optional[tuple] = None) -> None:
+    # The last feature of a department commits its files after all its batches are written
+    if writer.feature_done(completion):
+        pipeline.submit_write(writer, commit, writer, pipeline.on_commit)
+
+def extract_feature(
+    feature_id: str,
+    data: dict,
+    pipeline: Pipeline,
+    writer: DepartmentWriter
+) -> Result[tuple[int, Optional[str]], str]:
+    upper = FILTERS["datemut[lt]"]
+    filters = dict(FILTERS)
+    completion = None
+
+    try:
+        if INCREMENTAL:
+            watermark = MANIFEST.watermark(feature_id)
+            if watermark is not None and watermark >= upper:
+                logger.info(f"The feature {feature_id} is already extracted until {watermark}")
+                return Ok((0, None))
+            if watermark is not None:
+                filters["datemut[gte]"] = watermark
+
+        result = process_feature(feature_id, data, pipeline, writer, filters)
+        match result:
+            case Ok((nb, last_datemut)):
+                completion = (feature_id, upper, last_datemut, nb)
+        return result
+    finally:
+        finish_feature(pipeline, writer, completion)
+
+def process_features(
+    features: list[dict],
+    dpt: int,
+    pipeline: Pipeline,
+    feature_pool: Executor
+) -> list[Future]:
+    futures: list[Future] = []
+    # The incremental runs keep the files of the previous runs
+    name = f"{dpt}_{RUN_ID}" if INCREMENTAL else f"{dpt}"
+    writer = DepartmentWriter(TARGET_FOLDER, name, len(features))
+    if len(features) == 0:
+        return futures
 
-def process_features(features: list[dict], idg: int, dpt: int) -> Result[int, str]:
     for index, feature in enumerate(features):
         geometry = feature['geometry']
         data = {"geojson": geometry}
-        feature_id = f"{dpt}{index}"
+        feature_id = f"{dpt}_{index}"
 
-        result: Result[int, str] = process_feature(feature_id, idg, data)
+        futures.append(feature_pool.submit(extract_feature, feature_id, data, pipeline, writer))
 
-        match result:
-            case Ok(nb):
-                idg = nb
-                break
+    return futures
+
+def load_deferred() -> None:
+    if os.path.exists(DEFERRED_PATH):
+        try:
+            with open(DEFERRED_PATH, 'r') as fs:
+                for feature_id, data, filters in json.load(fs):
+                    SCHEDULER.defer((feature_id, data, filters))
+                    # The rest of the feature was extracted by a previous run, the retries can't complete it
+                    DEFERRED_FEATURES.extracted(feature_id, filters["datemut[lt]"], 1, True, None, 0)
+            os.remove(DEFERRED_PATH)
+        except Exception as error:
+            logger.error(f"Failed to load the deferred requests from {DEFERRED_PATH} : {error}")
+
+def save_deferred(items: list) -> None:
+    try:
+        with open(DEFERRED_PATH, 'w') as fs:
+            json.dump(items, fs)
+        logger.error(f"{len(items)} requests are still failing, saved them in {DEFERRED_PATH}")
+    except Exception as error:
+        logger.error(f"Failed to save the deferred requests : {error}\n{items}")
+
+def wait_features(futures: list[Future]) -> None:
+    for future in futures:
+        match future.result():
+            case Ok((nb, _)):
+                logger.info(f"Extracted {nb} mutations")
             case Err(message):
                 logger.error(message)
 
-    return Ok(idg)
+def retry_feature(
+    feature_id: str,
+    data: dict,
+    pipeline: Pipeline,
+    writer: DepartmentWriter,
+    filters: dict
+) -> Result[tuple[int, Optional[str]], str]:
+    # The feature is recorded in the manifest with the retry of its last deferred request
+    raised = True
+    try:
+        result = process_feature(feature_id, data, pipeline, writer, filters)
+        raised = False
+        return result
+    finally:
+        finish_feature(pipeline, writer, DEFERRED_FEATURES.retried(feature_id, failed=raised))
+
+def retry_deferred(pipeline: Pipeline, feature_pool: Executor) -> None:
+    for round in range(RETRY_ROUNDS):
+        deferred = SCHEDULER.drain()
+        if len(deferred) == 0:
+            return
+        logger.info(f"Retry round {round} : {len(deferred)} deferred requests, rate {SCHEDULER.rate:.2f} req/s")
+        writer = DepartmentWriter(TARGET_FOLDER, f"retry{round}_{RUN_ID}", len(deferred))
+        futures = [
+            feature_pool.submit(retry_feature, feature_id, data, pipeline, writer, filters)
+            for feature_id, data, filters in deferred
+        ]
+        wait_features(futures)
+
+    deferred = SCHEDULER.drain()
+    if len(deferred) > 0:
+        save_deferred(deferred)
 
 def set_up(folder_path: str) -> Result[Any, str]:
     if os.path.exists(TARGET_FOLDER) == False:
@@ -164,36 +441,53 @@ def set_up(folder_path: str) -> Result[Any, str]:
             os.makedirs(TARGET_FOLDER, exist_ok=True)
         except Exception as error:
             return Err(f"{error}")
+
+    if not INCREMENTAL:
+        # A full run overwrites the files of the departments, the retry files of the previous runs would be loaded again
+        for entry in os.scandir(TARGET_FOLDER):
+            if entry.name.startswith(("mutations_retry", "classes_retry")):
+                os.remove(entry.path)
     
-    entries = os.scandir(folder_path)
+    # Sorted so the department numbers, and so the feature ids of the manifest, are stable between runs
+    entries = sorted(os.scandir(folder_path), key=lambda entry: entry.name)
     return Ok(entries)
 
-def main(folder_path: str) -> Result[str, str]:
+def main(
+    folder_path: str,
+    on_commit: Optional[Callable[[str, str], None]] = None,
+    on_batch: Optional[Callable[[pa.RecordBatch, pa.RecordBatch], None]] = None
+) -> Result[str, str]:
+    if not RAW_PARQUET and on_batch is None:
+        logger.error("RAW_PARQUET_DVFPLUS=0 needs the in-process load, the extracted rows would be lost")
+        return Err("Nothing would keep the extracted rows")
+
     match set_up(folder_path):
         case Ok(entries):
             dpt = 1
-            idg = 0
-
-            for entry in entries:
-                if entry.is_file():
-                    match get_department(entry.path):
-                        case Ok(map):
-                            features = map['features']
-                            result = process_features(features, idg, dpt)
-                            
-                            match result:
-                                case Ok(nb):
-                                    idg = nb
-                                    break
+            futures: list[Future] = []
+            load_deferred()
+
+            try:
+                with Pipeline(fetch_workers=MAX_IN_FLIGHT, on_commit=on_commit, on_batch=on_batch) as pipeline, \
+                     ThreadPoolExecutor(max_workers=MAX_FEATURES) as feature_pool:
+                    for entry in entries:
+                        if entry.is_file():
+                            match get_department(entry.path):
+                                case Ok(map):
+                                    features = map['features']
+                                    futures.extend(process_features(features, dpt, pipeline, feature_pool))
+                                    dpt += 1
                                 case Err(message):
-                                    logger.error(f"Failed to process the features of the departement {dpt}")
-                            dpt+=1
-                            break
-                        case Err(message):
-                            logger.error(message)
-                            break
-                        case default:
-                            break
+                                    logger.error(message)
+
+                    wait_features(futures)
+                    retry_deferred(pipeline, feature_pool)
+            finally:
+                # The tilings of the run are written once, even when it fails
+                TILING_CACHE.save()
+
+            logger.info(f"Final request rate {SCHEDULER.rate:.2f} req/s, {SCHEDULER.queue_depth} requests deferred")
+
             return Ok("Successfully extract the data !")
         case Err(message):
             logger.error(message)
@@ -201,4 +495,3 @@ def main(folder_path: str) -> Result[str, str]:
         case default:
             logger.error("Impossible")
             return Err("...")
-    
\ No newline at end of file
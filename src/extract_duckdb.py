@@ -1,12 +1,37 @@
 from utils import *
 import duckdb
+import numpy as np
+import pyarrow as pa
+import json
 import os
+import queue
+import shutil
+import threading
+import time
 from pathlib import Path
-from typing import Optional, Callable
-from transform_duckdb import remove_duplicates_mutations
+from typing import Any, Optional, Callable
+from tables import MUTATIONS_LAYOUT, CLASSES_LAYOUT, ParquetLayout
+from metrics import METRICS
 
 INIT_SCRIPT_PATH = "databases/init.sql"
+RESET_SCRIPT_PATH = "databases/reset.sql"
 FILE_PATTERN = "mutations"
+EXPORT_LAYOUTS = {"mutations": MUTATIONS_LAYOUT, "classes": CLASSES_LAYOUT}
+
+# 'single' writes one file per table, 'partitioned' writes the tables partitioned by annee and departement
+EXPORT_MODE = os.environ.get("EXPORT_MODE_DVFPLUS", "single")
+# Target size of the files of a partition
+EXPORT_FILE_SIZE = os.environ.get("EXPORT_FILE_SIZE_DVFPLUS", "128MB")
+EXPORT_ROW_GROUP_SIZE = int(os.environ.get("EXPORT_ROW_GROUP_SIZE_DVFPLUS", "122880"))
+# Only rewrites the partitions of the files extracted since the previous partitioned export
+EXPORT_CHANGED_ONLY = os.environ.get("EXPORT_CHANGED_ONLY_DVFPLUS", "0") == "1"
+# Appends the Arrow batches of the transform to DuckDB in process, the extracted files are then only an archive
+ARROW_INGEST = os.environ.get("ARROW_INGEST_DVFPLUS", "0") == "1"
+# Batches and files waiting for the ingest thread, the writer threads block beyond it
+INGEST_QUEUE = int(os.environ.get("INGEST_QUEUE_DVFPLUS", "64"))
+# Keeps the database between the runs and merges the extracted rows into it instead of rebuilding it
+WAREHOUSE = os.environ.get("WAREHOUSE_DVFPLUS", "0") == "1"
+WAREHOUSE_PATH = os.environ.get("WAREHOUSE_PATH_DVFPLUS", "data/DVF/warehouse.duckdb")
 
 def new_connection(db_path: Optional[str] = None) -> duckdb.DuckDBPyConnection:
     if db_path and os.path.exists(db_path):
@@ -16,46 +41,536 @@ def new_connection(db_path: Optional[str] = None) -> duckdb.DuckDBPyConnection:
     else:
         return duckdb.connect()
 
-def insert_values(conn: duckdb.DuckDBPyConnection, path: str, table_name: str) -> None:
-    conn.execute(f"INSERT INTO {table_name} SELECT * FROM read_parquet('{path}')")
+def open_database(db_path: Optional[str] = None) -> duckdb.DuckDBPyConnection:
+    # The warehouse is kept between the runs, the other databases are rebuilt
+    if WAREHOUSE:
+        Path(WAREHOUSE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        return duckdb.connect(WAREHOUSE_PATH)
+    return new_connection(db_path)
 
-def from_folder(
+def timed_execute(conn: duckdb.DuckDBPyConnection, name: str, query: str, parameters: Optional[dict] = None) -> duckdb.DuckDBPyConnection:
+    with METRICS.statements.time(statement=name):
+        return conn.execute(query, parameters)
+
+def list_files(folder_path: Path, file_filter: Optional[Callable[[Path], bool]] = None) -> list[tuple[str, str]]:
+    # The (mutations, classes) pairs of the extracted files, file_filter selects the mutations files to load
+    files = []
+    for entry in sorted(folder_path.iterdir()):
+        if not entry.is_file() or not entry.name.startswith(FILE_PATTERN) or entry.suffix != '.parquet':
+            continue
+        if file_filter is not None and not file_filter(entry):
+            continue
+        classes = entry.with_name(entry.name.replace(FILE_PATTERN, "classes", 1))
+        if not classes.exists():
+            logger.warning(f"Skipped {entry}, the file {classes} doesn't exist")
+            continue
+        files.append((str(entry), str(classes)))
+    return files
+
+def bulk_load(conn: duckdb.DuckDBPyConnection, files: list[tuple[str, str]], upsert: bool = WAREHOUSE) -> int:
+    # Loads all the files at once instead of one INSERT per file, returns the number of new mutations, or merged ones with upsert
+    if upsert:
+        files = unapplied_files(conn, files)
+    if len(files) == 0:
+        return 0
+    start = time.perf_counter()
+    if upsert:
+        rows = merge_files(conn, files)
+    else:
+        rows = insert_files(conn, files)
+
+    elapsed = time.perf_counter() - start
+    METRICS.stage_seconds.observe(elapsed, stage="ingest")
+    METRICS.stage_rows.inc(rows, stage="ingest")
+    logger.info(f"Loaded {rows} mutations from {len(files)} files in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+    return rows
+
+def insert_files(conn: duckdb.DuckDBPyConnection, files: list[tuple[str, str]]) -> int:
+    parameters = {
+        "mutations": [mutations for mutations, _ in files],
+        "classes": [classes for _, classes in files]
+    }
+
+    conn.execute("CREATE OR REPLACE TEMPORARY TABLE files (mutations VARCHAR, classes VARCHAR)")
+    conn.executemany("INSERT INTO files VALUES (?, ?)", files)
+    # The same idg can come from several files, the first one gives its mutation and its classes
+    # The mutations files are read twice, this first scan only reads their idg, keeping whole rows costs more
+    timed_execute(conn, "first_files", """
+        CREATE OR REPLACE TEMPORARY TABLE first_files AS
+        SELECT idg, min(filename) AS filename, count(*) AS copies
+        FROM read_parquet($mutations, filename = true, union_by_name = true)
+        GROUP BY idg
+    """, {"mutations": parameters["mutations"]})
+    scanned = drop_loaded(conn, "first_files")
+    timed_execute(conn, "insert_mutations", """
+        INSERT OR IGNORE INTO mutations BY NAME
+        SELECT m.* EXCLUDE (filename)
+        FROM read_parquet($mutations, filename = true, union_by_name = true) m
+        JOIN first_files f ON m.idg = f.idg AND m.filename = f.filename
+    """, {"mutations": parameters["mutations"]})
+    timed_execute(conn, "insert_classes", """
+        INSERT INTO classes BY NAME
+        SELECT c.* EXCLUDE (filename)
+        FROM read_parquet($classes, filename = true, union_by_name = true) c
+        JOIN files ON c.filename = files.classes
+        JOIN first_files f ON c.idg = f.idg AND files.mutations = f.filename
+    """, {"classes": parameters["classes"]})
+
+    row = conn.execute("SELECT count(*) FROM first_files").fetchone()
+    rows = row[0] if row else 0
+    conn.execute("DROP TABLE first_files")
+    conn.execute("DROP TABLE files")
+
+    count_duplicates(scanned, rows)
+    return rows
+
+def drop_loaded(conn: duckdb.DuckDBPyConnection, first: str) -> int:
+    # Removes the idg already loaded from the first rows of the idg, returns the number of rows scanned
+    row = conn.execute(f"SELECT sum(copies) FROM {first}").fetchone()
+    conn.execute(f"DELETE FROM {first} WHERE idg IN (SELECT idg FROM mutations)")
+    return int(row[0]) if row and row[0] is not None else 0
+
+def count_duplicates(scanned: int, rows: int) -> None:
+    # The rows not inserted are the copies of an idg of another file or batch, or of a previous load
+    METRICS.duplicates.inc(scanned - rows)
+    if scanned > rows:
+        logger.debug(f"Dropped {scanned - rows} duplicated mutations")
+
+def unapplied_files(conn: duckdb.DuckDBPyConnection, files: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    applied = dict(conn.execute("SELECT filename, modified FROM LoadedFiles").fetchall())
+    return [(mutations, classes) for mutations, classes in files if applied.get(mutations) != os.path.getmtime(mutations)]
+
+def merge_files(conn: duckdb.DuckDBPyConnection, files: list[tuple[str, str]]) -> int:
+    conn.execute("CREATE OR REPLACE TEMPORARY TABLE files (mutations VARCHAR, classes VARCHAR)")
+    conn.executemany("INSERT INTO files VALUES (?, ?)", files)
+    stage(
+        conn,
+        "SELECT * EXCLUDE (filename), filename AS source FROM read_parquet($mutations, filename = true, union_by_name = true)",
+        """
+            SELECT c.* EXCLUDE (filename), files.mutations AS source
+            FROM read_parquet($classes, filename = true, union_by_name = true) c
+            JOIN files ON c.filename = files.classes
+        """,
+        {"mutations": [mutations for mutations, _ in files]},
+        {"classes": [classes for _, classes in files]}
+    )
+    conn.execute("DROP TABLE files")
+    rows = merge_staged(conn)
+    # A file merged twice changes nothing, recording it after the merge is enough
+    record_files(conn, files)
+    return rows
+
+def record_files(conn: duckdb.DuckDBPyConnection, files: list[tuple[str, str]]) -> None:
+    conn.executemany(
+        "INSERT OR REPLACE INTO LoadedFiles VALUES (?, ?, now())",
+        [(mutations, os.path.getmtime(mutations)) for mutations, _ in files]
+    )
+
+def stage(
     conn: duckdb.DuckDBPyConnection,
-    folder_path: Path,
-    transform_function: Callable[[duckdb.DuckDBPyConnection], None]
+    mutations: str,
+    classes: str,
+    mutations_parameters: Optional[dict] = None,
+    classes_parameters: Optional[dict] = None
 ) -> None:
+    # The queries have a source column, the rows of an idg are the ones of its first source
+    timed_execute(conn, "first_sources", f"""
+        CREATE OR REPLACE TEMPORARY TABLE first_sources AS
+        SELECT idg, min(source) AS source, count(*) AS copies FROM ({mutations}) GROUP BY idg
+    """, mutations_parameters)
+    conn.execute("CREATE OR REPLACE TEMPORARY TABLE staged_mutations AS FROM mutations LIMIT 0")
+    conn.execute("CREATE OR REPLACE TEMPORARY TABLE staged_classes AS FROM classes LIMIT 0")
+    timed_execute(conn, "stage_mutations", f"""
+        INSERT INTO staged_mutations BY NAME
+        SELECT m.* EXCLUDE (source) FROM ({mutations}) m
+        JOIN first_sources f ON m.idg = f.idg AND m.source = f.source
+    """, mutations_parameters)
+    timed_execute(conn, "stage_classes", f"""
+        INSERT INTO staged_classes BY NAME
+        SELECT c.* EXCLUDE (source) FROM ({classes}) c
+        JOIN first_sources f ON c.idg = f.idg AND c.source = f.source
+    """, classes_parameters)
+    # The idg already in the warehouse are merged, only the copies of the other sources are duplicates
+    row = conn.execute("SELECT sum(copies), count(*) FROM first_sources").fetchone()
+    if row and row[0] is not None:
+        count_duplicates(int(row[0]), row[1])
+    conn.execute("DROP TABLE first_sources")
+
+def merge_staged(conn: duckdb.DuckDBPyConnection) -> int:
+    # Upsert on idg of the staged rows that differ from the warehouse ones, returns the number of mutations merged
+    # Only the staged idg already in the warehouse are compared, the others are new
+    timed_execute(conn, "existing_idg", """
+        CREATE OR REPLACE TEMPORARY TABLE existing_idg AS
+        SELECT idg FROM staged_mutations SEMI JOIN mutations USING (idg)
+    """)
+    timed_execute(conn, "changed_idg", """
+        CREATE OR REPLACE TEMPORARY TABLE changed_idg AS
+        SELECT idg FROM staged_mutations ANTI JOIN existing_idg USING (idg)
+        UNION ALL
+        (
+            SELECT idg FROM (
+                SELECT * FROM staged_mutations SEMI JOIN existing_idg USING (idg)
+                EXCEPT
+                SELECT * FROM mutations SEMI JOIN existing_idg USING (idg)
+            )
+            UNION
+            SELECT idg FROM (
+                SELECT * FROM staged_classes SEMI JOIN existing_idg USING (idg)
+                EXCEPT ALL
+                SELECT * FROM classes SEMI JOIN existing_idg USING (idg)
+            )
+            UNION
+            SELECT idg FROM (
+                SELECT * FROM classes SEMI JOIN existing_idg USING (idg)
+                EXCEPT ALL
+                SELECT * FROM staged_classes SEMI JOIN existing_idg USING (idg)
+            )
+        )
+    """)
+    # The partitions of the replaced rows and of the new ones
+    timed_execute(conn, "affected_partitions", """
+        INSERT INTO AffectedPartitions
+        SELECT year(datemut), departement(idpar) FROM mutations WHERE idg IN (SELECT idg FROM changed_idg)
+        UNION
+        SELECT year(datemut), departement(idpar) FROM staged_mutations WHERE idg IN (SELECT idg FROM changed_idg)
+    """)
+    timed_execute(conn, "merge_classes_delete", "DELETE FROM classes WHERE idg IN (SELECT idg FROM changed_idg)")
+    timed_execute(conn, "merge_mutations", """
+        INSERT OR REPLACE INTO mutations BY NAME
+        SELECT * FROM staged_mutations WHERE idg IN (SELECT idg FROM changed_idg)
+    """)
+    timed_execute(conn, "merge_classes", """
+        INSERT INTO classes BY NAME
+        SELECT * FROM staged_classes WHERE idg IN (SELECT idg FROM changed_idg)
+    """)
+
+    row = conn.execute("SELECT count(*) FROM changed_idg").fetchone()
+    conn.execute("DROP TABLE changed_idg")
+    conn.execute("DROP TABLE existing_idg")
+    conn.execute("DROP TABLE staged_classes")
+    conn.execute("DROP TABLE staged_mutations")
+    return row[0] if row else 0
+
+def affected_partitions(conn: duckdb.DuckDBPyConnection) -> set[tuple[int, str]]:
+    rows = conn.execute("SELECT DISTINCT annee, departement FROM AffectedPartitions").fetchall()
+    return {(annee, departement) for annee, departement in rows}
+
+def init_database(conn: duckdb.DuckDBPyConnection, reset: bool = not WAREHOUSE) -> None:
+    if reset:
+        with open(RESET_SCRIPT_PATH, 'r') as f:
+            conn.execute(f.read())
     with open(INIT_SCRIPT_PATH, 'r') as f:
         init_script = f.read()
     conn.execute(init_script)
+
+def from_folder(
+    conn: duckdb.DuckDBPyConnection,
+    folder_path: Path,
+    transform_function: Optional[Callable[[duckdb.DuckDBPyConnection], Any]] = None,
+    file_filter: Optional[Callable[[Path], bool]] = None
+) -> None:
+    init_database(conn)
     
-    entries = [entry for entry in folder_path.iterdir() if entry.is_file()]
-    target_folder = folder_path.parent
-    target_folder.mkdir(exist_ok=True)
-    
-    for entry in entries:
-        if entry.name.startswith(FILE_PATTERN) and entry.suffix == '.parquet':
-            mutations_src = str(entry)
-            classes_src = mutations_src.replace("mutations", "classes")
-            
-            insert_values(conn, mutations_src, "mutations")
-            insert_values(conn, classes_src, "classes")
-    
-    transform_function(conn)
+    started_at = time.time()
+    files = list_files(folder_path, file_filter)
+    bulk_load(conn, files)
     
-    mutations_dest = str(target_folder / "mutations.parquet")
-    classes_dest = mutations_dest.replace("mutations", "classes")
+    if transform_function is not None:
+        transform_function(conn)
     
-    export_to_parquet(conn, mutations_dest, "mutations")
-    export_to_parquet(conn, classes_dest, "classes")
+    export(conn, folder_path.parent, files, started_at)
+
+def append_batches(
+    conn: duckdb.DuckDBPyConnection,
+    batches: list[tuple[pa.RecordBatch, pa.RecordBatch]],
+    upsert: bool = WAREHOUSE
+) -> set[tuple[int, str]]:
+    # Inserts the Arrow batches of the transform without going through files, returns their partitions
+    start = time.perf_counter()
+    # The batch number picks the rows of one batch when an idg is in several, like the first file of bulk_load
+    conn.register("arrow_mutations", pa.concat_tables([
+        pa.Table.from_batches([mutations]).append_column("batch", pa.array(np.full(mutations.num_rows, index, dtype=np.int32)))
+        for index, (mutations, _) in enumerate(batches)
+    ]))
+    conn.register("arrow_classes", pa.concat_tables([
+        pa.Table.from_batches([classes]).append_column("batch", pa.array(np.full(classes.num_rows, index, dtype=np.int32)))
+        for index, (_, classes) in enumerate(batches)
+    ]))
+    try:
+        partitions = conn.execute("""
+            SELECT DISTINCT year(datemut) AS annee, departement(idpar) AS departement
+            FROM arrow_mutations
+        """).fetchall()
+        if upsert:
+            stage(
+                conn,
+                "SELECT * EXCLUDE (batch), batch AS source FROM arrow_mutations",
+                "SELECT * EXCLUDE (batch), batch AS source FROM arrow_classes"
+            )
+            rows = merge_staged(conn)
+        else:
+            rows = insert_batches(conn)
+    finally:
+        conn.unregister("arrow_mutations")
+        conn.unregister("arrow_classes")
+
+    elapsed = time.perf_counter() - start
+    METRICS.stage_seconds.observe(elapsed, stage="ingest")
+    METRICS.stage_rows.inc(rows, stage="ingest")
+    logger.debug(f"Appended {rows} mutations from {len(batches)} batches in {elapsed:.2f}s")
+    return {(annee, departement) for annee, departement in partitions}
+
+def insert_batches(conn: duckdb.DuckDBPyConnection) -> int:
+    timed_execute(conn, "first_batches", """
+        CREATE OR REPLACE TEMPORARY TABLE first_batches AS
+        SELECT idg, min(batch) AS batch, count(*) AS copies
+        FROM arrow_mutations
+        GROUP BY idg
+    """)
+    scanned = drop_loaded(conn, "first_batches")
+    timed_execute(conn, "append_mutations", """
+        INSERT OR IGNORE INTO mutations BY NAME
+        SELECT m.* EXCLUDE (batch)
+        FROM arrow_mutations m
+        JOIN first_batches f ON m.idg = f.idg AND m.batch = f.batch
+    """)
+    timed_execute(conn, "append_classes", """
+        INSERT INTO classes BY NAME
+        SELECT c.* EXCLUDE (batch)
+        FROM arrow_classes c
+        JOIN first_batches f ON c.idg = f.idg AND c.batch = f.batch
+    """)
+    row = conn.execute("SELECT count(*) FROM first_batches").fetchone()
+    rows = row[0] if row else 0
+    conn.execute("DROP TABLE first_batches")
+    count_duplicates(scanned, rows)
+    return rows
+
+def export(
+    conn: duckdb.DuckDBPyConnection,
+    target_folder: Path,
+    files: list[tuple[str, str]],
+    started_at: float,
+    appended: Optional[set[tuple[int, str]]] = None,
+    upsert: bool = WAREHOUSE
+) -> None:
+    # appended are the partitions of the rows loaded from Arrow batches, they have no file
+    target_folder.mkdir(exist_ok=True)
+    if EXPORT_MODE == "partitioned":
+        changed = None
+        exported_at = load_export_state(target_folder) if upsert or EXPORT_CHANGED_ONLY else None
+        if exported_at is not None and upsert:
+            # The warehouse knows the partitions changed by its merges
+            changed = affected_partitions(conn)
+        elif exported_at is not None:
+            changed = changed_partitions(conn, [mutations for mutations, _ in files if os.path.getmtime(mutations) > exported_at])
+            changed |= appended or set()
+        export_partitioned(conn, target_folder, changed)
+        save_export_state(target_folder, started_at, changed)
+    else:
+        mutations_dest = str(target_folder / "mutations.parquet")
+        classes_dest = mutations_dest.replace("mutations", "classes")
+        
+        export_to_parquet(conn, mutations_dest, "mutations")
+        export_to_parquet(conn, classes_dest, "classes")
+    if upsert:
+        # The merged files are recorded by the merges, the partitions they changed are only forgotten once exported
+        conn.execute("DELETE FROM AffectedPartitions")
+
+class Ingester:
+    # Loads the extracted rows while the extraction is still running, the connection is only used by its thread
+    def __init__(self, conn: duckdb.DuckDBPyConnection, folder_path: Path, preload: bool = False, arrow: bool = ARROW_INGEST):
+        self.conn = conn
+        self.folder_path = folder_path
+        # The rows come from append, the committed files are then already loaded
+        self.arrow = arrow
+        self.started_at = time.time()
+        self.queue: queue.Queue = queue.Queue(maxsize=INGEST_QUEUE)
+        self.loaded: list[tuple[str, str]] = []
+        self.appended: set[tuple[int, str]] = set()
+        self.error: Optional[str] = None
+        # The files of the previous runs, only safe to load first when the run doesn't overwrite them
+        self.preloaded = list_files(folder_path) if preload and folder_path.is_dir() else []
+        init_database(conn)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, mutations: str, classes: str) -> None:
+        self.queue.put((mutations, classes))
+
+    def append(self, mutations: pa.RecordBatch, classes: pa.RecordBatch) -> None:
+        self.queue.put((mutations, classes))
+
+    def run(self) -> None:
+        try:
+            bulk_load(self.conn, self.preloaded)
+            self.loaded.extend(self.preloaded)
+        except Exception as error:
+            logger.error(f"Failed to load the files of the previous runs : {error}")
+            self.error = f"{error}"
+        stopped = False
+        while not stopped:
+            items = [self.queue.get()]
+            # Everything queued during the previous load is loaded at once
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopped = None in items
+            if self.error is not None:
+                continue
+            batches = [item for item in items if item is not None and isinstance(item[0], pa.RecordBatch)]
+            files = [item for item in items if item is not None and isinstance(item[0], str)]
+            try:
+                # The batches of a department are queued before its files
+                if len(batches) > 0:
+                    self.appended |= append_batches(self.conn, batches)
+                if len(files) > 0 and not self.arrow:
+                    bulk_load(self.conn, files)
+                elif len(files) > 0 and WAREHOUSE:
+                    # The archived files of the batches already merged
+                    record_files(self.conn, files)
+                self.loaded.extend(files)
+            except Exception as error:
+                logger.error(f"Failed to load the extracted rows : {error}")
+                self.error = f"{error}"
+
+    def stop(self) -> None:
+        # Waits for the rows already queued
+        self.queue.put(None)
+        self.thread.join()
+
+    def finish(self, transform_function: Optional[Callable[[duckdb.DuckDBPyConnection], Any]] = None) -> Result[int, str]:
+        # Called once the extraction is done, returns the number of files loaded
+        self.stop()
+        if self.error is not None:
+            return Err(f"Failed to load the extracted rows : {self.error}")
+        try:
+            # The files not committed by the run, kept from the previous runs
+            loaded = set(self.loaded)
+            remaining = [files for files in list_files(self.folder_path) if files not in loaded] if self.folder_path.is_dir() else []
+            bulk_load(self.conn, remaining)
+            if transform_function is not None:
+                transform_function(self.conn)
+            export(self.conn, self.folder_path.parent, self.loaded + remaining, self.started_at, self.appended)
+            return Ok(len(self.loaded) + len(remaining))
+        except Exception as error:
+            return Err(f"{error}")
+
+def copy_options(layout: ParquetLayout) -> str:
+    options = f"FORMAT PARQUET, COMPRESSION {layout.compression}"
+    if layout.compression.upper() == 'ZSTD' and layout.compression_level is not None:
+        options += f", COMPRESSION_LEVEL {layout.compression_level}"
+    return options
 
 def export_to_parquet(conn: duckdb.DuckDBPyConnection, file_path: str, table_name: str) -> None:
-    conn.execute(f"COPY {table_name} TO '{file_path}' (FORMAT PARQUET)")
+    # DuckDB picks the dictionary encodings and writes the bloom filters of the dictionary encoded columns by itself
+    layout = EXPORT_LAYOUTS[table_name]
+    order = f" ORDER BY {', '.join(layout.sort_by)}" if layout.sort_by else ""
+    with METRICS.stage_seconds.time(stage="export"):
+        timed_execute(conn, f"export_{table_name}", f"COPY (SELECT * FROM {table_name}{order}) TO '{file_path}' ({copy_options(layout)})")
+    METRICS.file_bytes.observe(os.path.getsize(file_path), table=table_name)
+
+def load_export_state(folder: Path) -> Optional[float]:
+    path = folder / EXPORT_STATE_FILE
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r') as fs:
+            return json.load(fs)["exported_at"]
+    except Exception as error:
+        logger.error(f"Failed to read {path}, all the partitions are exported : {error}")
+        return None
+
+def save_export_state(folder: Path, exported_at: float, partitions: Optional[set[tuple[int, str]]] = None) -> None:
+    # partitions are the ones rewritten by the export, None when it rewrote all of them
+    with open(folder / EXPORT_STATE_FILE, 'w') as fs:
+        json.dump({
+            "exported_at": exported_at,
+            "partitions": None if partitions is None else [list(partition) for partition in sorted(partitions)]
+        }, fs)
+
+def changed_partitions(conn: duckdb.DuckDBPyConnection, files: list[str]) -> set[tuple[int, str]]:
+    if len(files) == 0:
+        return set()
+    rows = conn.execute("""
+        SELECT DISTINCT year(datemut) AS annee, departement(idpar) AS departement
+        FROM read_parquet($files, union_by_name = true)
+    """, {"files": files}).fetchall()
+    return {(annee, departement) for annee, departement in rows}
+
+def partition_path(folder: Path, table_name: str, annee: int, departement: str) -> Path:
+    return folder / table_name / f"annee={annee}" / f"departement={departement}"
+
+def export_partitioned(
+    conn: duckdb.DuckDBPyConnection,
+    folder: Path,
+    changed: Optional[set[tuple[int, str]]] = None
+) -> None:
+    # Hive partitions annee=/departement=, DuckDB can't rotate the files of a PARTITION_BY so each partition is a COPY
+    start = time.perf_counter()
+    # Only the rows of the changed partitions are read and sorted
+    scope = ""
+    if changed is not None:
+        conn.execute("CREATE OR REPLACE TEMPORARY TABLE export_partitions (annee BIGINT, departement VARCHAR)")
+        if len(changed) > 0:
+            conn.executemany("INSERT INTO export_partitions VALUES (?, ?)", sorted(changed))
+        scope = " SEMI JOIN export_partitions USING (annee, departement)"
+    timed_execute(conn, "export_mutations", f"""
+        CREATE OR REPLACE TEMPORARY TABLE export_mutations AS
+        SELECT *
+        FROM (SELECT *, year(datemut) AS annee, departement(idpar) AS departement FROM mutations){scope}
+        ORDER BY annee, departement, codepostal, datemut
+    """)
+    timed_execute(conn, "export_classes", """
+        CREATE OR REPLACE TEMPORARY TABLE export_classes AS
+        SELECT c.*, m.annee, m.departement
+        FROM classes c JOIN export_mutations m USING (idg)
+        ORDER BY annee, departement, idg
+    """)
+    partitions = {
+        (annee, departement)
+        for annee, departement in conn.execute("SELECT DISTINCT annee, departement FROM export_mutations").fetchall()
+    }
+
+    if changed is None:
+        for table_name in EXPORT_LAYOUTS:
+            shutil.rmtree(folder / table_name, ignore_errors=True)
+    else:
+        # The changed partitions without rows anymore are only removed
+        for annee, departement in changed - partitions:
+            for table_name in EXPORT_LAYOUTS:
+                shutil.rmtree(partition_path(folder, table_name, annee, departement), ignore_errors=True)
+        partitions &= changed
+
+    for table_name, layout in EXPORT_LAYOUTS.items():
+        options = f"{copy_options(layout)}, FILE_SIZE_BYTES '{EXPORT_FILE_SIZE}', ROW_GROUP_SIZE {EXPORT_ROW_GROUP_SIZE}"
+        order = f" ORDER BY {', '.join(layout.sort_by)}" if layout.sort_by else ""
+        for annee, departement in sorted(partitions):
+            path = partition_path(folder, table_name, annee, departement)
+            shutil.rmtree(path, ignore_errors=True)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            timed_execute(conn, f"copy_{table_name}_partition", f"""
+                COPY (
+                    SELECT * EXCLUDE (annee, departement)
+                    FROM export_{table_name}
+                    WHERE annee = $annee AND departement = $departement{order}
+                ) TO '{path}' ({options})
+            """, {"annee": annee, "departement": departement})
+
+    conn.execute("DROP TABLE export_classes")
+    conn.execute("DROP TABLE export_mutations")
+    conn.execute("DROP TABLE IF EXISTS export_partitions")
+    elapsed = time.perf_counter() - start
+    METRICS.stage_seconds.observe(elapsed, stage="export")
+    logger.info(f"Exported {len(partitions)} partitions in {elapsed:.2f}s")
 
-def main(folder_path: str, db_path: Optional[str] = None) -> str:
+def main(folder_path: str, db_path: Optional[str] = None, file_filter: Optional[Callable[[Path], bool]] = None) -> str:
     try:
-        conn = new_connection(db_path)
+        conn = open_database(db_path)
         path = Path(folder_path)
-        from_folder(conn, path, remove_duplicates_mutations)
+        from_folder(conn, path, file_filter=file_filter)
         return "Successfully transformed the data with DuckDB!"
     except Exception as e:
         return f"Error: {str(e)}"
\ No newline at end of file
@@ -1,115 +1,336 @@
 import math
+import numpy as np
 from utils import *
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
-def inside(point: List[float], split_value: float, axis: str, side: str) -> bool:
-    value = point[0] if axis == 'x' else point[1]
+AXIS = {'x': 0, 'y': 1}
+EARTH_RADIUS = 6371008.8
+
+def inside(points: np.ndarray, split_value: float, axis: str, side: str) -> np.ndarray:
+    values = points[..., AXIS[axis]]
     if side in ['left', 'bottom']:
-        return value <= split_value
+        return values <= split_value
     else:
-        return value >= split_value
+        return values >= split_value
 
-def compute_intersection(s: List[float], p: List[float], split_value: float, axis: str) -> List[float]:
-    if axis == 'x':
-        t = (split_value - s[0]) / (p[0] - s[0])
-        y = s[1] + t * (p[1] - s[1])
-        return [split_value, y]
-    else:
-        t = (split_value - s[1]) / (p[1] - s[1])
-        x = s[0] + t * (p[0] - s[0])
-        return [x, split_value]
+def compute_intersection(s: np.ndarray, p: np.ndarray, split_value: float, axis: str) -> np.ndarray:
+    index = AXIS[axis]
+    t = (split_value - s[..., index]) / (p[..., index] - s[..., index])
+    intersection = s + t[..., np.newaxis] * (p - s)
+    intersection[..., index] = split_value
+    return intersection
+
+def clip_ring(ring: np.ndarray, split_value: float, axis: str, side: str) -> np.ndarray:
+    # Sutherland-Hodgman against one axis-aligned line, each edge (previous, current)
+    # emits its intersection with the line when it crosses it, then its end point when inside
+    previous = np.roll(ring, 1, axis=0)
+    current_inside = inside(ring, split_value, axis, side)
+    crossing = current_inside != inside(previous, split_value, axis, side)
+
+    points = np.empty((len(ring), 2, 2))
+    points[:, 1] = ring
+    points[crossing, 0] = compute_intersection(previous[crossing], ring[crossing], split_value, axis)
+    result = points[np.stack([crossing, current_inside], axis=1)]
+
+    if len(result) > 0 and not np.array_equal(result[0], result[-1]):
+        result = np.vstack([result, result[:1]])
+    return result
 
 def clip_polygon(polygon: List[List[float]], split_value: float, axis: str, side: str) -> List[List[List[float]]]:
-    result = []
-    s = polygon[-1]
-    point_s = s
-    
-    for point in polygon:
-        if inside(point, split_value, axis, side):
-            if not inside(point_s, split_value, axis, side):
-                intersection = compute_intersection(point_s, point, split_value, axis)
-                result.append(intersection)
-            result.append(point)
-        elif inside(point_s, split_value, axis, side):
-            intersection = compute_intersection(point_s, point, split_value, axis)
-            result.append(intersection)
-        point_s = point
-    
-    if result and result[0] != result[-1]:
-        result.append(result[0])
-    
+    result = clip_ring(np.asarray(polygon, dtype=float), split_value, axis, side)
+
     if len(result) < 4:
         raise ValueError("Inconsistent size: The polygon needs to have 4 points or more.")
-    
-    return [result]
 
-def unwrap_coordinates(value: list) -> List[List[List[float]]]:
+    return [result.tolist()]
+
+def crosses(ring: np.ndarray, split_value: float, axis: str, side: str) -> bool:
+    is_inside = inside(ring, split_value, axis, side)
+    return bool(is_inside.any() and not is_inside.all())
+
+def open_ring(ring: np.ndarray, counter_clockwise: bool) -> np.ndarray:
+    # The ring without its closing point, turning so that the polygon is on the left of its edges
+    points = ring[:-1] if len(ring) > 1 and np.array_equal(ring[0], ring[-1]) else ring
+    return points if (signed_area(points) > 0) == counter_clockwise else points[::-1]
+
+def cut_direction(side: str) -> float:
+    # The direction along the line that keeps the half-plane on the left, the way the clipped rings follow the cut
+    return 1.0 if side in ['left', 'top'] else -1.0
+
+def ring_arcs(ring: np.ndarray, split_value: float, axis: str, side: str) -> List[np.ndarray]:
+    # The runs of points of an open ring strictly inside the half-plane, each between the points where it meets the line.
+    # The edges on the line are left out, the linking follows the line where it bounds the polygon
+    count = len(ring)
+    along = 1 - AXIS[axis]
+    on_line = ring[:, AXIS[axis]] == split_value
+    strictly_inside = inside(ring, split_value, axis, side) & ~on_line
+    previous = np.roll(np.arange(count), 1)
+    following = np.roll(np.arange(count), -1)
+    # A point touching the line from inside only ends the run when the polygon lies on both of its sides along the line,
+    # its outgoing edge then points less along the cut direction than its incoming edge comes from
+    touching = on_line & strictly_inside[previous] & strictly_inside[following]
+    incoming = ring[previous] - ring
+    outgoing = ring[following] - ring
+    with np.errstate(divide='ignore', invalid='ignore'):
+        turn = (outgoing[:, along] / np.hypot(*outgoing.T) - incoming[:, along] / np.hypot(*incoming.T)) * cut_direction(side)
+    kept = strictly_inside | (touching & (turn > 0))
+
+    arcs = []
+    for start in np.flatnonzero(kept & ~kept[previous]):
+        end = start
+        while kept[following[end]]:
+            end = following[end]
+        before = ring[[previous[start]]]
+        after = ring[[following[end]]]
+        run = ring[np.arange(start, start + (end - start) % count + 1) % count]
+        if not on_line[previous[start]]:
+            before = compute_intersection(before, run[:1], split_value, axis)
+        if not on_line[following[end]]:
+            after = compute_intersection(run[-1:], after, split_value, axis)
+        arcs.append(np.vstack([before, run, after]))
+    return arcs
+
+def link_arcs(arcs: List[np.ndarray], axis: str, side: str) -> List[np.ndarray]:
+    # Closes the arcs into rings, the line is followed from where an arc leaves the half-plane to the next arc entering it,
+    # in the direction that keeps the half-plane on the left
+    along = 1 - AXIS[axis]
+    direction = cut_direction(side)
+    entries = [direction * float(arc[0][along]) for arc in arcs]
+    exits = [direction * float(arc[-1][along]) for arc in arcs]
+
+    rings = []
+    remaining = set(range(len(arcs)))
+    while remaining:
+        first = current = min(remaining)
+        remaining.remove(first)
+        parts = [arcs[first]]
+        while True:
+            # A ring touching the line from inside is split where it touches it, the two arcs meeting there don't join again
+            candidates = [index for index in remaining if entries[index] > exits[current]]
+            if entries[first] >= exits[current]:
+                candidates.append(first)
+            if not candidates:
+                break
+            current = min(candidates, key=lambda index: entries[index])
+            if current == first:
+                break
+            remaining.remove(current)
+            parts.append(arcs[current])
+
+        ring = np.concatenate(parts)
+        ring = ring[np.r_[True, np.any(ring[1:] != ring[:-1], axis=1)]]
+        if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+            ring = ring[:-1]
+        if len(ring) >= 3:
+            rings.append(np.vstack([ring, ring[:1]]))
+    return rings
+
+def contains(ring: np.ndarray, point: np.ndarray) -> bool:
+    # Even-odd rule on the ray going right from the point
+    start = ring
+    end = np.roll(ring, -1, axis=0)
+    crossing = (start[:, 1] > point[1]) != (end[:, 1] > point[1])
+    start = start[crossing]
+    end = end[crossing]
+    x = start[:, 0] + (point[1] - start[:, 1]) * (end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1])
+    return bool(np.count_nonzero(point[0] < x) % 2)
+
+def cut_polygon(rings: List[np.ndarray], split_value: float, axis: str, side: str) -> List[List[np.ndarray]]:
+    # Clipped apart, a hole crossed by the line would share its edge on the line with the exterior. The parts of the exterior
+    # and of the holes inside the half-plane are linked along the line into new exteriors instead, the hole opens on the cut
+    arcs = []
+    holes = []
+    for index, ring in enumerate(rings):
+        points = open_ring(ring, counter_clockwise=index == 0)
+        is_inside = inside(points, split_value, axis, side)
+        if is_inside.all():
+            holes.append(points)
+        elif is_inside.any():
+            arcs.extend(ring_arcs(points, split_value, axis, side))
+
+    polygons = [[exterior] for exterior in link_arcs(arcs, axis, side)]
+    for hole in holes:
+        # The points on the line may touch the exterior around the hole
+        off_line = hole[hole[:, AXIS[axis]] != split_value]
+        for polygon in polygons:
+            if len(off_line) > 0 and contains(polygon[0], off_line[0]):
+                polygon.append(np.vstack([hole, hole[:1]]))
+                break
+    return polygons
+
+def clip_polygons(polygons: List[List[np.ndarray]], split_value: float, axis: str, side: str) -> List[List[np.ndarray]]:
+    # The first ring of each polygon is the exterior, the others are holes
+    clipped = []
+    for rings in polygons:
+        if crosses(rings[0], split_value, axis, side) and any(crosses(hole, split_value, axis, side) for hole in rings[1:]):
+            clipped.extend(cut_polygon(rings, split_value, axis, side))
+            continue
+        exterior = clip_ring(rings[0], split_value, axis, side)
+        if len(exterior) < 4:
+            continue
+        holes = [clip_ring(hole, split_value, axis, side) for hole in rings[1:]]
+        clipped.append([exterior] + [hole for hole in holes if len(hole) >= 4])
+    return clipped
+
+def unwrap_ring(ring: list) -> np.ndarray:
+    try:
+        array = np.asarray(ring, dtype=float)
+        if array.ndim == 2 and array.shape[1] >= 2:
+            return array[:, :2]
+    except (TypeError, ValueError):
+        pass
+
+    # Slow path for rings with malformed points
+    points = []
+    for point in ring:
+        if isinstance(point, list) and len(point) >= 2:
+            x = point[0]
+            y = point[1]
+            if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+                points.append([x, y])
+    return np.asarray(points, dtype=float).reshape(-1, 2)
+
+def unwrap_coordinates(value: list) -> List[np.ndarray]:
     coordinates = []
     for ring in value:
         if not isinstance(ring, list):
             continue
-        unwrapped_ring = []
-        for point in ring:
-            if isinstance(point, list) and len(point) >= 2:
-                x = point[0]
-                y = point[1]
-                if isinstance(x, (int, float)) and isinstance(y, (int, float)):
-                    unwrapped_ring.append([x, y])
-        if unwrapped_ring:
+        unwrapped_ring = unwrap_ring(ring)
+        if len(unwrapped_ring) > 0:
             coordinates.append(unwrapped_ring)
     return coordinates
 
-def min_max_coordinate(coordinates: List[List[float]]) -> Tuple[float, float, float, float]:
-    if not coordinates:
-        raise ValueError("Inconsistent coordinates: Empty vector.")
-    
-    min_x = math.inf
-    max_x = -math.inf
-    min_y = math.inf
-    max_y = -math.inf
-    
-    for point in coordinates:
-        x, y = point[0], point[1]
-        min_x = min(min_x, x)
-        max_x = max(max_x, x)
-        min_y = min(min_y, y)
-        max_y = max(max_y, y)
-    
-    return min_x, max_x, min_y, max_y
+def unwrap_polygons(geometry: dict) -> List[List[np.ndarray]]:
+    geometry_type = geometry.get('type')
+    if geometry_type not in ('Polygon', 'MultiPolygon'):
+        raise ValueError("Inconsistent geometry type, this function only supports Polygon and MultiPolygon types.")
 
-def split_geometry(geometry: dict) -> Result[Tuple[dict, dict], str]:
-    if geometry.get('type') != 'Polygon':
-        raise ValueError("Inconsistent geometry type, this function only supports Polygon type.")
-    
     coordinates = geometry.get('coordinates')
     if coordinates is None:
         raise ValueError("Inconsistent geometry: The key 'coordinates' doesn't exist.")
-    
-    unwrapped_coords = unwrap_coordinates(coordinates)
-    if not unwrapped_coords:
+
+    polygons = [coordinates] if geometry_type == 'Polygon' else coordinates
+    unwrapped = []
+    for polygon in polygons:
+        if isinstance(polygon, list):
+            rings = unwrap_coordinates(polygon)
+            if rings:
+                unwrapped.append(rings)
+
+    if not unwrapped:
         raise ValueError("Inconsistent geometry: Empty coordinates.")
-    
-    exterior = unwrapped_coords[0]
-    min_x, max_x, min_y, max_y = min_max_coordinate(exterior)
+    return unwrapped
+
+def min_max_coordinate(coordinates: np.ndarray) -> Tuple[float, float, float, float]:
+    coordinates = np.asarray(coordinates, dtype=float)
+    if coordinates.size == 0:
+        raise ValueError("Inconsistent coordinates: Empty vector.")
+
+    min_x, min_y = coordinates[:, :2].min(axis=0)
+    max_x, max_y = coordinates[:, :2].max(axis=0)
+    return float(min_x), float(max_x), float(min_y), float(max_y)
+
+def to_geometry(polygons: List[List[np.ndarray]]) -> dict:
+    coordinates = [[ring.tolist() for ring in rings] for rings in polygons]
+    if len(coordinates) == 1:
+        return {
+            'type': 'Polygon',
+            'coordinates': coordinates[0]
+        }
+    return {
+        'type': 'MultiPolygon',
+        'coordinates': coordinates
+    }
+
+def clip_geometry(polygons: List[List[np.ndarray]], split_value: float, axis: str, side: str) -> Optional[dict]:
+    clipped = clip_polygons(polygons, split_value, axis, side)
+    return to_geometry(clipped) if clipped else None
+
+def split_geometry(geometry: dict) -> Result[Tuple[dict, dict], str]:
+    try:
+        polygons = unwrap_polygons(geometry)
+    except ValueError as error:
+        return Err(f"{error}")
+
+    exteriors = np.concatenate([rings[0] for rings in polygons])
+    min_x, max_x, min_y, max_y = min_max_coordinate(exteriors)
     width = max_x - min_x
     height = max_y - min_y
-    
+
     if width > height:
         split_value = (min_x + max_x) / 2
-        poly1 = clip_polygon(exterior, split_value, 'x', 'left')
-        poly2 = clip_polygon(exterior, split_value, 'x', 'right')
+        geometry1 = clip_geometry(polygons, split_value, 'x', 'left')
+        geometry2 = clip_geometry(polygons, split_value, 'x', 'right')
     else:
         split_value = (min_y + max_y) / 2
-        poly1 = clip_polygon(exterior, split_value, 'y', 'bottom')
-        poly2 = clip_polygon(exterior, split_value, 'y', 'top')
-    
-    geometry1 = {
-        'type': 'Polygon',
-        'coordinates': poly1
-    }
-    geometry2 = {
-        'type': 'Polygon',
-        'coordinates': poly2
-    }
-    
-    return Ok((geometry1, geometry2))
\ No newline at end of file
+        geometry1 = clip_geometry(polygons, split_value, 'y', 'bottom')
+        geometry2 = clip_geometry(polygons, split_value, 'y', 'top')
+
+    if geometry1 is None or geometry2 is None:
+        return Err("Inconsistent size: The polygon needs to have 4 points or more.")
+
+    return Ok((geometry1, geometry2))
+
+def project(ring: np.ndarray, latitude: float) -> np.ndarray:
+    # Equirectangular projection in meters around the given latitude, precise enough at the scale of a department
+    scale = np.array([math.cos(math.radians(latitude)), 1.0]) * EARTH_RADIUS
+    return np.radians(ring) * scale
+
+def signed_area(ring: np.ndarray) -> float:
+    # Positive when the ring turns counterclockwise
+    x = ring[:, 0]
+    y = ring[:, 1]
+    return float(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+
+def ring_area(ring: np.ndarray) -> float:
+    return abs(signed_area(ring))
+
+def geometry_area(geometry: dict) -> float:
+    polygons = unwrap_polygons(geometry)
+    latitude = float(np.concatenate([rings[0] for rings in polygons])[:, 1].mean())
+
+    area = 0.0
+    for rings in polygons:
+        area += ring_area(project(rings[0], latitude))
+        for hole in rings[1:]:
+            area -= ring_area(project(hole, latitude))
+    return area
+
+def split_into_tiles(geometry: dict, max_area: float) -> Result[List[dict], str]:
+    # Split along a grid whose cells are all smaller than max_area, the empty cells are dropped
+    try:
+        polygons = unwrap_polygons(geometry)
+    except ValueError as error:
+        return Err(f"{error}")
+
+    exteriors = np.concatenate([rings[0] for rings in polygons])
+    min_x, max_x, min_y, max_y = min_max_coordinate(exteriors)
+    corner = project(np.array([[min_x, min_y], [max_x, max_y]]), (min_y + max_y) / 2)
+    width, height = corner[1] - corner[0]
+    if width <= 0 or height <= 0 or max_area <= 0:
+        return Err("Inconsistent geometry: Empty bounding box.")
+
+    cells = math.ceil(width * height / max_area)
+    columns = max(1, round(math.sqrt(cells * width / height)))
+    rows = math.ceil(cells / columns)
+    xs = np.linspace(min_x, max_x, columns + 1)
+    ys = np.linspace(min_y, max_y, rows + 1)
+
+    tiles = []
+    for column in range(columns):
+        strip = polygons
+        if column > 0:
+            strip = clip_polygons(strip, xs[column], 'x', 'right')
+        if column < columns - 1:
+            strip = clip_polygons(strip, xs[column + 1], 'x', 'left')
+
+        for row in range(rows):
+            cell = strip
+            if row > 0:
+                cell = clip_polygons(cell, ys[row], 'y', 'top')
+            if row < rows - 1:
+                cell = clip_polygons(cell, ys[row + 1], 'y', 'bottom')
+            if cell:
+                tiles.append(to_geometry(cell))
+
+    return Ok(tiles)
@@ -1,4 +1,5 @@
-from load_dbt import generate_views, run_command
+import os
+from load_dbt import generate_views, incremental_since, run_command
 from dremio import launch_docker_compose, wait_service
 from utils import *
 
@@ -12,7 +13,14 @@ def main():
     status = wait_service("http://localhost:9047", 300)
     
     if status:
-        run_command(["run", "--project-dir", "dbt_immo"])
-        run_command(["test", "--project-dir", "dbt_immo"])
+        # An environment variable, a new --vars value would invalidate the whole partial parse
+        full_refresh, since = incremental_since("data/DVF")
+        if since is not None:
+            os.environ["DVF_SINCE_DVFPLUS"] = since
+        else:
+            os.environ.pop("DVF_SINCE_DVFPLUS", None)
+        # One build runs the models then their tests, in the order of the DAG
+        # A full export can have dropped rows of any year, the incremental models are rebuilt
+        run_command(["build", "--project-dir", "dbt_immo"] + (["--full-refresh"] if full_refresh else []))
     else:
         logger.error("Failed to launch the Docker Container")
\ No newline at end of file
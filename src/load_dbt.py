@@ -1,20 +1,56 @@
+import json
 import os
-import subprocess
 from pathlib import Path
-from typing import List
+from string import Template
+from typing import Any, List, Optional
 from typing import Tuple
+from metrics import METRICS
+from utils import *
 
 MODEL_FOLDER = "dbt_immo/models"
+# Events of dbt logged as they arrive, one per model, test or seed finished
+NODE_EVENTS = ("LogModelResult", "LogTestResult", "LogSeedResult", "LogSnapshotResult", "LogNodeNoOpResult")
+
+# Views over the extracted dataset, the incremental models mutations.sql and classes.sql replace
+# their rows dated from dvf_since() with the ones of these views, see macros/dvf_replace.sql
+SOURCE_TEMPLATE = Template("""{{ config(materialized='view') }}
+
+SELECT *
+FROM $source AS dvf
+""")
 
 def generate_view(files_path: List[str], view_name: str) -> None:
     path = Path(MODEL_FOLDER) / view_name
     path.parent.mkdir(parents=True, exist_ok=True)
     
-    queries = [f'SELECT * FROM DVF."{table}"' for table in files_path]
-    query = "\nUNION ALL\n".join(queries)
+    # A UNION of no SELECT isn't a query, the models can't be built without the dataset
+    if len(files_path) == 0:
+        raise ValueError(f"No extracted dataset for {view_name}")
+    # One dataset, the partitioned export or the single file, is read without re-planning a UNION of all the files
+    if len(files_path) == 1:
+        source = f'DVF."{files_path[0]}"'
+    else:
+        queries = [f'SELECT * FROM DVF."{table}"' for table in files_path]
+        source = "(\n" + "\nUNION ALL\n".join(queries) + "\n)"
     
     with open(path, 'w') as file:
-        file.write(query)
+        file.write(SOURCE_TEMPLATE.substitute(source=source))
+
+def incremental_since(folder_path: str) -> Tuple[bool, Optional[str]]:
+    # (full_refresh, since) from the last partitioned export: a full refresh when it rewrote all the partitions,
+    # else the first year it rewrote, the models then skip the older partitions
+    path = Path(folder_path) / EXPORT_STATE_FILE
+    try:
+        with open(path, 'r') as fs:
+            state = json.load(fs)
+    except Exception:
+        return False, None
+    partitions = state.get("partitions")
+    if partitions is None:
+        return True, None
+    if len(partitions) == 0:
+        return False, None
+    return False, f"{min(annee for annee, _ in partitions)}-01-01"
 
 def generate_views(folder_path: str) -> Tuple[bool, str]:
     path: Path = Path(folder_path)
@@ -23,6 +59,8 @@ def generate_views(folder_path: str) -> Tuple[bool, str]:
     
     try:
         entries = [entry for entry in path.iterdir() if entry.is_file()]
+        # The partitioned exports are folders, read by Dremio as one table
+        folders = [entry.name for entry in path.iterdir() if entry.is_dir() and entry.name in ("mutations", "classes")]
     except Exception as e:
         error_msg = f"Failed to read the folder {folder_path} : {e} - {os.getcwd()}"
         print(error_msg)
@@ -36,24 +74,36 @@ def generate_views(folder_path: str) -> Tuple[bool, str]:
             elif filename.startswith("classes"):
                 classes_path.append(filename)
     
+    # A partitioned export replaces the single file
+    if "mutations" in folders:
+        mutations_path = ["mutations"]
+    if "classes" in folders:
+        classes_path = ["classes"]
+    
     try:
-        generate_view(mutations_path, "mutations.sql")
-        generate_view(classes_path, "classes.sql")
+        generate_view(mutations_path, "dvf_mutations.sql")
+        generate_view(classes_path, "dvf_classes.sql")
         return True, "Successfully generate the dbt models !"
     except Exception as e:
         return False, f"Error generating views: {e}"
 
+def log_event(event: Any) -> None:
+    # Streams the results of the nodes while the build runs
+    if event.info.name in NODE_EVENTS:
+        logger.info(event.info.msg)
+
 def run_command(args: List[str]) -> None:
-    
-    try:
-        result = subprocess.run(
-            ["dbt"] + args,
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        print(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {e}")
-        print(f"Stderr: {e.stderr}")
-        raise
\ No newline at end of file
+    # dbt is only imported by the load, generate_views and the extraction run without it
+    from dbt.cli.main import dbtRunner
+    from dbt.contracts.results import RunExecutionResult
+
+    # In process, the adapter and the partial parse of target/ are reused instead of parsing the project again
+    runner = dbtRunner(callbacks=[log_event])
+    with METRICS.stage_seconds.time(stage=f"dbt_{args[0]}"):
+        result = runner.invoke(args)
+
+    if isinstance(result.result, RunExecutionResult):
+        for node in result.result.results:
+            METRICS.dbt_nodes.observe(node.execution_time, node=node.node.unique_id, status=str(node.status))
+    if not result.success:
+        raise Exception(f"dbt {args[0]} failed : {result.exception or 'see the results above'}")
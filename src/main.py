@@ -1,14 +1,19 @@
 from tasks import *
 from utils import *
+from metrics import METRICS
 
 if __name__ == '__main__':
-    res1 = task1()
-
-    if res1:
-        res2 = task2()
+    METRICS.start()
+    try:
+        if OVERLAP:
+            res2 = task1_2()
+        else:
+            res2 = task1() and task2()
 
         if res2:
             res3 = task3()
 
             if res3:
-                print("\n\nSuccessfully run the pipeline !")
\ No newline at end of file
+                print("\n\nSuccessfully run the pipeline !")
+    finally:
+        METRICS.finish()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+from typing import Optional
+from utils import *
+
+MANIFEST_PATH = "data/DVF/manifest.json"
+# Only query the mutations newer than the watermark of each feature
+INCREMENTAL = os.environ.get("INCREMENTAL_DVFPLUS", "0") == "1"
+
+class Manifest:
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.features: dict[str, dict] = {}
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fs:
+                data = json.load(fs)
+            self.features = data.get('features', {})
+        except Exception as error:
+            logger.error(f"Failed to load the manifest {self.path} : {error}")
+
+    def save(self) -> None:
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as fs:
+            json.dump({'features': self.features}, fs, indent=1)
+        os.replace(temp_path, self.path)
+
+    def watermark(self, feature_id: str) -> Optional[str]:
+        # Upper bound (excluded) of the datemut window already extracted for the feature
+        with self.lock:
+            feature = self.features.get(feature_id)
+            return feature.get('watermark') if feature else None
+
+    def complete(self, feature_id: str, watermark: str, last_datemut: Optional[str], mutations: int) -> None:
+        with self.lock:
+            feature = self.features.setdefault(feature_id, {'last_datemut': None, 'mutations': 0})
+            feature['watermark'] = watermark
+            if last_datemut is not None and (feature['last_datemut'] is None or last_datemut > feature['last_datemut']):
+                feature['last_datemut'] = last_datemut
+            feature['mutations'] += mutations
+            try:
+                self.save()
+            except Exception as error:
+                logger.error(f"Failed to save the manifest {self.path} : {error}")
+
+class DeferredFeatures:
+    # Features with deferred requests, completed once the retries extracted all of them
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.features: dict[str, dict] = {}
+
+    def extracted(self, feature_id: str, watermark: str, deferred: int, failed: bool, last_datemut: Optional[str], mutations: int) -> None:
+        # Called after each extraction of the feature, deferred is the number of requests it deferred
+        with self.lock:
+            feature = self.features.get(feature_id)
+            if feature is None:
+                if deferred == 0:
+                    return
+                feature = self.features[feature_id] = {'watermark': watermark, 'deferred': 0, 'failed': False, 'last_datemut': None, 'mutations': 0}
+            feature['deferred'] += deferred
+            feature['failed'] = feature['failed'] or failed
+            feature['last_datemut'] = max(feature['last_datemut'] or "", last_datemut or "") or None
+            feature['mutations'] += mutations
+
+    def retried(self, feature_id: str, failed: bool = False) -> Optional[tuple]:
+        # The arguments of MANIFEST.complete once the last deferred request of the feature is retried
+        with self.lock:
+            feature = self.features.get(feature_id)
+            if feature is None:
+                return None
+            feature['deferred'] -= 1
+            feature['failed'] = feature['failed'] or failed
+            if feature['deferred'] > 0:
+                return None
+            del self.features[feature_id]
+            if feature['failed']:
+                return None
+            return (feature_id, feature['watermark'], feature['last_datemut'], feature['mutations'])
+
+MANIFEST = Manifest()
+DEFERRED_FEATURES = DeferredFeatures()
@@ -0,0 +1,225 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from utils import *
+
+# JSON report written at the end of each run
+METRICS_REPORT = os.environ.get("METRICS_REPORT_DVFPLUS", "data/DVF/metrics.json")
+# Prometheus textfile, for the textfile collector of node_exporter, not written when empty
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE_DVFPLUS", "")
+# Seconds between two exports during the run, 0 only exports at the end
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL_DVFPLUS", "0"))
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BYTES_BUCKETS = tuple(float(4 ** power) for power in range(5, 16))
+DEPTH_BUCKETS = (0.0, 1.0, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0, 16.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def label_key(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: Any) -> None:
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def value(self, **labels: Any) -> float:
+        with self.lock:
+            return self.values.get(label_key(labels), 0)
+
+    def report(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [{"labels": dict(key), "value": value} for key, value in sorted(self.values.items())]
+
+    def prometheus(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Series:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[Labels, Series] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = label_key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series(self.buckets)
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.count += 1
+            series.sum += value
+            series.min = min(series.min, value)
+            series.max = max(series.max, value)
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, series: Series, quantile: float) -> float:
+        # Upper bound of the bucket holding the quantile, the maximum for the last one
+        rank = quantile * series.count
+        seen = 0
+        for index, count in enumerate(series.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.buckets[index], series.max) if index < len(self.buckets) else series.max
+        return series.max
+
+    def report(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [
+                {
+                    "labels": dict(key),
+                    "count": series.count,
+                    "sum": series.sum,
+                    "mean": series.sum / series.count,
+                    "min": series.min,
+                    "p50": self.quantile(series, 0.5),
+                    "p95": self.quantile(series, 0.95),
+                    "p99": self.quantile(series, 0.99),
+                    "max": series.max,
+                }
+                for key, series in sorted(self.series.items()) if series.count > 0
+            ]
+
+    def prometheus(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series.counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{format_labels(key, ('le', repr(bound)))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(key, ('le', '+Inf'))} {series.count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {series.sum}")
+                lines.append(f"{self.name}_count{format_labels(key)} {series.count}")
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        self.requests = Histogram("dvf_request_seconds", "Latency of the calls to the DVF+ API by status code")
+        self.response_bytes = Counter("dvf_response_bytes_total", "Bytes received from the DVF+ API")
+        self.cache_hits = Counter("dvf_cache_hits_total", "Responses served by the response cache")
+        self.retries = Counter("dvf_retries_total", "Requests retried by status code")
+        self.deferred = Counter("dvf_deferred_total", "Requests deferred to a retry round")
+        self.split_depth = Histogram("dvf_split_depth", "Number of splits of the geometries accepted by the API", DEPTH_BUCKETS)
+        self.stage_seconds = Histogram("dvf_stage_seconds", "Time spent by each stage of the pipeline")
+        self.stage_rows = Counter("dvf_stage_rows_total", "Rows processed by each stage of the pipeline")
+        self.file_bytes = Histogram("dvf_file_bytes", "Size of the parquet files written by table", BYTES_BUCKETS)
+        self.duplicates = Counter("dvf_duplicates_total", "Duplicated mutations dropped by the ingest")
+        self.statements = Histogram("dvf_duckdb_statement_seconds", "Time of the DuckDB statements")
+        self.dbt_nodes = Histogram("dvf_dbt_node_seconds", "Execution time of the dbt models and tests")
+        self.exporter: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def all(self) -> List[Any]:
+        return [value for value in vars(self).values() if isinstance(value, (Counter, Histogram))]
+
+    def stages(self) -> Dict[str, Dict[str, float]]:
+        # Rows per second of the time spent in each stage, summed over the threads and processes
+        summary = {}
+        for entry in self.stage_seconds.report():
+            name = entry["labels"]["stage"]
+            rows = self.stage_rows.value(stage=name)
+            summary[name] = {
+                "seconds": entry["sum"],
+                "calls": entry["count"],
+                "rows": rows,
+                "rows_per_second": rows / entry["sum"] if entry["sum"] > 0 else 0.0,
+            }
+        return summary
+
+    def report(self) -> Dict[str, Any]:
+        now = time.time()
+        return {
+            "started_at": self.started_at,
+            "finished_at": now,
+            "duration": now - self.started_at,
+            "stages": self.stages(),
+            "counters": {metric.name: metric.report() for metric in self.all() if isinstance(metric, Counter)},
+            "histograms": {metric.name: metric.report() for metric in self.all() if isinstance(metric, Histogram)},
+        }
+
+    def prometheus(self) -> str:
+        lines = []
+        for metric in self.all():
+            lines.extend(metric.prometheus())
+        lines.append("# HELP dvf_run_started_seconds Start of the run as a unix timestamp")
+        lines.append("# TYPE dvf_run_started_seconds gauge")
+        lines.append(f"dvf_run_started_seconds {self.started_at}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, report_path: str = METRICS_REPORT, textfile_path: str = METRICS_TEXTFILE) -> None:
+        # Written to temporary files then renamed, the collectors never read a partial file
+        outputs = [(report_path, lambda: json.dumps(self.report(), indent=2)), (textfile_path, self.prometheus)]
+        for path, render in outputs:
+            if not path:
+                continue
+            try:
+                folder = os.path.dirname(path)
+                if folder:
+                    os.makedirs(folder, exist_ok=True)
+                with open(f"{path}.tmp", 'w') as fs:
+                    fs.write(render())
+                os.replace(f"{path}.tmp", path)
+            except Exception as error:
+                logger.error(f"Failed to write the metrics to {path} : {error}")
+
+    def start(self, interval: float = METRICS_INTERVAL) -> None:
+        self.started_at = time.time()
+        if interval > 0 and self.exporter is None:
+            self.stopped.clear()
+            self.exporter = threading.Thread(target=self.export, args=(interval,), daemon=True)
+            self.exporter.start()
+
+    def export(self, interval: float) -> None:
+        while not self.stopped.wait(interval):
+            self.write()
+
+    def finish(self) -> None:
+        self.stopped.set()
+        if self.exporter is not None:
+            self.exporter.join()
+            self.exporter = None
+        self.write()
+
+METRICS = Metrics()
@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+import time
+import pyarrow as pa
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+from transform_api_dvf import transform_api_data
+from writers import DepartmentWriter
+from metrics import METRICS
+from utils import *
+
+# Processes decoding the responses and building their Arrow batches
+TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS_DVFPLUS", str(os.cpu_count() or 1)))
+# Responses waiting for or being transformed, the fetchers block beyond it
+TRANSFORM_QUEUE = int(os.environ.get("TRANSFORM_QUEUE_DVFPLUS", str(2 * TRANSFORM_WORKERS)))
+# Threads writing the batches, the files of a department are always written by the same one
+WRITE_WORKERS = int(os.environ.get("WRITE_WORKERS_DVFPLUS", "2"))
+# Batches waiting for each writer thread, the transforms block beyond it
+WRITE_QUEUE = int(os.environ.get("WRITE_QUEUE_DVFPLUS", "16"))
+
+@dataclass
+class Transformed:
+    mutations: pa.RecordBatch
+    classes: pa.RecordBatch
+    last_datemut: Optional[str]
+    # Time of the transform in the worker process, its metrics are recorded by the parent
+    seconds: float
+
+def transform(content: bytes) -> Transformed:
+    # Runs in the worker processes
+    start = time.perf_counter()
+    mutations, classes = transform_api_data(content)
+    mutations_batch = mutations.to_batch()
+    classes_batch = classes.to_batch()
+    return Transformed(mutations_batch, classes_batch, mutations.last_datemut(), time.perf_counter() - start)
+
+class Pipeline:
+    # Fetch threads -> transform processes -> writer threads, each stage bounded by the size of its queue
+    def __init__(
+        self,
+        fetch_workers: int,
+        transform_workers: int = TRANSFORM_WORKERS,
+        transform_queue: int = TRANSFORM_QUEUE,
+        write_workers: int = WRITE_WORKERS,
+        write_queue: int = WRITE_QUEUE,
+        on_commit: Optional[Callable[[str, str], None]] = None,
+        on_batch: Optional[Callable[[pa.RecordBatch, pa.RecordBatch], None]] = None
+    ):
+        # Called by the writer threads with the (mutations, classes) paths of each committed department
+        self.on_commit = on_commit
+        # Called by the writer threads with the new rows of each batch, before the commit of its department
+        self.on_batch = on_batch
+        self.fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers)
+        self.transform_pool = ProcessPoolExecutor(max_workers=transform_workers)
+        self.transform_slots = threading.BoundedSemaphore(transform_queue)
+        self.write_queues: List[queue.Queue] = [queue.Queue(maxsize=write_queue) for _ in range(write_workers)]
+        self.write_threads = [
+            threading.Thread(target=self.write_worker, args=(tasks,), daemon=True)
+            for tasks in self.write_queues
+        ]
+        for thread in self.write_threads:
+            thread.start()
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+
+    def fetch(self, function: Callable[..., Any], *args) -> Future:
+        return self.fetch_pool.submit(function, *args)
+
+    def transform(self, content: bytes) -> Future:
+        self.transform_slots.acquire()
+        try:
+            future = self.transform_pool.submit(transform, content)
+        except Exception:
+            self.transform_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.transform_slots.release())
+        return future
+
+    def write(self, writer: DepartmentWriter, transformed: Transformed) -> None:
+        self.submit_write(writer, self.timed_write, writer, transformed.mutations, transformed.classes)
+
+    def timed_write(self, writer: DepartmentWriter, mutations: pa.RecordBatch, classes: pa.RecordBatch) -> None:
+        with METRICS.stage_seconds.time(stage="write"):
+            mutations, classes = writer.write(mutations, classes)
+        METRICS.stage_rows.inc(mutations.num_rows, stage="write")
+        if self.on_batch is not None and mutations.num_rows > 0:
+            self.on_batch(mutations, classes)
+
+    def submit_write(self, writer: DepartmentWriter, function: Callable[..., Any], *args) -> None:
+        # The tasks of a writer run in order, so its close runs after all its writes
+        tasks = self.write_queues[hash(writer.name) % len(self.write_queues)]
+        tasks.put((writer, function, args))
+
+    def write_worker(self, tasks: queue.Queue) -> None:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            writer, function, args = task
+            try:
+                function(*args)
+            except Exception as error:
+                logger.error(error)
+                writer.fail(f"{error}")
+
+    def shutdown(self) -> None:
+        self.fetch_pool.shutdown()
+        self.transform_pool.shutdown()
+        for tasks in self.write_queues:
+            tasks.put(None)
+        for thread in self.write_threads:
+            thread.join()
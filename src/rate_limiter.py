@@ -0,0 +1,135 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, List, Optional
+from utils import *
+
+# Requests per second at the start of a run, adjusted from the responses of the API
+INITIAL_RATE = float(os.environ.get("RATE_DVFPLUS", "5"))
+MIN_RATE = 0.2
+MAX_RATE = float(os.environ.get("MAX_RATE_DVFPLUS", "50"))
+
+# Additive increase after a success, multiplicative decrease after a 402
+RATE_INCREASE = 0.05
+RATE_DECREASE = 0.5
+# Fraction of the learned quota ceiling the scheduler aims for
+CEILING_MARGIN = 0.95
+# Relative rise per second of the learned ceiling without 402, so a raised quota is detected
+CEILING_RECOVERY = 0.01
+
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+class TokenBucket:
+    # clock and sleep are only replaced by the tests
+    def __init__(self, rate: float, clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def set_rate(self, rate: float, drain: bool = False) -> None:
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+            self.tokens = 0.0 if drain else min(self.tokens, self.capacity)
+
+@dataclass
+class Sent:
+    # Rate of the scheduler when a request was sent, and the number of decreases before it
+    rate: float
+    decreases: int
+
+class RateScheduler:
+    def __init__(
+        self,
+        rate: float = INITIAL_RATE,
+        min_rate: float = MIN_RATE,
+        max_rate: float = MAX_RATE,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        self.bucket = TokenBucket(rate, clock, sleep)
+        self.clock = clock
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # Highest rate known to exceed the quota, None until the first 402
+        self.ceiling: Optional[float] = None
+        self.relaxed_at = clock()
+        self.decreases = 0
+        self.retry_queue: Deque[Any] = deque()
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.retry_queue)
+
+    def acquire(self) -> Sent:
+        self.bucket.acquire()
+        with self.lock:
+            return Sent(self.rate, self.decreases)
+
+    def on_success(self) -> None:
+        with self.lock:
+            limit = self.max_rate
+            if self.ceiling is not None:
+                now = self.clock()
+                self.ceiling = min(self.max_rate, self.ceiling * (1 + CEILING_RECOVERY * (now - self.relaxed_at)))
+                self.relaxed_at = now
+                limit = self.ceiling * CEILING_MARGIN
+            rate = min(limit, self.rate + RATE_INCREASE)
+            if rate != self.rate:
+                self.bucket.set_rate(rate)
+
+    def on_quota(self, sent: Sent) -> None:
+        with self.lock:
+            # The 402 of the requests sent before the last decrease are already accounted for
+            if sent.decreases < self.decreases:
+                return
+            self.decreases += 1
+            self.ceiling = sent.rate if self.ceiling is None else min(self.ceiling, sent.rate)
+            self.relaxed_at = self.clock()
+            rate = max(self.min_rate, sent.rate * RATE_DECREASE)
+            self.bucket.set_rate(rate, drain=True)
+            logger.warning(f"Request quota exceeded, rate lowered to {rate:.2f} req/s (ceiling {self.ceiling:.2f} req/s)")
+
+    def backoff(self, attempt: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def defer(self, item: Any) -> None:
+        self.retry_queue.append(item)
+
+    def drain(self) -> List[Any]:
+        items = []
+        while len(self.retry_queue) > 0:
+            items.append(self.retry_queue.popleft())
+        return items
+
+SCHEDULER = RateScheduler()
@@ -0,0 +1,242 @@
+import argparse
+import gzip
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from geometry import geometry_area, unwrap_polygons
+from synthetic import SyntheticConfig, generate_feature, generate_polygon
+
+# Local stand-in of 'mutation/search', run the extraction against it with API_URL_DVFPLUS=http://localhost:<port>
+ENDPOINT = "/dvfplus/v1.0/sogefi/mutation/search"
+# The mutations are generated per cell of this size in degrees, the same cell always has the same mutations
+CELL_SIZE = 0.01
+
+@dataclass
+class SimulatorConfig:
+    # 'none', 'fixed', 'uniform', 'exponential' or 'lognormal', in seconds
+    latency: str = "none"
+    latency_mean: float = 0.1
+    # Half-width of 'uniform' and sigma of 'lognormal'
+    latency_spread: float = 0.05
+    # Requests per second accepted before answering 402, None for no quota
+    quota_rate: Optional[float] = None
+    # Probability of a 402 or a 501 on any request
+    quota_probability: float = 0.0
+    error_probability: float = 0.0
+    # Largest surface accepted in m2, a larger geometry gets the 403 'Surface ... trop grande'
+    max_area: float = 25e6
+    # Mutations per km2
+    density: float = 50.0
+    seed: int = 0
+    synthetic: SyntheticConfig = field(default_factory=SyntheticConfig)
+
+class Quota:
+    # Token bucket refilled at rate tokens per second
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class Simulator:
+    def __init__(self, config: SimulatorConfig):
+        self.config = config
+        self.quota = Quota(config.quota_rate) if config.quota_rate else None
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {}
+        self.cell = lru_cache(maxsize=65536)(self.generate_cell)
+
+    def count(self, status: int) -> None:
+        with self.lock:
+            self.stats[str(status)] = self.stats.get(str(status), 0) + 1
+
+    def random(self) -> float:
+        with self.lock:
+            return self.rng.random()
+
+    def latency(self) -> float:
+        config = self.config
+        with self.lock:
+            if config.latency == "fixed":
+                return config.latency_mean
+            if config.latency == "uniform":
+                return max(0.0, self.rng.uniform(config.latency_mean - config.latency_spread, config.latency_mean + config.latency_spread))
+            if config.latency == "exponential":
+                return self.rng.expovariate(1 / config.latency_mean)
+            if config.latency == "lognormal":
+                # Parameterized by the mean of the distribution
+                sigma = config.latency_spread
+                return self.rng.lognormvariate(math.log(config.latency_mean) - sigma ** 2 / 2, sigma)
+        return 0.0
+
+    def generate_cell(self, x: int, y: int) -> List[Tuple[float, float, Dict[str, Any]]]:
+        # The mutations located in the cell (x, y) with their point
+        rng = random.Random(f"{self.config.seed}:{x}:{y}")
+        latitude = math.radians((y + 0.5) * CELL_SIZE)
+        area = (CELL_SIZE * 111.32) ** 2 * math.cos(latitude)
+        mutations = []
+        for index in range(int(rng.expovariate(1 / max(self.config.density * area, 1e-9)))):
+            px = (x + rng.random()) * CELL_SIZE
+            py = (y + rng.random()) * CELL_SIZE
+            feature = generate_feature(rng, self.config.synthetic, index)
+            feature["geometry"] = generate_polygon(rng, 5, px, py, CELL_SIZE / 200)
+            for number, disposition in enumerate(feature["properties"]["dispositions"]):
+                disposition["idmutation"] = zlib.crc32(f"{x}:{y}:{index}:{number}".encode()) & 0x7fffffff
+            mutations.append((px, py, feature))
+        return mutations
+
+    def search(self, geometry: Dict[str, Any], filters: Dict[str, str]) -> List[Dict[str, Any]]:
+        polygons = unwrap_polygons(geometry)
+        rings = [ring for rings in polygons for ring in rings]
+        points = np.concatenate(rings)
+        min_x, min_y = points.min(axis=0)
+        max_x, max_y = points.max(axis=0)
+
+        candidates = []
+        for x in range(math.floor(min_x / CELL_SIZE), math.floor(max_x / CELL_SIZE) + 1):
+            for y in range(math.floor(min_y / CELL_SIZE), math.floor(max_y / CELL_SIZE) + 1):
+                candidates.extend(self.cell(x, y))
+        if not candidates:
+            return []
+
+        # Even-odd rule over all the rings, so the holes are excluded
+        px = np.array([candidate[0] for candidate in candidates])
+        py = np.array([candidate[1] for candidate in candidates])
+        inside = np.zeros(len(candidates), dtype=bool)
+        for ring in rings:
+            x1, y1 = ring[:-1, 0], ring[:-1, 1]
+            x2, y2 = ring[1:, 0], ring[1:, 1]
+            crosses = (y1[:, None] > py) != (y2[:, None] > py)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                intersection = x1[:, None] + (py - y1[:, None]) * (x2 - x1)[:, None] / (y2 - y1)[:, None]
+            inside ^= (np.count_nonzero(crosses & (px < intersection), axis=0) % 2).astype(bool)
+
+        lower = filters.get("datemut[gte]")
+        upper = filters.get("datemut[lt]")
+        features = []
+        for (_, _, feature), selected in zip(candidates, inside):
+            datemut = feature["properties"]["datemut"]
+            if selected and (lower is None or datemut >= lower) and (upper is None or datemut < upper):
+                features.append(feature)
+        return features
+
+    def handle(self, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, Dict[str, Any]]:
+        if not path.endswith(ENDPOINT):
+            return 404, {"message": "Not found"}
+
+        delay = self.latency()
+        if delay > 0:
+            time.sleep(delay)
+
+        if (self.quota is not None and not self.quota.take()) or self.random() < self.config.quota_probability:
+            return 402, {"message": "Quota dépassé"}
+        if self.random() < self.config.error_probability:
+            return 501, {"message": "Not Implemented"}
+
+        try:
+            geometry = json.loads(body)["geojson"]
+            area = geometry_area(geometry)
+        except (KeyError, TypeError, ValueError) as error:
+            return 400, {"message": f"GeoJSON invalide : {error}"}
+        if area > self.config.max_area:
+            return 403, {"message": f"Surface {area / 1e6:.2f} km² du GeoJSON trop grande"}
+
+        return 200, {"type": "FeatureCollection", "features": self.search(geometry, query)}
+
+def make_handler(simulator: Simulator) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            if urlparse(self.path).path == "/stats":
+                with simulator.lock:
+                    stats = dict(simulator.stats)
+                self.send(200, stats)
+            else:
+                self.send(404, {"message": "Not found"})
+
+        def do_POST(self) -> None:
+            url = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, payload = simulator.handle(url.path, query, body)
+            simulator.count(status)
+            self.send(status, payload)
+
+        def send(self, status: int, payload: Dict[str, Any]) -> None:
+            # Compact separators, the extraction matches the message of the 403 on its exact text
+            content = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                content = gzip.compress(content, compresslevel=1)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+def start(config: SimulatorConfig, host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, Simulator]:
+    # Serves in a daemon thread, port 0 picks a free port, stopped by server.shutdown()
+    simulator = Simulator(config)
+    server = ThreadingHTTPServer((host, port), make_handler(simulator))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, simulator
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local simulator of the DVF+ 'mutation/search' API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", choices=["none", "fixed", "uniform", "exponential", "lognormal"], default="none")
+    parser.add_argument("--latency-mean", type=float, default=0.1)
+    parser.add_argument("--latency-spread", type=float, default=0.05)
+    parser.add_argument("--quota-rate", type=float, default=None)
+    parser.add_argument("--quota-probability", type=float, default=0.0)
+    parser.add_argument("--error-probability", type=float, default=0.0)
+    parser.add_argument("--max-area", type=float, default=25e6, help="largest surface accepted in m2")
+    parser.add_argument("--density", type=float, default=50.0, help="mutations per km2")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = SimulatorConfig(
+        latency=args.latency, latency_mean=args.latency_mean, latency_spread=args.latency_spread,
+        quota_rate=args.quota_rate, quota_probability=args.quota_probability,
+        error_probability=args.error_probability, max_area=args.max_area,
+        density=args.density, seed=args.seed
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(Simulator(config)))
+    server.daemon_threads = True
+    print(f"Serving 'mutation/search' on http://{args.host}:{args.port}, set API_URL_DVFPLUS to it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
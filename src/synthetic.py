@@ -0,0 +1,86 @@
+import json
+import math
+import random
+from dataclasses import dataclass
+from datetime import date, timedelta
+from typing import Any, Dict, List
+
+TYPOLOGIES = ["Maison", "Appartement", "Dépendance", "Local industriel. commercial ou assimilé", "Terrain"]
+NATURES = ["Vente", "Vente en l'état futur d'achèvement", "Echange", "Adjudication"]
+LIBELLES = ["Sols", "Terres", "Prés", "Bois", "Jardins", "Terrains à bâtir"]
+TYPVOIES = ["RUE", "AV", "BD", "CHE", "PL", "IMP", None]
+COMMUNES = ["Paris", "Lyon", "Marseille", "Toulouse", "Nantes", "Lille", "Rennes"]
+
+@dataclass
+class SyntheticConfig:
+    features: int = 1000
+    dispositions: int = 1
+    parcels: int = 3
+    classes: int = 2
+    # Vertices of the geometry of each feature
+    vertices: int = 16
+    seed: int = 0
+    # Offsets the idmutation, so several responses don't share their mutations
+    start: int = 0
+
+def generate_polygon(rng: random.Random, vertices: int, x: float, y: float, radius: float) -> Dict[str, Any]:
+    ring = []
+    for index in range(vertices):
+        angle = 2 * math.pi * index / vertices
+        distance = radius * rng.uniform(0.6, 1.0)
+        ring.append([round(x + distance * math.cos(angle), 6), round(y + distance * math.sin(angle), 6)])
+    ring.append(ring[0])
+    return {"type": "Polygon", "coordinates": [ring]}
+
+def generate_parcel(rng: random.Random, config: SyntheticConfig, departement: int) -> Dict[str, Any]:
+    commune = rng.randrange(1, 999)
+    return {
+        "idpar": f"{departement:02d}{commune:03d}000{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}{rng.randrange(1, 9999):04d}",
+        "parcvendue": rng.random() < 0.9,
+        "dcnt": [
+            {"libregroupement": rng.choice(LIBELLES), "surface": round(rng.uniform(10, 5000), 2)}
+            for _ in range(config.classes)
+        ],
+        "adresses": [{
+            "btq": rng.choice([None, "B", "T"]),
+            "voie": f"DE LA {rng.choice(['GARE', 'MAIRIE', 'PAIX', 'REPUBLIQUE'])}",
+            "novoie": str(rng.randrange(1, 200)),
+            "codvoie": f"{rng.randrange(1, 9999):04d}",
+            "commune": rng.choice(COMMUNES),
+            "typvoie": rng.choice(TYPVOIES),
+            "codepostal": f"{departement:02d}{rng.randrange(0, 999):03d}"
+        }]
+    }
+
+def generate_feature(rng: random.Random, config: SyntheticConfig, index: int) -> Dict[str, Any]:
+    departement = rng.randrange(1, 96)
+    datemut = date(2014, 1, 1) + timedelta(days=rng.randrange(0, 365 * 11))
+    x = rng.uniform(-1.5, 7.5)
+    y = rng.uniform(43.0, 50.5)
+    return {
+        "type": "Feature",
+        "geometry": generate_polygon(rng, config.vertices, x, y, 0.0005),
+        "properties": {
+            "vefa": rng.random() < 0.05,
+            "datemut": datemut.strftime("%Y-%m-%d"),
+            "typologie": {"libelle": rng.choice(TYPOLOGIES)},
+            "nature_mutation": {"libelle": rng.choice(NATURES)},
+            "dispositions": [
+                {
+                    "idmutation": config.start + index * config.dispositions + disposition,
+                    "valeurfonc": round(rng.uniform(1000, 2000000), 2),
+                    "parcelles": [generate_parcel(rng, config, departement) for _ in range(config.parcels)]
+                }
+                for disposition in range(config.dispositions)
+            ]
+        }
+    }
+
+def generate_features(config: SyntheticConfig) -> List[Dict[str, Any]]:
+    rng = random.Random(config.seed)
+    return [generate_feature(rng, config, index) for index in range(config.features)]
+
+def generate_response(config: SyntheticConfig) -> bytes:
+    # Body of a 'mutation/search' response
+    collection = {"type": "FeatureCollection", "features": generate_features(config)}
+    return json.dumps(collection, ensure_ascii=False).encode()
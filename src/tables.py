@@ -1,8 +1,11 @@
+import os
+import inspect
+import hashlib
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-from datetime import datetime
 from typing import List, Optional, Dict, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class SharedMutationProps:
@@ -11,60 +14,163 @@ class SharedMutationProps:
     datemut: str
     nature: str
 
-class Adresse:
-    def __init__(
-        self, btq: Optional[str], voie: Optional[str], novoie: Optional[str],
-        codvoie: Optional[str], commune: Optional[str], typvoie: Optional[str],
-        codepostal: Optional[str]
-    ):
-        self.btq = btq
-        self.voie = voie
-        self.novoie = novoie
-        self.codvoie = codvoie
-        self.commune = commune
-        self.typvoie = typvoie
-        self.codepostal = codepostal
-
-    @classmethod
-    def extract(cls, value: Any) -> 'Adresse':
-        if not isinstance(value, list) or len(value) == 0:
-            raise ValueError("Inconsistent value: Expected a non-empty list")
-        adresse = value[0]
-        if not isinstance(adresse, dict):
-            raise ValueError("Inconsistent value: Expected a dictionary")
-        
-        return cls(
-            btq=cls.unwrap_value(adresse.get('btq')),
-            voie=cls.unwrap_value(adresse.get('voie')),
-            novoie=cls.unwrap_value(adresse.get('novoie')),
-            codvoie=cls.unwrap_value(adresse.get('codvoie')),
-            commune=cls.unwrap_value(adresse.get('commune')),
-            typvoie=cls.unwrap_value(adresse.get('typvoie')),
-            codepostal=cls.unwrap_value(adresse.get('codepostal'))
-        )
-    
-    @staticmethod
-    def unwrap_value(value: Any) -> Optional[str]:
-        if isinstance(value, str):
-            return value
-        return None
-
-class Mutation:
-    def __init__(
+def unwrap_value(value: Any) -> Optional[str]:
+    if isinstance(value, str):
+        return value
+    return None
+
+MUTATIONS_SCHEMA = pa.schema([
+    pa.field('idg', pa.uint64(), False),
+    pa.field('idpar', pa.string(), False),
+    pa.field('idmutation', pa.uint64(), False),
+    pa.field('vefa', pa.bool_(), False),
+    pa.field('typologie', pa.string(), True),
+    pa.field('datemut', pa.date32(), False),
+    pa.field('nature', pa.string(), True),
+    pa.field('btq', pa.string(), True),
+    pa.field('voie', pa.string(), True),
+    pa.field('novoie', pa.string(), True),
+    pa.field('codvoie', pa.string(), True),
+    pa.field('commune', pa.string(), True),
+    pa.field('typvoie', pa.string(), True),
+    pa.field('codepostal', pa.string(), True),
+    pa.field('valeur_fonciere', pa.float64(), False),
+    pa.field('vendu', pa.bool_(), True)
+])
+
+CLASSES_SCHEMA = pa.schema([
+    pa.field('idg', pa.uint64(), False),
+    pa.field('libelle', pa.string(), False),
+    pa.field('surface', pa.float64(), False)
+])
+
+PARQUET_COMPRESSION = os.environ.get("PARQUET_COMPRESSION_DVFPLUS", "ZSTD")
+PARQUET_COMPRESSION_LEVEL = int(os.environ.get("PARQUET_COMPRESSION_LEVEL_DVFPLUS", "6"))
+# The bloom filters are only written by the versions of pyarrow that support them
+BLOOM_FILTERS = 'bloom_filter_options' in inspect.signature(pq.ParquetWriter.__init__).parameters
+
+@dataclass
+class ParquetLayout:
+    # Low cardinality columns are dictionary encoded, the others are plain encoded
+    dictionary_columns: List[str]
+    # The files are sorted by these columns so the statistics of their row groups can prune the scans
+    sort_by: List[str] = field(default_factory=list)
+    bloom_filter_columns: List[str] = field(default_factory=list)
+    compression: str = PARQUET_COMPRESSION
+    compression_level: Optional[int] = PARQUET_COMPRESSION_LEVEL
+    write_statistics: bool = True
+    write_page_index: bool = True
+
+    def sort_keys(self) -> List[tuple]:
+        return [(name, 'ascending') for name in self.sort_by]
+
+    def sort(self, table: pa.Table) -> pa.Table:
+        if not self.sort_by or table.num_rows == 0:
+            return table
+        return table.take(pc.sort_indices(table, sort_keys=self.sort_keys()))
+
+    def writer_options(self, schema: pa.Schema) -> Dict[str, Any]:
+        options: Dict[str, Any] = {
+            'compression': self.compression,
+            'use_dictionary': [name for name in self.dictionary_columns if name in schema.names],
+            'write_statistics': self.write_statistics,
+            'write_page_index': self.write_page_index,
+        }
+        if self.compression.upper() in ('ZSTD', 'GZIP', 'BROTLI'):
+            options['compression_level'] = self.compression_level
+        if self.sort_by:
+            options['sorting_columns'] = pq.SortingColumn.from_ordering(schema, self.sort_keys())
+        if BLOOM_FILTERS and self.bloom_filter_columns:
+            options['bloom_filter_options'] = {name: True for name in self.bloom_filter_columns}
+        return options
+
+MUTATIONS_LAYOUT = ParquetLayout(
+    dictionary_columns=['typologie', 'nature', 'btq', 'commune', 'typvoie', 'codepostal'],
+    sort_by=['codepostal', 'datemut'],
+    bloom_filter_columns=['idpar']
+)
+
+CLASSES_LAYOUT = ParquetLayout(
+    dictionary_columns=['libelle'],
+    sort_by=['idg']
+)
+
+def global_id(idmutation: int, idpar: str) -> int:
+    # 63 bits of a hash of the row key, fits the BIGINT of the databases
+    digest = hashlib.blake2b(f"{idmutation}:{idpar}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') >> 1
+
+def parse_dates(values: List[str]) -> pa.Array:
+    # Each distinct date is parsed once, the invalid dates become 1970-01-01
+    encoded = pa.array(values, type=pa.string()).dictionary_encode()
+    timestamps = pc.strptime(encoded.dictionary, format='%Y-%m-%d', unit='s', error_is_null=True)
+    dates = pc.fill_null(pc.cast(timestamps, pa.date32()), pa.scalar(0, pa.date32()))
+    return dates.take(encoded.indices)
+
+class ColumnsBuilder:
+    # Accumulate rows directly as columns, the repeated strings are interned so
+    # each distinct value is stored once
+    def __init__(self, schema: pa.Schema):
+        self.schema = schema
+        self.columns: Dict[str, list] = {name: [] for name in schema.names}
+        self.strings: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.columns[self.schema.names[0]])
+
+    def intern(self, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            return None
+        return self.strings.setdefault(value, value)
+
+    def rollback(self, size: int) -> None:
+        # Drop the rows appended after the builder had the given size
+        for column in self.columns.values():
+            del column[size:]
+
+    def clear(self) -> None:
+        self.rollback(0)
+
+    def array(self, field: pa.Field) -> pa.Array:
+        return pa.array(self.columns[field.name], type=field.type)
+
+    def arrays(self) -> List[pa.Array]:
+        return [self.array(field) for field in self.schema]
+
+    def to_batch(self) -> pa.RecordBatch:
+        return pa.RecordBatch.from_arrays(self.arrays(), schema=self.schema)
+
+class MutationsBuilder(ColumnsBuilder):
+    def __init__(self):
+        super().__init__(MUTATIONS_SCHEMA)
+
+    def append_row(
         self, idg: int, idpar: str, idmutation: int, shared_props: SharedMutationProps,
-        adresse: Adresse, valeur_fonciere: float, vendu: bool
-    ):
-        self.idg = idg
-        self.idpar = idpar
-        self.idmutation = idmutation
-        self.shared_props = shared_props
-        self.adresse = adresse
-        self.valeur_fonciere = valeur_fonciere
-        self.vendu = vendu
-
-    @classmethod
-    def extract(cls, map: Dict[str, Any], shared_props: SharedMutationProps, valeurfonc: float,
-                idmutation: int, id: int) -> 'Mutation':
+        btq: Optional[str], voie: Optional[str], novoie: Optional[str], codvoie: Optional[str],
+        commune: Optional[str], typvoie: Optional[str], codepostal: Optional[str],
+        valeur_fonciere: float, vendu: bool
+    ) -> None:
+        columns = self.columns
+        intern = self.intern
+        columns['idg'].append(idg)
+        columns['idpar'].append(idpar)
+        columns['idmutation'].append(idmutation)
+        columns['vefa'].append(shared_props.vefa)
+        columns['typologie'].append(intern(shared_props.typologie))
+        columns['datemut'].append(intern(shared_props.datemut))
+        columns['nature'].append(intern(shared_props.nature))
+        columns['btq'].append(intern(btq))
+        columns['voie'].append(intern(voie))
+        columns['novoie'].append(novoie)
+        columns['codvoie'].append(intern(codvoie))
+        columns['commune'].append(intern(commune))
+        columns['typvoie'].append(intern(typvoie))
+        columns['codepostal'].append(intern(codepostal))
+        columns['valeur_fonciere'].append(valeur_fonciere)
+        columns['vendu'].append(vendu)
+
+    def extract(self, map: Dict[str, Any], shared_props: SharedMutationProps, valeurfonc: float,
+                idmutation: int, id: int) -> None:
         idpar = map.get('idpar')
         if not isinstance(idpar, str):
             raise ValueError("Missing or invalid 'idpar'")
@@ -76,28 +182,36 @@ class Mutation:
         adresses = map.get('adresses')
         if adresses is None:
             raise ValueError("Missing 'adresses'")
-        
-        adresse = Adresse.extract(adresses)
-        
-        return cls(
-            idg=id,
-            idpar=idpar,
-            idmutation=idmutation,
-            shared_props=shared_props,
-            adresse=adresse,
-            valeur_fonciere=valeurfonc,
-            vendu=vendu
+        if not isinstance(adresses, list) or len(adresses) == 0:
+            raise ValueError("Inconsistent value: Expected a non-empty list")
+        adresse = adresses[0]
+        if not isinstance(adresse, dict):
+            raise ValueError("Inconsistent value: Expected a dictionary")
+
+        unwrap = unwrap_value
+        self.append_row(
+            id, idpar, idmutation, shared_props,
+            unwrap(adresse.get('btq')), unwrap(adresse.get('voie')), unwrap(adresse.get('novoie')),
+            unwrap(adresse.get('codvoie')), unwrap(adresse.get('commune')), unwrap(adresse.get('typvoie')),
+            unwrap(adresse.get('codepostal')), valeurfonc, vendu
         )
 
-class Classes:
-    def __init__(self, idg: int, libelle: str, surface: float):
-        self.idg = idg
-        self.libelle = libelle
-        self.surface = surface
+    def last_datemut(self) -> Optional[str]:
+        return max(self.columns['datemut'], default=None)
+
+    def array(self, field: pa.Field) -> pa.Array:
+        if field.name == 'datemut':
+            return parse_dates(self.columns['datemut'])
+        return super().array(field)
 
-    @classmethod
-    def extract(cls, values: List[Any], id: int) -> List['Classes']:
-        results = []
+class ClassesBuilder(ColumnsBuilder):
+    def __init__(self):
+        super().__init__(CLASSES_SCHEMA)
+
+    def extract(self, values: List[Any], id: int) -> None:
+        idg = self.columns['idg']
+        libelles = self.columns['libelle']
+        surfaces = self.columns['surface']
         for value in values:
             if not isinstance(value, dict):
                 continue
@@ -105,113 +219,10 @@ class Classes:
             libelle = value.get('libregroupement')
             if (isinstance(surface, (int, float)) and surface >= 1.0 and
                 isinstance(libelle, str)):
-                results.append(cls(idg=id, libelle=libelle, surface=surface))
-        return results
-
-def parse_date(date_str: str) -> int:
-    base_date = datetime(1970, 1, 1)
-    try:
-        date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-    except ValueError:
-        return 0
-    return (date_obj - base_date).days
-
-def write_classes_to_parquet(data: List[Classes], path: str):
-    idg_vec = []
-    libelle_vec = []
-    surface_vec = []
-    
-    for class_obj in data:
-        idg_vec.append(class_obj.idg)
-        libelle_vec.append(class_obj.libelle)
-        surface_vec.append(class_obj.surface)
-    
-    schema = pa.schema([
-        pa.field('idg', pa.uint64(), False),
-        pa.field('libelle', pa.string(), False),
-        pa.field('surface', pa.float64(), False)
-    ])
-    
-    table = pa.Table.from_arrays([
-        pa.array(idg_vec, type=pa.uint64()),
-        pa.array(libelle_vec, type=pa.string()),
-        pa.array(surface_vec, type=pa.float64())
-    ], schema=schema)
-    
-    pq.write_table(table, path, compression='SNAPPY')
-
-def write_mutations_to_parquet(data: List[Mutation], path: str):
-    idg_vec = []
-    idpar_vec = []
-    idmutation_vec = []
-    vefa_vec = []
-    typologie_vec = []
-    datemut_vec = []
-    nature_vec = []
-    btq_vec = []
-    voie_vec = []
-    novoie_vec = []
-    codvoie_vec = []
-    commune_vec = []
-    typvoie_vec = []
-    codepostal_vec = []
-    valeur_fonciere_vec = []
-    vendu_vec = []
-    
-    for mutation in data:
-        idg_vec.append(mutation.idg)
-        idpar_vec.append(mutation.idpar)
-        idmutation_vec.append(mutation.idmutation)
-        vefa_vec.append(mutation.shared_props.vefa)
-        typologie_vec.append(mutation.shared_props.typologie)
-        datemut_vec.append(parse_date(mutation.shared_props.datemut))
-        nature_vec.append(mutation.shared_props.nature)
-        btq_vec.append(mutation.adresse.btq)
-        voie_vec.append(mutation.adresse.voie)
-        novoie_vec.append(mutation.adresse.novoie)
-        codvoie_vec.append(mutation.adresse.codvoie)
-        commune_vec.append(mutation.adresse.commune)
-        typvoie_vec.append(mutation.adresse.typvoie)
-        codepostal_vec.append(mutation.adresse.codepostal)
-        valeur_fonciere_vec.append(mutation.valeur_fonciere)
-        vendu_vec.append(mutation.vendu)
-    
-    schema = pa.schema([
-        pa.field('idg', pa.uint64(), False),
-        pa.field('idpar', pa.string(), False),
-        pa.field('idmutation', pa.uint64(), False),
-        pa.field('vefa', pa.bool_(), False),
-        pa.field('typologie', pa.string(), True),
-        pa.field('datemut', pa.date32(), False),
-        pa.field('nature', pa.string(), True),
-        pa.field('btq', pa.string(), True),
-        pa.field('voie', pa.string(), True),
-        pa.field('novoie', pa.string(), True),
-        pa.field('codvoie', pa.string(), True),
-        pa.field('commune', pa.string(), True),
-        pa.field('typvoie', pa.string(), True),
-        pa.field('codepostal', pa.string(), True),
-        pa.field('valeur_fonciere', pa.float64(), False),
-        pa.field('vendu', pa.bool_(), True)
-    ])
-    
-    table = pa.Table.from_arrays([
-        pa.array(idg_vec, type=pa.uint64()),
-        pa.array(idpar_vec, type=pa.string()),
-        pa.array(idmutation_vec, type=pa.uint64()),
-        pa.array(vefa_vec, type=pa.bool_()),
-        pa.array(typologie_vec, type=pa.string()),
-        pa.array(datemut_vec, type=pa.date32()),
-        pa.array(nature_vec, type=pa.string()),
-        pa.array(btq_vec, type=pa.string()),
-        pa.array(voie_vec, type=pa.string()),
-        pa.array(novoie_vec, type=pa.string()),
-        pa.array(codvoie_vec, type=pa.string()),
-        pa.array(commune_vec, type=pa.string()),
-        pa.array(typvoie_vec, type=pa.string()),
-        pa.array(codepostal_vec, type=pa.string()),
-        pa.array(valeur_fonciere_vec, type=pa.float64()),
-        pa.array(vendu_vec, type=pa.bool_())
-    ], schema=schema)
-    
-    pq.write_table(table, path, compression='SNAPPY')
\ No newline at end of file
+                idg.append(id)
+                libelles.append(self.intern(libelle))
+                surfaces.append(surface)
+
+def write_batch_to_parquet(batch: pa.RecordBatch, path: str, layout: ParquetLayout):
+    table = layout.sort(pa.Table.from_batches([batch]))
+    pq.write_table(table, path, **layout.writer_options(table.schema))
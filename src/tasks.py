@@ -1,13 +1,24 @@
 import extract_api_dvf
 import extract_duckdb
 import load
+import os
+from pathlib import Path
+from manifest import INCREMENTAL
 from utils import *
 
+# Loads the extracted files in DuckDB while the extraction is still running, 0 runs the task1 then the task2
+OVERLAP = os.environ.get("OVERLAP_DVFPLUS", "1") == "1"
+
 def task1() -> bool:
     try:
-        extract_api_dvf.main("data/FranceGeoJSON")
-        print("Successfully extract the Data from the API DVF+ !")
-        return True
+        match extract_api_dvf.main("data/FranceGeoJSON"):
+            case Ok(_):
+                print("Successfully extract the Data from the API DVF+ !")
+                return True
+            case Err(message):
+                logger.error(message)
+                print("Failed the Task1")
+                return False
     except Exception as error:
         logger.error(error)
         print("Failed the Task1")
@@ -22,6 +33,34 @@ def task2() -> bool:
         print("Failed the Task2")
         return False
 
+def task1_2() -> bool:
+    # The export runs once the extraction is done
+    try:
+        conn = extract_duckdb.open_database("db_temp.duckdb")
+        # The incremental runs never overwrite the files of the previous runs
+        ingester = extract_duckdb.Ingester(conn, Path("data/DVF/extracted"), preload=INCREMENTAL)
+        match extract_api_dvf.main("data/FranceGeoJSON", ingester.submit, ingester.append if ingester.arrow else None):
+            case Ok(_):
+                print("Successfully extract the Data from the API DVF+ !")
+            case Err(message):
+                # The rows committed before the failure are loaded, the warehouse exports them with the next run
+                ingester.stop()
+                logger.error(message)
+                print("Failed the Task1")
+                return False
+        match ingester.finish():
+            case Ok(files):
+                logger.info(f"Loaded {files} extracted files")
+                return True
+            case Err(message):
+                logger.error(message)
+                print("Failed the Task2")
+                return False
+    except Exception as error:
+        logger.error(error)
+        print("Failed the Task1")
+        return False
+
 def task3() -> bool:
     try:
         load.main()
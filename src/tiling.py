@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+from utils import *
+
+TILING_PATH = "data/DVF/tiling.json"
+SURFACE_PATH = "data/DVF/surface_limit.json"
+# Fraction of the smallest rejected surface used as tile size until a larger surface is accepted
+SURFACE_SHRINK = 0.5
+# Coordinates are rounded before hashing so the same outline always gets the same fingerprint
+FINGERPRINT_PRECISION = 7
+
+def fingerprint(geometry: dict) -> str:
+    def round_coordinates(value):
+        if isinstance(value, list):
+            return [round_coordinates(item) for item in value]
+        if isinstance(value, float):
+            return round(value, FINGERPRINT_PRECISION)
+        return value
+
+    payload = json.dumps(
+        [geometry.get('type'), round_coordinates(geometry.get('coordinates'))],
+        separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class TilingCache:
+    def __init__(self, path: str = TILING_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tilings: dict[str, list[dict]] = {}
+        # Set by put, the file is rewritten once by save at the end of the run
+        self.dirty = False
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fs:
+                self.tilings = json.load(fs)
+        except Exception as error:
+            logger.error(f"Failed to load the tiling cache {self.path} : {error}")
+
+    def save(self) -> None:
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, 'w') as fs:
+                    json.dump(self.tilings, fs)
+                os.replace(temp_path, self.path)
+                self.dirty = False
+            except Exception as error:
+                logger.error(f"Failed to save the tiling cache {self.path} : {error}")
+
+    def get(self, geometry: dict) -> Optional[list[dict]]:
+        with self.lock:
+            return self.tilings.get(fingerprint(geometry))
+
+    def put(self, geometry: dict, tiles: list[dict]) -> None:
+        with self.lock:
+            self.tilings[fingerprint(geometry)] = tiles
+            self.dirty = True
+
+    def forget(self, geometry: dict) -> None:
+        with self.lock:
+            if self.tilings.pop(fingerprint(geometry), None) is not None:
+                self.dirty = True
+
+class SurfaceLimit:
+    # Bounds of the maximum surface accepted by the API, in square meters of the local projection
+    def __init__(self, path: str = SURFACE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.max_accepted = 0.0
+        self.min_rejected: Optional[float] = None
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fs:
+                data = json.load(fs)
+            self.max_accepted = data.get('max_accepted', 0.0)
+            self.min_rejected = data.get('min_rejected')
+        except Exception as error:
+            logger.error(f"Failed to load the surface limit {self.path} : {error}")
+
+    def save(self) -> None:
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as fs:
+                json.dump({'max_accepted': self.max_accepted, 'min_rejected': self.min_rejected}, fs)
+            os.replace(temp_path, self.path)
+        except Exception as error:
+            logger.error(f"Failed to save the surface limit {self.path} : {error}")
+
+    def target(self) -> Optional[float]:
+        # Largest tile surface expected to be accepted, None while no geometry was rejected
+        with self.lock:
+            if self.min_rejected is None:
+                return None
+            if self.max_accepted < self.min_rejected:
+                return max(self.max_accepted, self.min_rejected * SURFACE_SHRINK)
+            return self.min_rejected * SURFACE_SHRINK
+
+    def accepted(self, area: float) -> None:
+        with self.lock:
+            if area > self.max_accepted and (self.min_rejected is None or area < self.min_rejected):
+                self.max_accepted = area
+                self.save()
+
+    def rejected(self, area: float, surface: str) -> None:
+        # The 403 reports the surface of the rejected geometry measured by the API, not its limit, and the bounds are
+        # compared with the geometry_area of the tiles, so only the local area is kept and the reported one is logged
+        with self.lock:
+            if self.min_rejected is None or area < self.min_rejected:
+                self.min_rejected = area
+                self.max_accepted = min(self.max_accepted, area)
+                logger.info(f"The API rejected a surface of {surface} ({area:.0f} m2 locally), new limit {area:.0f} m2")
+                self.save()
+
+TILING_CACHE = TilingCache()
+SURFACE_LIMIT = SurfaceLimit()
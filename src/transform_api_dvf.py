@@ -1,18 +1,235 @@
+import codecs
 import json
-from typing import List, Dict, Any, Optional, Tuple
-from tables import SharedMutationProps, Mutation, Classes
+import os
+import re
+from typing import List, Dict, Any, Optional, Tuple, Union, Iterable, Iterator
+from tables import SharedMutationProps, MutationsBuilder, ClassesBuilder, global_id
 from utils import *
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+# Backend used to decode each feature : 'json' finds the end of each feature while decoding it (fastest),
+# 'orjson' needs the end of each feature to be found by scanning first
+JSON_BACKEND = os.environ.get("JSON_BACKEND_DVFPLUS", "json")
+CHUNK_SIZE = 64 * 1024
+
+# A complete string, or a structural character. A lone '"' is the start of a string cut by the end of the buffer
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}"]')
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+SCALAR_END = re.compile(r'[,\]\s]')
+WHITESPACE = re.compile(r'\s*')
+DECODER = json.JSONDecoder()
+CUT_MARGIN = 64
+
+def loads(text: str) -> Any:
+    if JSON_BACKEND == "orjson" and orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def iter_chunks(data: Union[str, bytes], size: int = CHUNK_SIZE) -> Iterator[Union[str, bytes]]:
+    view = data if isinstance(data, str) else memoryview(data)
+    for start in range(0, len(view), size):
+        chunk = view[start:start + size]
+        yield chunk if isinstance(chunk, str) else chunk.tobytes()
+
+# Decode the items of the 'features' array of a response one at a time,
+# only the current feature is kept in memory
+class FeatureStream:
+    def __init__(self, chunks: Iterable[Union[str, bytes]]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+            text = chunk if isinstance(chunk, str) else self.decoder.decode(chunk)
+        except StopIteration:
+            self.eof = True
+            text = self.decoder.decode(b"", final=True)
+        except UnicodeDecodeError as error:
+            raise ValueError(f"Failed to convert the data content to JSON: {error}")
+        self.buffer += text
+        return True
+
+    def compact(self) -> None:
+        # Release the consumed content once it is larger than a chunk, to avoid copying the buffer for each feature
+        if self.pos >= CHUNK_SIZE:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+
+    def peek(self) -> Optional[str]:
+        # Skip the whitespaces and return the next character, None at the end of the content
+        while True:
+            whitespace = WHITESPACE.match(self.buffer, self.pos)
+            if whitespace is not None:
+                self.pos = whitespace.end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def truncated(self) -> ValueError:
+        return ValueError("Failed to convert the data content to JSON: Unexpected end of the content")
+
+    def find_features(self) -> None:
+        first = self.peek()
+        if first is None:
+            raise self.truncated()
+        if first != '{':
+            if first in '["-0123456789' or self.buffer.startswith(('true', 'false', 'null'), self.pos):
+                raise ValueError("Inconsistent value: Expected a dictionary")
+            raise ValueError(f"Failed to convert the data content to JSON: Unexpected character {first!r}")
+
+        depth = 0
+        while True:
+            token = TOKEN.search(self.buffer, self.pos)
+            if token is None or token.group() == '"':
+                if token is not None:
+                    self.pos = token.start()
+                else:
+                    self.pos = len(self.buffer)
+                if not self.fill():
+                    raise self.truncated()
+                continue
+
+            value = token.group()
+            self.pos = token.end()
+            if value == '"features"' and depth == 1:
+                if self.peek() == ':':
+                    self.pos += 1
+                    self.compact()
+                    return
+            elif value in '{[':
+                depth += 1
+            elif value in '}]':
+                depth -= 1
+                if depth == 0:
+                    raise ValueError("Failed to get the value of the key 'features'")
+
+    def container_end(self, scan: int, depth: int, opening: str, closing: str) -> Tuple[Optional[int], int, int]:
+        # Count the brackets between the strings at C speed, in valid JSON the other kind of
+        # bracket doesn't change where the container ends
+        buffer = self.buffer
+        while True:
+            quote = buffer.find('"', scan)
+            segment_end = quote if quote >= 0 else len(buffer)
+            closed = buffer.count(closing, scan, segment_end)
+            if closed >= depth:
+                # The container may end in this segment, find the exact position
+                for index in range(scan, segment_end):
+                    if buffer[index] == opening:
+                        depth += 1
+                    elif buffer[index] == closing:
+                        depth -= 1
+                        if depth == 0:
+                            return index + 1, index + 1, 0
+            else:
+                depth += buffer.count(opening, scan, segment_end) - closed
+
+            if quote < 0:
+                return None, len(buffer), depth
+            string_end = buffer.find('"', quote + 1)
+            if string_end >= 0 and buffer[string_end - 1] == '\\':
+                # Escaped quote, slow path
+                string = STRING.match(buffer, quote)
+                string_end = string.end() - 1 if string is not None else -1
+            if string_end < 0:
+                return None, quote, depth
+            scan = string_end + 1
+
+    def value_end(self) -> int:
+        # Index of the end of the JSON value starting at self.pos
+        start = self.buffer[self.pos]
+        scan = self.pos
+        depth = 0
+        while True:
+            if start in '{[':
+                end, scan, depth = self.container_end(scan, depth, start, '}' if start == '{' else ']')
+                if end is not None:
+                    return end
+            elif start == '"':
+                token = STRING.match(self.buffer, self.pos)
+                if token is not None:
+                    return token.end()
+            else:
+                token = SCALAR_END.search(self.buffer, self.pos)
+                if token is not None:
+                    return token.start()
+                if self.eof:
+                    return len(self.buffer)
+
+            if not self.fill():
+                raise self.truncated()
+
+    def __iter__(self) -> Iterator[Any]:
+        self.find_features()
+
+        if self.peek() != '[':
+            if self.peek() is None:
+                raise self.truncated()
+            raise ValueError("Inconsistent value: Expected a list")
+        self.pos += 1
+
+        first = True
+        while True:
+            character = self.peek()
+            if character is None:
+                raise self.truncated()
+            if character == ']':
+                return
+            if not first:
+                if character != ',':
+                    raise ValueError(f"Failed to convert the data content to JSON: Unexpected character {character!r}")
+                self.pos += 1
+                character = self.peek()
+                if character is None:
+                    raise self.truncated()
+            first = False
+
+            if JSON_BACKEND == "json" and character in '{[':
+                value = self.raw_decode()
+            else:
+                end = self.value_end()
+                text = self.buffer[self.pos:end]
+                self.pos = end
+                try:
+                    value = loads(text)
+                except ValueError as error:
+                    raise ValueError(f"Failed to convert the data content to JSON: {error}")
+            self.compact()
+            yield value
+
+    def raw_decode(self) -> Any:
+        # The C decoder finds the end of the value while decoding it, a value cut by the
+        # end of the buffer is decoded again once more content is read
+        while True:
+            try:
+                value, self.pos = DECODER.raw_decode(self.buffer, self.pos)
+                return value
+            except json.JSONDecodeError as error:
+                # A value cut in the middle of a literal or a number fails a few characters before the end
+                cut = error.pos >= len(self.buffer) - CUT_MARGIN or error.msg.startswith("Unterminated string")
+                if not cut:
+                    raise ValueError(f"Failed to convert the data content to JSON: {error}")
+                if not self.fill():
+                    raise self.truncated()
+
 def map_parcelles(
     parcelles: List[Dict[str, Any]],
     shared_props: SharedMutationProps,
     valeurfonc: float,
     idmutation: int,
-    idg: int,
-) -> Tuple[int, List[Mutation], List[Classes]]:
-    mutations = []
-    classes = []
-
+    mutations: MutationsBuilder,
+    classes: ClassesBuilder,
+) -> None:
     for parcelle in parcelles:
         if 'dcnt' not in parcelle:
             raise ValueError("Failed to get the value of the key 'dcnt'")
@@ -20,24 +237,21 @@ def map_parcelles(
         if not isinstance(dcnt, list):
             raise ValueError("Inconsistent value: Expected a list")
         
-        idg += 1
+        idpar = parcelle.get('idpar')
+        if not isinstance(idpar, str):
+            raise ValueError("Missing or invalid 'idpar'")
+        # Derived from the row itself, so it doesn't depend on the order of the extraction
+        idg = global_id(idmutation, idpar)
         
-        classes_rows = Classes.extract(dcnt, idg)
-        mutation_row = Mutation.extract(parcelle, shared_props, valeurfonc, idmutation, idg)
-        
-        classes.extend(classes_rows)
-        mutations.append(mutation_row)
-    
-    return idg, mutations, classes
+        classes.extract(dcnt, idg)
+        mutations.extract(parcelle, shared_props, valeurfonc, idmutation, idg)
 
 def map_dispositions(
     dispositions: List[Any],
     shared_props: SharedMutationProps,
-    idg: int,
-) -> Tuple[int, List[Mutation], List[Classes]]:
-    mutations = []
-    classes = []
-
+    mutations: MutationsBuilder,
+    classes: ClassesBuilder,
+) -> None:
     valid_dispositions = []
     for disposition in dispositions:
         if isinstance(disposition, dict):
@@ -67,27 +281,28 @@ def map_dispositions(
         if not isinstance(idmutation, int):
             raise ValueError("Inconsistent value: Expected an integer")
         
+        # A disposition with an invalid parcel is dropped as a whole
+        mutations_size = len(mutations)
+        classes_size = len(classes)
         try:
-            new_idg, muts, clas = map_parcelles(
+            map_parcelles(
                 valid_parcelles,
                 shared_props,
                 valeurfonc,
                 idmutation,
-                idg
+                mutations,
+                classes
             )
-
-            idg = new_idg
-            mutations.extend(muts)
-            classes.extend(clas)
         except Exception as error:
+            mutations.rollback(mutations_size)
+            classes.rollback(classes_size)
             logger.error(f"{error}")
 
-    return idg, mutations, classes
-
 def map_properties(
     properties: Dict[str, Any],
-    idg: int,
-) -> Tuple[int, List[Mutation], List[Classes]]:
+    mutations: MutationsBuilder,
+    classes: ClassesBuilder,
+) -> None:
     if 'vefa' not in properties:
         raise ValueError("Failed to get the value of the key 'vefa'")
     vefa = properties['vefa']
@@ -130,34 +345,20 @@ def map_properties(
     if not isinstance(dispositions, list):
         raise ValueError("Inconsistent value: Expected a list")
     
-    return map_dispositions(
+    map_dispositions(
         dispositions,
         shared_props,
-        idg
+        mutations,
+        classes
     )
 
-def transform_api_data(
-    data: str,
-    idg: int,
-) -> Tuple[int, List[Mutation], List[Classes]]:
-    mutations = []
-    classes = []
-
-    try:
-        value = json.loads(data)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Failed to convert the data content to JSON: {e}")
-    
-    if not isinstance(value, dict):
-        raise ValueError("Inconsistent value: Expected a dictionary")
-    
-    if 'features' not in value:
-        raise ValueError("Failed to get the value of the key 'features'")
-    features = value['features']
-    if not isinstance(features, list):
-        raise ValueError("Inconsistent value: Expected a list")
-    
-    for feature in features:
+def stream_api_data(
+    chunks: Iterable[Union[str, bytes]],
+    mutations: MutationsBuilder,
+    classes: ClassesBuilder,
+) -> Iterator[int]:
+    # Yields the number of rows of each feature
+    for feature in FeatureStream(chunks):
         if not isinstance(feature, dict):
             continue
         
@@ -167,13 +368,26 @@ def transform_api_data(
         if not isinstance(properties, dict):
             raise ValueError("Inconsistent value: Expected a dictionary")
         
+        # A feature with invalid properties is dropped as a whole
+        mutations_size = len(mutations)
+        classes_size = len(classes)
         try:
-            new_idg, muts, clas = map_properties(properties, idg)
-
-            idg = new_idg
-            mutations.extend(muts)
-            classes.extend(clas)
+            map_properties(properties, mutations, classes)
+            yield len(mutations) - mutations_size
         except Exception as error:
+            mutations.rollback(mutations_size)
+            classes.rollback(classes_size)
             logger.error(f"{error}")
+
+def transform_api_data(
+    data: Union[str, bytes],
+    mutations: Optional[MutationsBuilder] = None,
+    classes: Optional[ClassesBuilder] = None,
+) -> Tuple[MutationsBuilder, ClassesBuilder]:
+    mutations = mutations if mutations is not None else MutationsBuilder()
+    classes = classes if classes is not None else ClassesBuilder()
+
+    for _ in stream_api_data(iter_chunks(data), mutations, classes):
+        pass
     
-    return idg, mutations, classes
\ No newline at end of file
+    return mutations, classes
@@ -0,0 +1,59 @@
+import os
+import threading
+import requests
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from typing import Optional
+from utils import *
+
+# Number of keep-alive connections kept per host, should be >= the number of requests in flight
+POOL_SIZE = int(os.environ.get("POOL_SIZE_DVFPLUS", "8"))
+CHUNK_SIZE = 64 * 1024
+
+try:
+    # urllib3 decodes 'br' encoded responses only when a brotli module is available
+    import brotli
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+_session: Optional[Session] = None
+_session_lock = threading.Lock()
+
+def new_session(pool_size: int = POOL_SIZE) -> Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        pool_block=True
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        'Accept-Encoding': ACCEPT_ENCODING,
+        'Connection': 'keep-alive'
+    })
+    return session
+
+def get_session() -> Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = new_session()
+        return _session
+
+def post(url: str, headers: dict, params: dict, json: dict) -> Response:
+    return get_session().post(
+        url=url,
+        headers=headers,
+        params=params,
+        json=json,
+        stream=True
+    )
+
+def read_body(response: Response) -> bytes:
+    # Read the decoded body chunk by chunk and release the connection to the pool
+    try:
+        return b"".join(response.iter_content(chunk_size=CHUNK_SIZE))
+    finally:
+        response.close()
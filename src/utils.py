@@ -8,4 +8,7 @@ logger.add(
     compression="zip",
     level="DEBUG",
     format="[{time:YYYY-MM-DD HH:mm:ss}] [{file}:{line}] [{level}] : {message}"
-)
\ No newline at end of file
+)
+
+# Written next to the exported tables by the partitioned export, read by the load
+EXPORT_STATE_FILE = "export_state.json"
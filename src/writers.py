@@ -0,0 +1,147 @@
+import os
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from typing import List, Optional, Tuple
+from tables import MUTATIONS_SCHEMA, CLASSES_SCHEMA, MUTATIONS_LAYOUT, CLASSES_LAYOUT, ParquetLayout
+from utils import *
+
+# Rows per row group of the extracted files
+ROW_GROUP_SIZE = int(os.environ.get("ROW_GROUP_SIZE_DVFPLUS", "131072"))
+# Writes the extracted files, 0 only keeps them when the batches are loaded in process
+RAW_PARQUET = os.environ.get("RAW_PARQUET_DVFPLUS", "1") == "1"
+
+class ParquetSink:
+    # One open ParquetWriter on a temporary file, renamed to its final path once closed
+    def __init__(self, path: str, schema: pa.Schema, layout: ParquetLayout, row_group_size: int = ROW_GROUP_SIZE):
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.sorted_path = f"{path}.sorted.tmp"
+        self.schema = schema
+        self.layout = layout
+        self.row_group_size = row_group_size
+        self.writer: Optional[pq.ParquetWriter] = None
+        self.pending: List[pa.RecordBatch] = []
+        self.pending_rows = 0
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def write(self, batch: pa.RecordBatch) -> None:
+        if batch.num_rows == 0:
+            return
+        with self.lock:
+            self.pending.append(batch)
+            self.pending_rows += batch.num_rows
+            while self.pending_rows >= self.row_group_size:
+                self.flush(self.row_group_size)
+
+    def flush(self, rows: Optional[int] = None) -> None:
+        table = pa.Table.from_batches(self.pending, schema=self.schema)
+        rows = table.num_rows if rows is None else rows
+        group = table.slice(0, rows)
+        rest = table.slice(rows)
+        self.pending = rest.to_batches()
+        self.pending_rows = rest.num_rows
+
+        if self.writer is None:
+            self.writer = self.open()
+        self.writer.write_table(self.layout.sort(group), row_group_size=rows)
+        self.rows += rows
+
+    def open(self) -> pq.ParquetWriter:
+        return pq.ParquetWriter(self.temp_path, self.schema, **self.layout.writer_options(self.schema))
+
+    def has_rows(self) -> bool:
+        with self.lock:
+            return self.rows + self.pending_rows > 0
+
+    def close(self, keep_empty: bool = False) -> Optional[str]:
+        # Returns the path of the file, None when no row was written and the empty file isn't kept
+        with self.lock:
+            if self.pending_rows > 0:
+                self.flush()
+            if self.writer is None:
+                if not keep_empty:
+                    return None
+                self.writer = self.open()
+            self.writer.close()
+            self.writer = None
+            self.sort_file()
+            os.replace(self.temp_path, self.path)
+            return self.path
+
+    def sort_file(self) -> None:
+        # The row groups are only sorted when flushed, the file is rewritten once so their statistics don't overlap
+        # It holds the rows of a department in memory at its commit, the streamed writes don't
+        if not self.layout.sort_by or pq.ParquetFile(self.temp_path).metadata.num_row_groups < 2:
+            return
+        table = self.layout.sort(pq.read_table(self.temp_path, schema=self.schema))
+        pq.write_table(table, self.sorted_path, row_group_size=self.row_group_size, **self.layout.writer_options(self.schema))
+        os.replace(self.sorted_path, self.temp_path)
+
+    def abort(self) -> None:
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            for path in (self.temp_path, self.sorted_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+class DepartmentWriter:
+    # The mutations and classes files of a department, closed once all its features are done
+    def __init__(self, folder: str, name: str, features: int, row_group_size: int = ROW_GROUP_SIZE, archive: bool = RAW_PARQUET):
+        self.name = name
+        # Without archive nothing is written, the close then commits no file
+        self.archive = archive
+        self.mutations = ParquetSink(os.path.join(folder, f"mutations_{name}.parquet"), MUTATIONS_SCHEMA, MUTATIONS_LAYOUT, row_group_size)
+        self.classes = ParquetSink(os.path.join(folder, f"classes_{name}.parquet"), CLASSES_SCHEMA, CLASSES_LAYOUT, row_group_size)
+        self.remaining = features
+        # Features fully extracted, only recorded once the files are committed
+        self.completed: list[tuple] = []
+        # idg already written, the overlapping tiles and features return the same rows
+        self.written: set[int] = set()
+        # Set when a write failed, the files are then never committed
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def write(self, mutations: pa.RecordBatch, classes: pa.RecordBatch) -> Tuple[pa.RecordBatch, pa.RecordBatch]:
+        # Returns the rows not written yet
+        with self.lock:
+            new = {idg for idg in mutations.column('idg').to_pylist() if idg not in self.written}
+            self.written.update(new)
+        if len(new) < mutations.num_rows:
+            values = pa.array(list(new), pa.uint64())
+            mutations = mutations.filter(pc.is_in(mutations.column('idg'), value_set=values))
+            classes = classes.filter(pc.is_in(classes.column('idg'), value_set=values))
+        if self.archive:
+            self.mutations.write(mutations)
+            self.classes.write(classes)
+        return mutations, classes
+
+    def fail(self, message: str) -> None:
+        with self.lock:
+            self.error = self.error or message
+
+    def feature_done(self, completion: Optional[tuple] = None) -> bool:
+        # Returns True for the last feature of the department
+        with self.lock:
+            if completion is not None:
+                self.completed.append(completion)
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def close(self) -> Result[Optional[str], str]:
+        if self.error is not None:
+            self.mutations.abort()
+            self.classes.abort()
+            return Err(f"Failed to write the files of {self.name} : {self.error}")
+        try:
+            # The classes are committed first, a visible mutations file always has its classes file
+            self.classes.close(keep_empty=self.mutations.has_rows())
+            return Ok(self.mutations.close())
+        except Exception as error:
+            self.mutations.abort()
+            self.classes.abort()
+            return Err(f"Failed to commit the files of {self.name} : {error}")
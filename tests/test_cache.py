@@ -0,0 +1,57 @@
+import gzip
+import os
+
+import extract_api_dvf
+from cache import CACHE_MISS, ResponseCache, cache_key
+from extract_api_dvf import api_post, is_retriable
+
+def disk_size(cache):
+    return sum(entry.stat().st_size for entry in cache.entries())
+
+def test_entries_are_gzipped_with_their_status(tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 ** 2)
+    cache.put("ab12", 403, b'{"message":"Surface 2 km2 du GeoJSON trop grande"}')
+    assert cache.get("ab12") == (403, b'{"message":"Surface 2 km2 du GeoJSON trop grande"}')
+    with open(cache.path("ab12"), 'rb') as fs:
+        assert gzip.decompress(fs.read()).startswith(b"403\n")
+    assert cache.get("cd34") is None
+
+def test_overwrite_counts_the_entry_once(tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 ** 2)
+    cache.put("ab12", 200, os.urandom(1000))
+    cache.put("ab12", 200, os.urandom(2000))
+    cache.put("ab12", 200, os.urandom(500))
+    assert cache.size == disk_size(cache)
+    assert cache.get("ab12")[0] == 200
+
+def test_eviction_removes_the_least_recently_used_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path), 2500)
+    cache.put("aa", 200, os.urandom(1000))
+    cache.put("bb", 200, os.urandom(1000))
+    os.utime(cache.path("aa"), (1, 1))
+    os.utime(cache.path("bb"), (2, 2))
+    # Read last, aa is kept over bb
+    cache.get("aa")
+
+    cache.put("cc", 200, os.urandom(1000))
+    assert cache.get("bb") is None
+    assert cache.get("aa") is not None and cache.get("cc") is not None
+    assert cache.size == disk_size(cache) <= 2500
+
+def no_call(**kwargs):
+    raise AssertionError("The API was called")
+
+def test_replay_serves_the_cache_and_never_calls_the_api(monkeypatch, tmp_path):
+    cache = ResponseCache(str(tmp_path), 1024 ** 2)
+    monkeypatch.setattr(extract_api_dvf, "CACHE", cache)
+    monkeypatch.setattr(extract_api_dvf, "REPLAY_DVFPLUS", True)
+    monkeypatch.setattr(extract_api_dvf.transport, "post", no_call)
+    data = {"geojson": {"type": "Polygon", "coordinates": []}}
+    cache.put(cache_key("mutation/search", data, extract_api_dvf.FILTERS), 200, b'{"features":[]}')
+
+    assert api_post(endpoint="mutation/search", data=data).ok() == b'{"features":[]}'
+
+    # A miss is never retried, the replay would miss again
+    message = api_post(endpoint="mutation/search", data={"geojson": None}).err()
+    assert message.startswith(CACHE_MISS)
+    assert not is_retriable(message)
@@ -0,0 +1,74 @@
+import glob
+import json
+import os
+
+import pyarrow.parquet as pq
+
+import extract_api_dvf
+import simulator
+from extract_api_dvf import set_up
+from rate_limiter import RateScheduler
+from result import Ok
+from simulator import SimulatorConfig
+from synthetic import SyntheticConfig
+from tiling import SurfaceLimit, TilingCache
+
+def test_full_run_removes_the_retry_files_of_the_previous_runs(monkeypatch, tmp_path):
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    for name in ("mutations_1.parquet", "classes_1.parquet", "mutations_retry0_20240101000000.parquet", "classes_retry0_20240101000000.parquet"):
+        (extracted / name).touch()
+    monkeypatch.setattr(extract_api_dvf, "TARGET_FOLDER", str(extracted))
+
+    monkeypatch.setattr(extract_api_dvf, "INCREMENTAL", True)
+    assert isinstance(set_up(str(tmp_path)), Ok)
+    assert len(list(extracted.iterdir())) == 4
+
+    monkeypatch.setattr(extract_api_dvf, "INCREMENTAL", False)
+    assert isinstance(set_up(str(tmp_path)), Ok)
+    assert sorted(path.name for path in extracted.iterdir()) == ["classes_1.parquet", "mutations_1.parquet"]
+
+def write_departments(folder):
+    # Squares of about 55 km2, more than twice the surface accepted by the simulator
+    folder.mkdir()
+    for index in range(2):
+        x = 2.0 + index * 0.2
+        squares = [[[x, y], [x + 0.08, y], [x + 0.08, y + 0.08], [x, y + 0.08], [x, y]] for y in (45.0, 45.1, 45.2)]
+        with open(folder / f"{index:02d}.json", 'w') as fs:
+            json.dump({"features": [{"geometry": {"type": "Polygon", "coordinates": [square]}} for square in squares]}, fs)
+
+def extract(monkeypatch, folder, config):
+    # Runs the extraction in folder against a simulator, returns the extracted idg and the statuses served
+    server, sim = simulator.start(config)
+    scheduler = RateScheduler(1000.0, max_rate=1000.0)
+    monkeypatch.setattr(scheduler, "backoff", lambda attempt: 0.0)
+    monkeypatch.setattr(extract_api_dvf, "API_URL_DVFPLUS", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(extract_api_dvf, "CACHE", None)
+    monkeypatch.setattr(extract_api_dvf, "SCHEDULER", scheduler)
+    monkeypatch.setattr(extract_api_dvf, "TILING_CACHE", TilingCache(str(folder / "tiling.json")))
+    monkeypatch.setattr(extract_api_dvf, "SURFACE_LIMIT", SurfaceLimit(str(folder / "surface_limit.json")))
+    monkeypatch.chdir(folder)
+    write_departments(folder / "departments")
+    try:
+        assert isinstance(extract_api_dvf.main(str(folder / "departments")), Ok)
+    finally:
+        server.shutdown()
+    mutations = pq.read_table(sorted(glob.glob(f"{extract_api_dvf.TARGET_FOLDER}/mutations_*.parquet")))
+    return mutations.column("idg").to_pylist(), sim.stats
+
+def test_extraction_splits_and_retries_against_the_simulator(monkeypatch, tmp_path):
+    synthetic = SyntheticConfig(dispositions=1)
+    (tmp_path / "reference").mkdir()
+    (tmp_path / "faulty").mkdir()
+    # Every geometry accepted at once and no failure
+    expected, stats = extract(monkeypatch, tmp_path / "reference", SimulatorConfig(max_area=1e12, density=2.0, seed=3, synthetic=synthetic))
+    assert set(stats) == {"200"}
+    assert len(expected) > 0
+
+    # The same mutations once the too large geometries are split and the 402 and 501 retried
+    config = SimulatorConfig(max_area=25e6, quota_probability=0.25, error_probability=0.25, density=2.0, seed=3, synthetic=synthetic)
+    idg, stats = extract(monkeypatch, tmp_path / "faulty", config)
+    assert stats["403"] > 0 and stats["402"] > 0 and stats["501"] > 0
+    assert len(idg) == len(set(idg))
+    assert set(idg) == set(expected)
+    assert not os.path.exists(tmp_path / "faulty" / extract_api_dvf.DEFERRED_PATH)
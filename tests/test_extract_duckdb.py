@@ -0,0 +1,227 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import duckdb
+import pytest
+from result import Ok
+
+import extract_duckdb
+from extract_duckdb import (
+    Ingester, affected_partitions, append_batches, bulk_load, export, export_partitioned, init_database, load_export_state,
+    merge_files, partition_path
+)
+from metrics import METRICS
+from tables import CLASSES_LAYOUT, MUTATIONS_LAYOUT, ClassesBuilder, MutationsBuilder, SharedMutationProps, write_batch_to_parquet
+
+ROOT = Path(__file__).resolve().parent.parent
+
+@pytest.fixture
+def conn(monkeypatch):
+    # The scripts of the databases folder are read relatively to the root of the repository
+    monkeypatch.chdir(ROOT)
+    conn = duckdb.connect()
+    init_database(conn, reset=False)
+    yield conn
+    conn.close()
+
+def build_batches(rows):
+    # rows: (idg, idpar, datemut, valeur_fonciere, [(libelle, surface)])
+    mutations = MutationsBuilder()
+    classes = ClassesBuilder()
+    for idg, idpar, datemut, valeur_fonciere, dcnt in rows:
+        shared_props = SharedMutationProps(vefa=False, typologie="Maison", datemut=datemut, nature="Vente")
+        adresses = [{"commune": "Paris", "codepostal": f"{idpar[:2]}000"}]
+        mutations.extract({"idpar": idpar, "parcvendue": True, "adresses": adresses}, shared_props, valeur_fonciere, idg, idg)
+        classes.extract([{"libregroupement": libelle, "surface": surface} for libelle, surface in dcnt], idg)
+    return mutations.to_batch(), classes.to_batch()
+
+def write_files(folder, name, rows):
+    mutations, classes = build_batches(rows)
+    paths = (str(folder / f"mutations_{name}.parquet"), str(folder / f"classes_{name}.parquet"))
+    write_batch_to_parquet(mutations, paths[0], MUTATIONS_LAYOUT)
+    write_batch_to_parquet(classes, paths[1], CLASSES_LAYOUT)
+    return paths
+
+def table(conn, query):
+    return conn.execute(query).fetchall()
+
+ROWS = [
+    (1, "75101000AB0001", "2020-01-10", 100000.0, [("Sols", 100.0)]),
+    (2, "75101000AB0002", "2020-02-10", 200000.0, [("Sols", 200.0)]),
+    (3, "13101000AB0003", "2021-03-10", 300000.0, [("Sols", 300.0), ("Jardins", 30.0)]),
+]
+
+def test_merge_replaces_the_changed_rows_only(conn, tmp_path):
+    assert merge_files(conn, [write_files(tmp_path, "1", ROWS)]) == 3
+    conn.execute("DELETE FROM AffectedPartitions")
+
+    # The same rows change nothing
+    assert merge_files(conn, [write_files(tmp_path, "2", ROWS)]) == 0
+    assert affected_partitions(conn) == set()
+
+    changed = [
+        ROWS[0],
+        (2, "75101000AB0002", "2020-02-10", 210000.0, [("Sols", 200.0)]),
+        (3, "13101000AB0003", "2021-03-10", 300000.0, [("Sols", 300.0)]),
+        (4, "69101000AB0004", "2022-04-10", 400000.0, [("Bois", 40.0)]),
+    ]
+    assert merge_files(conn, [write_files(tmp_path, "3", changed)]) == 3
+    assert table(conn, "SELECT idg, valeur_fonciere FROM mutations ORDER BY idg") == [
+        (1, 100000), (2, 210000), (3, 300000), (4, 400000)
+    ]
+    assert table(conn, "SELECT idg, libelle, surface FROM classes ORDER BY idg, libelle") == [
+        (1, "Sols", 100), (2, "Sols", 200), (3, "Sols", 300), (4, "Bois", 40)
+    ]
+    assert affected_partitions(conn) == {(2020, "75"), (2021, "13"), (2022, "69")}
+
+def test_merge_compares_the_duplicated_classes(conn, tmp_path):
+    merge_files(conn, [write_files(tmp_path, "1", ROWS)])
+    # Only the number of identical classes differs
+    duplicated = [ROWS[0], ROWS[1], (3, "13101000AB0003", "2021-03-10", 300000.0, [("Sols", 300.0), ("Jardins", 30.0), ("Jardins", 30.0)])]
+    assert merge_files(conn, [write_files(tmp_path, "2", duplicated)]) == 1
+    assert table(conn, "SELECT count(*) FROM classes WHERE idg = 3") == [(3,)]
+
+def test_merge_takes_the_rows_of_the_first_file(conn, tmp_path):
+    first = write_files(tmp_path, "1", ROWS[:1])
+    second = write_files(tmp_path, "2", [(1, "75101000AB0001", "2020-01-10", 999999.0, [("Bois", 1.0)])])
+    assert merge_files(conn, [second, first]) == 1
+    assert table(conn, "SELECT valeur_fonciere FROM mutations") == [(100000,)]
+    assert table(conn, "SELECT libelle FROM classes") == [("Sols",)]
+
+def test_bulk_load_skips_the_merged_files(conn, tmp_path):
+    files = [write_files(tmp_path, "1", ROWS)]
+    assert bulk_load(conn, files, upsert=True) == 3
+    assert bulk_load(conn, files, upsert=True) == 0
+
+    # A rewritten file is merged again
+    files = [write_files(tmp_path, "1", [(1, "75101000AB0001", "2020-01-10", 150000.0, [("Sols", 100.0)])])]
+    os.utime(files[0][0], (1, 1))
+    assert bulk_load(conn, files, upsert=True) == 1
+    assert table(conn, "SELECT valeur_fonciere FROM mutations WHERE idg = 1") == [(150000,)]
+
+def test_insert_counts_the_dropped_duplicates(conn, tmp_path):
+    before = METRICS.duplicates.value()
+    first = write_files(tmp_path, "1", ROWS[:2])
+    second = write_files(tmp_path, "2", [(2, "75101000AB0002", "2020-02-10", 999999.0, [("Bois", 1.0)]), ROWS[2]])
+    assert bulk_load(conn, [second, first], upsert=False) == 3
+    assert table(conn, "SELECT valeur_fonciere FROM mutations WHERE idg = 2") == [(200000,)]
+    assert table(conn, "SELECT libelle FROM classes WHERE idg = 2") == [("Sols",)]
+    assert METRICS.duplicates.value() - before == 1
+
+    # The idg loaded by a previous load are dropped too
+    assert bulk_load(conn, [write_files(tmp_path, "3", ROWS)], upsert=False) == 0
+    assert METRICS.duplicates.value() - before == 4
+
+def test_export_after_a_stopped_run_keeps_the_merged_partitions(monkeypatch, tmp_path):
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(extract_duckdb, "EXPORT_MODE", "partitioned")
+    database = str(tmp_path / "warehouse.duckdb")
+    target = tmp_path / "DVF"
+
+    def run(rows, name, exported=True):
+        conn = duckdb.connect(database)
+        init_database(conn, reset=False)
+        files = [write_files(tmp_path, name, rows)]
+        bulk_load(conn, files, upsert=True)
+        if exported:
+            export(conn, target, files, time.time(), upsert=True)
+        conn.close()
+
+    run(ROWS, "1")
+    # Stops after its merge, before its export
+    run([ROWS[0], ROWS[1], (3, "13101000AB0003", "2021-03-10", 350000.0, [("Sols", 300.0)])], "1", exported=False)
+    # The file is already merged, the next run still exports the partition it changed
+    run([], "2")
+    partition = extract_duckdb.partition_path(target, "mutations", 2021, "13")
+    assert table(duckdb.connect(), f"SELECT valeur_fonciere FROM read_parquet('{partition}/*.parquet')") == [(350000,)]
+    conn = duckdb.connect(database)
+    assert affected_partitions(conn) == set()
+    conn.close()
+
+def partition_rows(folder, table_name, annee, departement, column):
+    path = partition_path(folder, table_name, annee, departement)
+    return sorted(table(duckdb.connect(), f"SELECT {column} FROM read_parquet('{path}/*.parquet')"))
+
+def test_partitioned_export_rewrites_the_changed_partitions_only(conn, tmp_path):
+    bulk_load(conn, [write_files(tmp_path, "1", ROWS)], upsert=False)
+    export_partitioned(conn, tmp_path)
+    assert partition_rows(tmp_path, "mutations", 2020, "75", "idg") == [(1,), (2,)]
+    assert partition_rows(tmp_path, "classes", 2021, "13", "libelle") == [("Jardins",), ("Sols",)]
+
+    # Kept as long as its partition isn't rewritten
+    marker = partition_path(tmp_path, "mutations", 2020, "75") / "marker"
+    marker.touch()
+    conn.execute("UPDATE mutations SET valeur_fonciere = 350000 WHERE idg = 3")
+    conn.execute("DELETE FROM classes WHERE idg = 2")
+    conn.execute("DELETE FROM mutations WHERE idg = 2")
+    export_partitioned(conn, tmp_path, {(2021, "13")})
+    assert marker.exists()
+    assert partition_rows(tmp_path, "mutations", 2021, "13", "valeur_fonciere") == [(350000,)]
+
+    # A changed partition without rows is removed
+    conn.execute("DELETE FROM classes")
+    conn.execute("DELETE FROM mutations WHERE idg = 3")
+    export_partitioned(conn, tmp_path, {(2021, "13")})
+    assert not partition_path(tmp_path, "mutations", 2021, "13").exists()
+    assert not partition_path(tmp_path, "classes", 2021, "13").exists()
+
+def test_changed_only_export_follows_the_new_files(conn, monkeypatch, tmp_path):
+    monkeypatch.setattr(extract_duckdb, "EXPORT_MODE", "partitioned")
+    monkeypatch.setattr(extract_duckdb, "EXPORT_CHANGED_ONLY", True)
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    files = [write_files(extracted, "1", ROWS)]
+    bulk_load(conn, files, upsert=False)
+    export(conn, tmp_path, files, time.time(), upsert=False)
+    exported_at = load_export_state(tmp_path)
+    assert exported_at is not None
+
+    marker = partition_path(tmp_path, "mutations", 2020, "75") / "marker"
+    marker.touch()
+    files.append(write_files(extracted, "2", [(4, "69101000AB0004", "2022-04-10", 400000.0, [("Bois", 40.0)])]))
+    os.utime(files[1][0], (exported_at + 1, exported_at + 1))
+    bulk_load(conn, files[1:], upsert=False)
+    export(conn, tmp_path, files, exported_at + 2, upsert=False)
+    assert marker.exists()
+    assert partition_rows(tmp_path, "mutations", 2022, "69", "idg") == [(4,)]
+    with open(tmp_path / extract_duckdb.EXPORT_STATE_FILE, 'r') as fs:
+        assert json.load(fs) == {"exported_at": exported_at + 2, "partitions": [[2022, "69"]]}
+
+def test_append_batches_keeps_the_first_batch_of_an_idg(conn):
+    first = build_batches(ROWS[:2])
+    second = build_batches([(2, "75101000AB0002", "2020-02-10", 999999.0, [("Bois", 1.0)]), (4, "69101000AB0004", "2022-04-10", 400000.0, [])])
+    assert append_batches(conn, [first, second], upsert=False) == {(2020, "75"), (2022, "69")}
+    assert table(conn, "SELECT idg, valeur_fonciere FROM mutations ORDER BY idg") == [(1, 100000), (2, 200000), (4, 400000)]
+    assert table(conn, "SELECT idg, libelle FROM classes ORDER BY idg") == [(1, "Sols"), (2, "Sols")]
+
+def test_ingester_loads_the_rows_while_they_are_extracted(conn, tmp_path):
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    # Committed by a previous run, only loaded by finish
+    write_files(extracted, "0", [(5, "33101000AB0005", "2019-05-10", 500000.0, [("Sols", 50.0)])])
+    ingester = Ingester(conn, extracted, arrow=False)
+    ingester.submit(*write_files(extracted, "1", ROWS[:2]))
+    ingester.submit(*write_files(extracted, "2", ROWS[1:]))
+    assert ingester.finish() == Ok(3)
+    assert table(conn, "SELECT idg FROM mutations ORDER BY idg") == [(1,), (2,), (3,), (5,)]
+    assert table(duckdb.connect(), f"SELECT count(*) FROM read_parquet('{tmp_path / 'mutations.parquet'}')") == [(4,)]
+
+def test_ingester_appends_the_arrow_batches(conn, tmp_path):
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    ingester = Ingester(conn, extracted, arrow=True)
+    ingester.append(*build_batches(ROWS))
+    # The archive of the batches isn't loaded again
+    ingester.submit(*write_files(extracted, "1", ROWS))
+    assert ingester.finish() == Ok(1)
+    assert table(conn, "SELECT count(*) FROM mutations") == [(3,)]
+    assert table(conn, "SELECT count(*) FROM classes") == [(4,)]
+
+def test_ingester_reports_a_failed_load(conn, tmp_path):
+    extracted = tmp_path / "extracted"
+    extracted.mkdir()
+    ingester = Ingester(conn, extracted, arrow=False)
+    ingester.submit(str(extracted / "mutations_missing.parquet"), str(extracted / "classes_missing.parquet"))
+    assert ingester.finish().is_err()
@@ -0,0 +1,167 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from geometry import clip_polygon, clip_polygons, clip_ring, geometry_area, ring_area, split_geometry, split_into_tiles
+
+SIDES = [('x', 'left'), ('x', 'right'), ('y', 'bottom'), ('y', 'top')]
+
+def scalar_clip(polygon, split_value, axis, side):
+    # Sutherland-Hodgman one point at a time, the clipping before the vectorization
+    def inside(point):
+        value = point[0] if axis == 'x' else point[1]
+        return value <= split_value if side in ('left', 'bottom') else value >= split_value
+
+    def intersection(s, p):
+        if axis == 'x':
+            t = (split_value - s[0]) / (p[0] - s[0])
+            return [split_value, s[1] + t * (p[1] - s[1])]
+        t = (split_value - s[1]) / (p[1] - s[1])
+        return [s[0] + t * (p[0] - s[0]), split_value]
+
+    result = []
+    point_s = polygon[-1]
+    for point in polygon:
+        if inside(point):
+            if not inside(point_s):
+                result.append(intersection(point_s, point))
+            result.append(point)
+        elif inside(point_s):
+            result.append(intersection(point_s, point))
+        point_s = point
+    if result and result[0] != result[-1]:
+        result.append(result[0])
+    return result
+
+def random_ring(rng, vertices):
+    # Star shaped around (2, 45), concave for most of the seeds
+    ring = []
+    for index in range(vertices):
+        angle = 2 * math.pi * index / vertices
+        distance = rng.uniform(0.2, 1.0)
+        ring.append([2 + distance * math.cos(angle), 45 + distance * math.sin(angle)])
+    ring.append(ring[0])
+    return ring
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("axis, side", SIDES)
+def test_clip_ring_matches_the_scalar_clipping(seed, axis, side):
+    rng = random.Random(seed)
+    ring = random_ring(rng, rng.randrange(3, 64))
+    center = 2 if axis == 'x' else 45
+    for split_value in (center + rng.uniform(-0.9, 0.9), center, center - 2, center + 2):
+        expected = scalar_clip(ring, split_value, axis, side)
+        clipped = clip_ring(np.asarray(ring, dtype=float), split_value, axis, side)
+        assert clipped.shape == (len(expected), 2) if expected else len(clipped) == 0
+        if expected:
+            np.testing.assert_allclose(clipped, expected)
+
+@pytest.mark.parametrize("axis, side", SIDES)
+def test_clip_ring_with_vertices_on_the_line(axis, side):
+    square = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.0, 0.0]]
+    for split_value in (0.0, 0.5, 1.0):
+        expected = scalar_clip(square, split_value, axis, side)
+        np.testing.assert_allclose(clip_ring(np.asarray(square), split_value, axis, side), np.asarray(expected).reshape(-1, 2))
+
+def test_clip_polygon_rejects_an_empty_result():
+    square = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.0, 0.0]]
+    assert clip_polygon(square, 0.5, 'x', 'left') == [[[0.0, 0.0], [0.5, 0.0], [0.5, 1.0], [0.0, 1.0], [0.0, 0.0]]]
+    with pytest.raises(ValueError):
+        clip_polygon(square, 2.0, 'x', 'right')
+
+def is_simple(ring):
+    # No two edges of the ring cross or touch, except the consecutive ones at their shared point
+    edges = list(zip(ring[:-1], ring[1:]))
+
+    def orientation(a, b, c):
+        return np.sign((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]))
+
+    def on_segment(a, b, c):
+        return min(a[0], b[0]) <= c[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= c[1] <= max(a[1], b[1])
+
+    def intersect(a, b, c, d):
+        o1, o2, o3, o4 = orientation(a, b, c), orientation(a, b, d), orientation(c, d, a), orientation(c, d, b)
+        if o1 != o2 and o3 != o4:
+            return True
+        return any(o == 0 and on_segment(p, q, r) for o, p, q, r in ((o1, a, b, c), (o2, a, b, d), (o3, c, d, a), (o4, c, d, b)))
+
+    for i in range(len(edges)):
+        for j in range(i + 1, len(edges)):
+            if j == i + 1 or (i == 0 and j == len(edges) - 1):
+                continue
+            if intersect(*edges[i], *edges[j]):
+                return False
+    return True
+
+SQUARE = np.array([[0.0, 0.0], [6.0, 0.0], [6.0, 6.0], [0.0, 6.0], [0.0, 0.0]])
+
+@pytest.mark.parametrize("axis, side", SIDES)
+def test_hole_crossed_by_the_line_opens_on_the_cut(axis, side):
+    hole = np.array([[2.0, 2.0], [2.0, 4.0], [4.0, 4.0], [4.0, 2.0], [2.0, 2.0]])
+    clipped = clip_polygons([[SQUARE, hole]], 3.0, axis, side)
+    assert len(clipped) == 1 and len(clipped[0]) == 1
+    assert ring_area(clipped[0][0]) == pytest.approx(18 - 2)
+    assert is_simple(clipped[0][0].tolist())
+
+def test_hole_crossed_twice_by_the_line():
+    # U shaped, its two arms cross the line
+    hole = np.array([[1.0, 1.0], [5.0, 1.0], [5.0, 5.0], [4.0, 5.0], [4.0, 2.0], [2.0, 2.0], [2.0, 5.0], [1.0, 5.0], [1.0, 1.0]])
+    top = clip_polygons([[SQUARE, hole]], 3.0, 'y', 'top')
+    assert [len(rings) for rings in top] == [1]
+    assert ring_area(top[0][0]) == pytest.approx(18 - 4)
+
+    # Between the arms and the line, an island apart from the rest of the polygon
+    bottom = clip_polygons([[SQUARE, hole]], 3.0, 'y', 'bottom')
+    assert [len(rings) for rings in bottom] == [1, 1]
+    assert ring_area(bottom[0][0]) == pytest.approx(18 - 8)
+    assert ring_area(bottom[1][0]) == pytest.approx(2)
+    assert all(is_simple(rings[0].tolist()) for rings in top + bottom)
+
+def test_hole_away_from_the_line_is_kept():
+    hole = np.array([[1.0, 1.0], [1.0, 2.0], [2.0, 2.0], [2.0, 1.0], [1.0, 1.0]])
+    clipped = clip_polygons([[SQUARE, hole]], 3.0, 'x', 'left')
+    assert len(clipped[0]) == 2
+    np.testing.assert_array_equal(clipped[0][1], hole)
+
+def random_hole(rng, vertices):
+    # Clockwise around (2, 45), inside the exterior of random_ring when it has 8 vertices or more
+    ring = []
+    for index in range(vertices):
+        angle = -2 * math.pi * index / vertices
+        distance = rng.uniform(0.02, 0.13)
+        ring.append([2 + distance * math.cos(angle), 45 + distance * math.sin(angle)])
+    ring.append(ring[0])
+    return np.asarray(ring)
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("axis, sides", [('x', ('left', 'right')), ('y', ('bottom', 'top'))])
+def test_clip_polygons_through_a_hole_keeps_the_area(seed, axis, sides):
+    rng = random.Random(seed)
+    exterior = np.asarray(random_ring(rng, rng.randrange(8, 32)))
+    hole = random_hole(rng, rng.randrange(4, 12))
+    values = hole[:-1, 0 if axis == 'x' else 1]
+    # Through the hole and through one of its vertices, the line touches the hole there
+    for split_value in (rng.uniform(values.min(), values.max()), sorted(values)[len(values) // 2]):
+        parts = [rings for side in sides for rings in clip_polygons([[exterior, hole]], split_value, axis, side)]
+        area = sum(ring_area(rings[0]) - sum(ring_area(ring) for ring in rings[1:]) for rings in parts)
+        assert area == pytest.approx(ring_area(exterior) - ring_area(hole), rel=1e-9)
+        assert all(is_simple(rings[0].tolist()) for rings in parts)
+
+# Each geometry is projected around its own latitude, the areas of the parts only add up approximately
+def test_split_geometry_keeps_the_area():
+    rng = random.Random(1)
+    exterior = random_ring(rng, 40)
+    hole = [[2 + 0.1 * x, 45 + 0.1 * y] for x, y in [(-1, -1), (1, -1), (1, 1), (-1, 1), (-1, -1)]]
+    geometry = {"type": "MultiPolygon", "coordinates": [[exterior, hole], [[[5, 45], [5.5, 45], [5.5, 45.5], [5, 45]]]]}
+    first, second = split_geometry(geometry).unwrap()
+    assert geometry_area(first) + geometry_area(second) == pytest.approx(geometry_area(geometry), rel=1e-3)
+
+def test_split_into_tiles_keeps_the_area():
+    geometry = {"type": "Polygon", "coordinates": [random_ring(random.Random(2), 64)]}
+    max_area = geometry_area(geometry) / 7
+    tiles = split_into_tiles(geometry, max_area).unwrap()
+    assert len(tiles) >= 7
+    assert all(geometry_area(tile) <= max_area * 1.01 for tile in tiles)
+    assert sum(geometry_area(tile) for tile in tiles) == pytest.approx(geometry_area(geometry), rel=1e-3)
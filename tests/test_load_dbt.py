@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+import load_dbt
+from load_dbt import generate_view, generate_views, incremental_since
+from utils import EXPORT_STATE_FILE
+
+@pytest.fixture
+def models(monkeypatch, tmp_path):
+    monkeypatch.setattr(load_dbt, "MODEL_FOLDER", str(tmp_path / "models"))
+    return tmp_path / "models"
+
+def write_state(folder, partitions):
+    with open(folder / EXPORT_STATE_FILE, 'w') as fs:
+        json.dump({"exported_at": 0.0, "partitions": partitions}, fs)
+
+def test_incremental_since_reads_the_last_export(tmp_path):
+    assert incremental_since(str(tmp_path)) == (False, None)
+
+    write_state(tmp_path, [[2022, "75"], [2021, "13"]])
+    assert incremental_since(str(tmp_path)) == (False, "2021-01-01")
+
+    # The export rewrote all the partitions
+    write_state(tmp_path, None)
+    assert incremental_since(str(tmp_path)) == (True, None)
+
+def test_generate_view_reads_one_dataset_or_their_union(models):
+    generate_view(["mutations"], "dvf_mutations.sql")
+    assert 'FROM DVF."mutations" AS dvf' in (models / "dvf_mutations.sql").read_text()
+
+    generate_view(["classes_1.parquet", "classes_2.parquet"], "dvf_classes.sql")
+    assert 'SELECT * FROM DVF."classes_1.parquet"\nUNION ALL\nSELECT * FROM DVF."classes_2.parquet"' in (models / "dvf_classes.sql").read_text()
+
+def test_generate_views_fails_without_a_dataset(models, tmp_path):
+    (tmp_path / "mutations.parquet").touch()
+    status, message = generate_views(str(tmp_path))
+    assert not status
+    assert "dvf_classes.sql" in message
+    assert not (models / "dvf_classes.sql").exists()
@@ -0,0 +1,41 @@
+from manifest import DeferredFeatures, Manifest
+
+def test_manifest_round_trip(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = Manifest(path)
+    assert manifest.watermark("1_0") is None
+    manifest.complete("1_0", "2024-01-01", "2023-12-20", 10)
+
+    assert Manifest(path).features == {"1_0": {"watermark": "2024-01-01", "last_datemut": "2023-12-20", "mutations": 10}}
+
+def test_watermark_advances_with_each_run(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    manifest.complete("1_0", "2024-01-01", "2023-12-20", 10)
+    # Nothing new since the previous run
+    manifest.complete("1_0", "2024-06-01", None, 0)
+    manifest.complete("1_0", "2025-01-01", "2024-11-02", 3)
+
+    assert manifest.watermark("1_0") == "2025-01-01"
+    assert manifest.features["1_0"]["last_datemut"] == "2024-11-02"
+    assert manifest.features["1_0"]["mutations"] == 13
+
+def test_unreadable_manifest_starts_empty(tmp_path):
+    path = tmp_path / "manifest.json"
+    path.write_text("{")
+    assert Manifest(str(path)).features == {}
+
+def test_deferred_feature_completes_after_its_last_retry():
+    deferred = DeferredFeatures()
+    deferred.extracted("1_0", "2024-01-01", 0, False, "2023-05-01", 4)
+    assert deferred.retried("1_0") is None
+
+    deferred.extracted("2_0", "2024-01-01", 2, False, "2023-05-01", 4)
+    assert deferred.retried("2_0") is None
+    assert deferred.retried("2_0") == ("2_0", "2024-01-01", "2023-05-01", 4)
+    assert deferred.features == {}
+
+def test_deferred_feature_with_a_failed_retry_never_completes():
+    deferred = DeferredFeatures()
+    deferred.extracted("1_0", "2024-01-01", 1, False, None, 0)
+    assert deferred.retried("1_0", failed=True) is None
+    assert deferred.features == {}
@@ -0,0 +1,68 @@
+from dataclasses import replace
+
+import pyarrow.parquet as pq
+
+from pipeline import Pipeline
+from synthetic import SyntheticConfig, generate_response
+from transform_api_dvf import transform_api_data
+from writers import DepartmentWriter
+
+CONFIG = SyntheticConfig(features=200, parcels=2, classes=2, vertices=8)
+
+def responses(count):
+    return [generate_response(replace(CONFIG, seed=index, start=index * CONFIG.features)) for index in range(count)]
+
+def test_pipeline_writes_each_row_once(tmp_path):
+    bodies = responses(3)
+    # The last response overlaps the first one, like two tiles of the same feature
+    bodies.append(bodies[0])
+    writer = DepartmentWriter(str(tmp_path), "1", len(bodies), row_group_size=100)
+    committed = []
+
+    with Pipeline(fetch_workers=2, transform_workers=2, transform_queue=2, write_workers=2, write_queue=2) as pipeline:
+        fetched = [pipeline.fetch(lambda body: body, body) for body in bodies]
+        for future in fetched:
+            pipeline.write(writer, pipeline.transform(future.result()).result())
+            if writer.feature_done():
+                # Queued after all the writes of the department
+                pipeline.submit_write(writer, lambda: committed.append(writer.close()))
+
+    expected = [transform_api_data(body) for body in bodies[:3]]
+    mutations = pq.read_table(tmp_path / "mutations_1.parquet")
+    classes = pq.read_table(tmp_path / "classes_1.parquet")
+    assert [result.ok() for result in committed] == [writer.mutations.path]
+    assert sorted(mutations.column("idg").to_pylist()) == sorted(idg for rows, _ in expected for idg in rows.columns["idg"])
+    assert sorted(classes.column("idg").to_pylist()) == sorted(idg for _, rows in expected for idg in rows.columns["idg"])
+    metadata = pq.ParquetFile(tmp_path / "mutations_1.parquet").metadata
+    assert max(metadata.row_group(index).num_rows for index in range(metadata.num_row_groups)) == 100
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_committed_file_is_sorted_across_row_groups(tmp_path):
+    writer = DepartmentWriter(str(tmp_path), "3", 1, row_group_size=100)
+    for body in responses(3):
+        mutations, classes = transform_api_data(body)
+        writer.write(mutations.to_batch(), classes.to_batch())
+    writer.feature_done()
+    assert writer.close().is_ok()
+
+    metadata = pq.ParquetFile(tmp_path / "mutations_3.parquet").metadata
+    column = metadata.schema.names.index("codepostal")
+    statistics = [metadata.row_group(index).column(column).statistics for index in range(metadata.num_row_groups)]
+    assert metadata.num_row_groups > 1
+    assert all(previous.max <= current.min for previous, current in zip(statistics, statistics[1:]))
+
+def test_failed_write_commits_nothing(tmp_path):
+    writer = DepartmentWriter(str(tmp_path), "2", 1)
+    results = []
+
+    def fail():
+        raise OSError("No space left on device")
+
+    with Pipeline(fetch_workers=1, transform_workers=1, write_workers=1) as pipeline:
+        pipeline.write(writer, pipeline.transform(responses(1)[0]).result())
+        pipeline.submit_write(writer, fail)
+        pipeline.submit_write(writer, lambda: results.append(writer.close()))
+
+    assert results[0].is_err()
+    assert "No space left on device" in results[0].err()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+from rate_limiter import BACKOFF_MAX, CEILING_MARGIN, RATE_INCREASE, RateScheduler, TokenBucket
+
+class Clock:
+    # Time only moves when the code sleeps or the test advances it
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+def test_bucket_refills_at_its_rate_up_to_its_capacity(clock):
+    bucket = TokenBucket(2.0, clock, clock.sleep)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+    # The idle time refills the capacity only
+    clock.now += 10
+    clock.sleeps.clear()
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+def test_quota_halves_the_rate_once_per_decrease(clock):
+    scheduler = RateScheduler(10.0, min_rate=0.2, max_rate=50.0, clock=clock, sleep=clock.sleep)
+    first = scheduler.acquire()
+    second = scheduler.acquire()
+    scheduler.on_quota(first)
+    assert scheduler.rate == 5.0
+    assert scheduler.ceiling == 10.0
+
+    # Sent before the decrease, its 402 is already accounted for
+    scheduler.on_quota(second)
+    assert scheduler.rate == 5.0
+
+    # The bucket is drained, the next request waits for a token at the new rate
+    scheduler.acquire()
+    assert clock.sleeps == [pytest.approx(0.2)]
+
+def test_quota_keeps_the_minimum_rate(clock):
+    scheduler = RateScheduler(0.3, min_rate=0.2, max_rate=50.0, clock=clock, sleep=clock.sleep)
+    scheduler.on_quota(scheduler.acquire())
+    assert scheduler.rate == 0.2
+
+def test_success_recovers_up_to_the_learned_ceiling(clock):
+    scheduler = RateScheduler(10.0, min_rate=0.2, max_rate=50.0, clock=clock, sleep=clock.sleep)
+    scheduler.on_quota(scheduler.acquire())
+    scheduler.on_success()
+    assert scheduler.rate == pytest.approx(5.0 + RATE_INCREASE)
+
+    for _ in range(200):
+        scheduler.on_success()
+    assert scheduler.rate == pytest.approx(10.0 * CEILING_MARGIN)
+
+    # The ceiling rises while no 402 comes, a raised quota is found again
+    clock.now += 100
+    scheduler.on_success()
+    assert scheduler.ceiling == pytest.approx(20.0)
+    assert scheduler.rate == pytest.approx(10.0 * CEILING_MARGIN + RATE_INCREASE)
+
+def test_success_without_quota_stops_at_the_maximum_rate(clock):
+    scheduler = RateScheduler(1.0, min_rate=0.2, max_rate=2.0, clock=clock, sleep=clock.sleep)
+    for _ in range(100):
+        scheduler.on_success()
+    assert scheduler.rate == 2.0
+
+def test_drain_returns_the_deferred_requests_in_order():
+    scheduler = RateScheduler()
+    for item in ("a", "b", "c"):
+        scheduler.defer(item)
+    assert scheduler.queue_depth == 3
+    assert scheduler.drain() == ["a", "b", "c"]
+    assert scheduler.queue_depth == 0
+    assert scheduler.drain() == []
+
+def test_backoff_is_bounded():
+    random.seed(0)
+    scheduler = RateScheduler()
+    for attempt in range(10):
+        assert 0 <= scheduler.backoff(attempt) <= min(BACKOFF_MAX, 2 ** attempt)
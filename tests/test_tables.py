@@ -0,0 +1,100 @@
+import datetime
+import random
+
+import pyarrow as pa
+import pytest
+
+from tables import MUTATIONS_SCHEMA, CLASSES_SCHEMA, ClassesBuilder, MutationsBuilder, SharedMutationProps, global_id, parse_dates
+
+SHARED_PROPS = SharedMutationProps(vefa=False, typologie="Maison", datemut="2020-05-17", nature="Vente")
+
+def parcelle(idpar="75101000AB0001", **changes):
+    value = {
+        "idpar": idpar,
+        "parcvendue": True,
+        "adresses": [{"btq": None, "voie": "DE LA GARE", "novoie": "12", "codvoie": "0123",
+                      "commune": "Paris", "typvoie": "RUE", "codepostal": "75001"}],
+    }
+    value.update(changes)
+    return value
+
+def test_global_id_is_stable_and_fits_a_bigint():
+    idg = global_id(123, "75101000AB0001")
+    assert idg == global_id(123, "75101000AB0001")
+    assert 0 <= idg < 2 ** 63
+    assert idg != global_id(123, "75101000AB0002")
+    assert idg != global_id(124, "75101000AB0001")
+
+def test_global_id_separates_the_key_fields():
+    # The separator keeps (1, "23...") and (12, "3...") apart
+    assert global_id(1, "23") != global_id(12, "3")
+
+def test_global_id_has_no_collisions():
+    rng = random.Random(0)
+    keys = {(rng.randrange(1, 10 ** 9), f"{rng.randrange(1, 96):02d}{rng.randrange(1, 999):03d}000AB{rng.randrange(1, 9999):04d}") for _ in range(200000)}
+    assert len({global_id(*key) for key in keys}) == len(keys)
+
+def test_mutations_builder():
+    mutations = MutationsBuilder()
+    mutations.extract(parcelle(), SHARED_PROPS, 250000.0, 7, global_id(7, "75101000AB0001"))
+    mutations.extract(parcelle("75101000AB0002", adresses=[{"voie": 12}]), SHARED_PROPS, 250000.0, 7, 2)
+
+    batch = mutations.to_batch()
+    assert batch.schema == MUTATIONS_SCHEMA
+    rows = batch.to_pylist()
+    assert rows[0]["idg"] == global_id(7, "75101000AB0001")
+    assert rows[0]["datemut"] == datetime.date(2020, 5, 17)
+    assert rows[0]["codepostal"] == "75001"
+    # The values that aren't strings are dropped
+    assert rows[1]["voie"] is None
+    assert mutations.last_datemut() == "2020-05-17"
+
+@pytest.mark.parametrize("changes, message", [
+    ({"idpar": None}, "idpar"),
+    ({"parcvendue": "oui"}, "parcvendue"),
+    ({"adresses": None}, "adresses"),
+    ({"adresses": []}, "non-empty list"),
+    ({"adresses": ["12 rue de la Gare"]}, "dictionary"),
+])
+def test_mutations_builder_rejects_invalid_parcels(changes, message):
+    with pytest.raises(ValueError, match=message):
+        MutationsBuilder().extract(parcelle(**changes), SHARED_PROPS, 1.0, 1, 1)
+
+def test_classes_builder_keeps_the_valid_classes():
+    classes = ClassesBuilder()
+    classes.extract([
+        {"libregroupement": "Sols", "surface": 120},
+        {"libregroupement": "Jardins", "surface": 0.5},
+        {"libregroupement": None, "surface": 10.0},
+        {"libregroupement": "Bois", "surface": "10"},
+        "Prés",
+        {"libregroupement": "Prés", "surface": 1.0},
+    ], 42)
+    batch = classes.to_batch()
+    assert batch.schema == CLASSES_SCHEMA
+    assert batch.to_pylist() == [
+        {"idg": 42, "libelle": "Sols", "surface": 120.0},
+        {"idg": 42, "libelle": "Prés", "surface": 1.0},
+    ]
+
+def test_rollback_drops_the_rows_of_a_feature():
+    mutations = MutationsBuilder()
+    mutations.extract(parcelle(), SHARED_PROPS, 1.0, 1, 1)
+    size = len(mutations)
+    mutations.extract(parcelle("75101000AB0002"), SHARED_PROPS, 1.0, 2, 2)
+    mutations.rollback(size)
+    assert len(mutations) == 1
+    assert all(len(column) == 1 for column in mutations.columns.values())
+    assert mutations.to_batch().column("idg").to_pylist() == [1]
+
+def test_strings_are_interned():
+    mutations = MutationsBuilder()
+    for index in range(3):
+        mutations.extract(parcelle(adresses=[{"commune": "".join(["Par", "is"])}]), SHARED_PROPS, 1.0, index, index)
+    communes = mutations.columns["commune"]
+    assert communes[0] is communes[1] is communes[2]
+
+def test_parse_dates():
+    dates = parse_dates(["2020-05-17", "not a date", "2020-05-17", "2014-01-01"])
+    assert dates.type == pa.date32()
+    assert dates.to_pylist() == [datetime.date(2020, 5, 17), datetime.date(1970, 1, 1), datetime.date(2020, 5, 17), datetime.date(2014, 1, 1)]
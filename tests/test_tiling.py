@@ -0,0 +1,45 @@
+from tiling import SURFACE_SHRINK, SurfaceLimit, TilingCache, fingerprint
+
+SQUARE = {"type": "Polygon", "coordinates": [[[2.0, 48.0], [2.1, 48.0], [2.1, 48.1], [2.0, 48.1], [2.0, 48.0]]]}
+TILES = [{"type": "Polygon", "coordinates": [[[2.0, 48.0], [2.05, 48.0], [2.05, 48.1], [2.0, 48.1], [2.0, 48.0]]]}]
+
+def test_fingerprint_ignores_the_noise_below_its_precision():
+    noisy = {"type": "Polygon", "coordinates": [[[x + 1e-10, y] for x, y in SQUARE["coordinates"][0]]]}
+    moved = {"type": "Polygon", "coordinates": [[[x + 1e-3, y] for x, y in SQUARE["coordinates"][0]]]}
+    assert fingerprint(noisy) == fingerprint(SQUARE)
+    assert fingerprint(moved) != fingerprint(SQUARE)
+
+def test_tiling_cache_round_trip(tmp_path):
+    path = tmp_path / "tiling.json"
+    cache = TilingCache(str(path))
+    cache.save()
+    assert not path.exists()
+
+    cache.put(SQUARE, TILES)
+    cache.save()
+    assert TilingCache(str(path)).get(SQUARE) == TILES
+
+    cache.forget(SQUARE)
+    cache.save()
+    assert TilingCache(str(path)).get(SQUARE) is None
+
+def test_surface_limit_bounds(tmp_path):
+    path = str(tmp_path / "surface_limit.json")
+    limit = SurfaceLimit(path)
+    limit.accepted(3e6)
+    assert limit.target() is None
+
+    limit.rejected(10e6, "10.00 km²")
+    assert limit.target() == 10e6 * SURFACE_SHRINK
+    # Accepted surfaces above the shrunk target raise it, the ones above the rejected surface are ignored
+    limit.accepted(7e6)
+    limit.accepted(12e6)
+    assert limit.target() == 7e6
+
+    # A smaller rejected surface lowers both bounds
+    limit.rejected(6e6, "6.00 km²")
+    assert (limit.max_accepted, limit.min_rejected) == (6e6, 6e6)
+    assert limit.target() == 6e6 * SURFACE_SHRINK
+
+    reloaded = SurfaceLimit(path)
+    assert (reloaded.max_accepted, reloaded.min_rejected) == (6e6, 6e6)
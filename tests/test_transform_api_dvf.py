@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+import transform_api_dvf
+from transform_api_dvf import CUT_MARGIN, FeatureStream, iter_chunks
+
+BACKENDS = ["json", pytest.param("orjson", marks=pytest.mark.skipif(transform_api_dvf.orjson is None, reason="orjson is not installed"))]
+CHUNK_SIZES = [1, 2, 3, 7, CUT_MARGIN - 1, CUT_MARGIN, CUT_MARGIN + 1, 2 * CUT_MARGIN + 5, 4096]
+
+FEATURES = [
+    {"type": "Feature", "properties": {"idmutation": 1, "valeurfonc": 125000.5, "l_idpar": ["75101000AB0001"]}},
+    {"properties": {"text": "brackets ]}{[ and \"quotes\" and \\ in a string", "empty": "", "list": []}},
+    {"properties": {"accents": "Évry-Courcouronnes", "emoji": "\U0001f3e0", "escaped": "é\n\t"}},
+    {"properties": {"literals": [True, False, None], "numbers": [-0.5, 1e-7, 12345678901234567890, 0]}},
+    {"properties": {"long": "x" * (3 * CUT_MARGIN), "nested": [[[{"a": [{}]}]]]}},
+    [1, [2, [3]]],
+    "a string feature",
+    123456789,
+    -1.5e10,
+    True,
+    None,
+    {},
+]
+
+def payload(features, indent=None):
+    # 'features' also appears nested and inside a string, only the top level key is the list of features
+    data = {
+        "type": "FeatureCollection",
+        "meta": {"features": [{"nested": True}], "note": "\"features\": []"},
+        "features": features,
+        "count": len(features),
+    }
+    return json.dumps(data, ensure_ascii=False, indent=indent)
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    monkeypatch.setattr(transform_api_dvf, "JSON_BACKEND", request.param)
+    return request.param
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("indent", [None, 2])
+def test_features_cut_at_any_position(backend, size, indent):
+    text = payload(FEATURES, indent)
+    assert list(FeatureStream(iter_chunks(text, size))) == FEATURES
+    assert list(FeatureStream(iter_chunks(text.encode("utf-8"), size))) == FEATURES
+
+def test_every_cut_position(backend):
+    # Two chunks, cut at every position of the content, including inside multi-byte characters
+    data = payload(FEATURES).encode("utf-8")
+    for cut in range(1, len(data)):
+        assert list(FeatureStream([data[:cut], data[cut:]])) == FEATURES
+
+@pytest.mark.parametrize("size", [CUT_MARGIN, 1000, 4096])
+def test_content_larger_than_the_buffer(backend, size):
+    # Enough features for the consumed content to be released while streaming
+    features = [{"properties": {"idmutation": index, "text": "é" * (index % 50)}} for index in range(3000)]
+    text = payload(features)
+    assert len(text) > 2 * transform_api_dvf.CHUNK_SIZE
+    assert list(FeatureStream(iter_chunks(text.encode("utf-8"), size))) == features
+
+@pytest.mark.parametrize("size", [1, CUT_MARGIN, 4096])
+def test_empty_features(backend, size):
+    assert list(FeatureStream(iter_chunks(payload([]), size))) == []
+
+@pytest.mark.parametrize("size", [1, 5, CUT_MARGIN])
+def test_truncated_content(backend, size):
+    text = payload(FEATURES)
+    end = text.index('"count"')
+    for cut in (text.index('"features"') + 5, end - 40, end - 3):
+        with pytest.raises(ValueError, match="Unexpected end of the content"):
+            list(FeatureStream(iter_chunks(text[:cut], size)))
+
+@pytest.mark.parametrize("data, message", [
+    ('[{"features": []}]', "Expected a dictionary"),
+    ('{"type": "FeatureCollection"}', "Failed to get the value of the key 'features'"),
+    ('{"features": {"a": 1}}', "Expected a list"),
+    ('{"features": [{"a": 1} {"b": 2}]}', "Unexpected character"),
+    ('{"features": [{"a": tru}]}', "Failed to convert the data content to JSON"),
+])
+def test_invalid_content(backend, data, message):
+    for size in (1, CUT_MARGIN, 4096):
+        with pytest.raises(ValueError, match=message):
+            list(FeatureStream(iter_chunks(data, size)))